@@ -2,6 +2,8 @@ from rest_framework import pagination
 from rest_framework.response import Response
 from django.shortcuts import reverse
 
+from core.utils.pagination import KeysetPagination
+
 
 class ResultSetPagination(pagination.PageNumberPagination):
 	page_size = 10
@@ -20,4 +22,18 @@ class ResultSetPagination(pagination.PageNumberPagination):
 				'next_page': self.get_next_link()
 			},
 			'results': data,
-		})
\ No newline at end of file
+		})
+
+
+class ChatMessageCursorPagination(KeysetPagination):
+	"""Chat history pages by '?before=<message id>' / '?after=<message id>', older pages continue into the archive"""
+	page_size = 10
+	ordering_field = 'created'
+	use_archive = True
+
+
+class ChatMessageSearchPagination(KeysetPagination):
+	"""Search result pages ordered by rank, next page by '?before=<message id>'"""
+	page_size = 20
+	ordering_field = 'rank'
+	compare_in_db = True  # 'ts_rank' is float4, it doesn't come back equal from python
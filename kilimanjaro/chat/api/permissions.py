@@ -3,13 +3,14 @@ from rest_framework import permissions
 
 class ChatRoomPermission(permissions.BasePermission):
     def has_permission(self, request, view):
-        if view.action in ["list", "block_chat_room", "unblock_chat_room", "blocked_chat_room_list"]:
+        if view.action in ["list", "block_chat_room", "unblock_chat_room", "blocked_chat_room_list",
+                            "mark_room_read", "unread_count"]:
                 return True
         return False
 
 
 class ChatmessagePermission(permissions.BasePermission):
     def has_permission(self, request, view):
-        if view.action in ["list", "report_message"]:
+        if view.action in ["list", "report_message", "search"]:
                 return True
         return False
\ No newline at end of file
@@ -3,17 +3,22 @@ from chat.models import ChatMessage
 
 from django.conf import settings
 
+from core.utils.general_data import CHAT_ATTACHMENT_DISPLAY_SIZE
+from core.utils.images import pick_variant, with_host
+
 
 class ChatMessageSerializer(serializers.ModelSerializer):
     sender = serializers.SerializerMethodField()
     attachment_links = serializers.SerializerMethodField()
+    attachment_previews = serializers.SerializerMethodField()
     send_by = serializers.SerializerMethodField()
     created_at = serializers.SerializerMethodField()
 
     class Meta:
         model = ChatMessage
         fields = ("id", 'sender', 'message_type', 'send_by',
-                'message_text', 'attachment_links', 'is_deleted', 'created_at')
+                'message_text', 'attachment_links', 'attachment_previews', 'voice', 'voice_waveform',
+                'is_deleted', 'created_at')
 
     def get_sender(self, obj):
         sender = obj.sender
@@ -30,6 +35,14 @@ class ChatMessageSerializer(serializers.ModelSerializer):
             attachment_links = [f"{settings.SITE_HOST}{link}" for link in obj.attachment_links]
         return attachment_links
 
+    def get_attachment_previews(self, obj):
+        # smallest image variant per attachment link, None until it's made or when attachment isn't an image
+        attachment_variants = obj.attachment_variants or [None] * len(obj.attachment_links or [])
+        return [
+            with_host(pick_variant(variants, CHAT_ATTACHMENT_DISPLAY_SIZE), settings.SITE_HOST)
+            for variants in attachment_variants
+        ]
+
     def get_send_by(self, obj):
         return "me" if obj.sender == self.context['request'].user else "other"
 
@@ -39,7 +52,14 @@ class ChatMessageSerializer(serializers.ModelSerializer):
             "time": obj.created.strftime("%I:%M %p")
         }
 
-    
 
+class ChatMessageSearchSerializer(ChatMessageSerializer):
+    headline = serializers.SerializerMethodField()
 
+    class Meta:
+        model = ChatMessage
+        fields = ChatMessageSerializer.Meta.fields + ('room_id', 'headline')
 
+    def get_headline(self, obj):
+        # message text with matched words in <b></b>, made by the search view for the page rows
+        return self.context['headlines'].get(obj.id, obj.message_text)
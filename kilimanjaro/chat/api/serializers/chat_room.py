@@ -6,26 +6,39 @@ from .chat_message import ChatMessageSerializer
 
 class ChatRoomSerializer(serializers.ModelSerializer):
     chat_room_partner = serializers.SerializerMethodField()
-    messages = serializers.SerializerMethodField()
+    last_message = serializers.SerializerMethodField()
+    unread_count = serializers.SerializerMethodField()
     blocked_by_partner = serializers.SerializerMethodField()
     blocked_by_me = serializers.SerializerMethodField()
 
     class Meta:
         model = ChatRoom
-        fields = ("id", 'chat_room_partner', 'blocked_by_partner', 'blocked_by_me', 'messages')
+        fields = ("id", 'chat_room_partner', 'blocked_by_partner', 'blocked_by_me', 'last_message', 'unread_count')
 
     def get_chat_room_partner(self, obj):
         partner = obj.get_room_partner(self.context['request'].user)
         return {
             'id': partner.id,
             'username': partner.__str__(),
-            'profile_pic': partner.profile_image
+            'profile_pic': partner.profile_image,
+            'is_online': partner.id in self.context.get('online_user_ids', ()),  # looked up once by the view
         }
 
-    def get_messages(self, obj):
-        messages = ChatMessage.objects.filter(room=obj)[:10]
-        serializer = ChatMessageSerializer(messages, many=True, context={'request': self.context['request']})
-        return serializer.data
+    def get_last_message(self, obj):
+        # denormalized summary of the room, no message query
+        if not obj.last_message_id:
+            return None
+        return {
+            'id': obj.last_message_id,
+            'preview': obj.last_message_preview,
+            'created_at': {
+                "date": obj.last_message_at.strftime("%d %b, %Y"),
+                "time": obj.last_message_at.strftime("%I:%M %p")
+            }
+        }
+
+    def get_unread_count(self, obj):
+        return obj.get_unread_count(self.context['request'].user)
 
     def get_blocked_by_partner(self, obj):
         user = self.context['request'].user
@@ -41,6 +54,19 @@ class ChatRoomSerializer(serializers.ModelSerializer):
         elif user == obj.room_member_2:
             return obj.is_blocked_by_member_2
 
+class ChatRoomDetailSerializer(ChatRoomSerializer):
+    messages = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ChatRoom
+        fields = ChatRoomSerializer.Meta.fields + ('messages',)
+
+    def get_messages(self, obj):
+        messages = ChatMessage.objects.filter(room=obj).select_related('sender').order_by('-created', '-id')[:10]
+        serializer = ChatMessageSerializer(messages, many=True, context={'request': self.context['request']})
+        return serializer.data
+
+
 class ChatBlockRoomSerializer(serializers.ModelSerializer):
     chat_room_partner = serializers.SerializerMethodField()
 
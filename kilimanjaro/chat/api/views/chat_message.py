@@ -1,12 +1,15 @@
 from rest_framework import permissions, viewsets
-from django.db.models import Q, F
-from chat.api.pagination import ResultSetPagination
+from django.contrib.postgres.search import SearchHeadline, SearchQuery, SearchRank
+from django.db.models import F, Q
+from chat.api.pagination import ChatMessageCursorPagination, ChatMessageSearchPagination
 from rest_framework.decorators import action
 from rest_framework.response import Response
 
-from chat.api.serializers import ChatMessageSerializer
-from chat.models import ChatMessage, ChatRoom, ChatMessageReport
+from chat.api.serializers import ChatMessageSerializer, ChatMessageSearchSerializer
+from chat.models import ArchivedChatMessage, ChatMessage, ChatRoom, ChatMessageReport
+from chat.partitions import archive_exists
 from chat.api.permissions import ChatmessagePermission
+from core.utils.general_data import CHAT_SEARCH_CONFIG
 
 
 class ChatMessageViewset(viewsets.ModelViewSet):
@@ -16,28 +19,80 @@ class ChatMessageViewset(viewsets.ModelViewSet):
     -------
         get_queryset:
             Returns chat room messages filtered by room
+        get_archive_queryset:
+            Returns archived messages of the room
+        search:
+            Full text search over messages of the request user's rooms
     """
 
     serializer_class = ChatMessageSerializer
     permission_classes = [permissions.IsAuthenticated, ChatmessagePermission]
-    pagination_class = ResultSetPagination
+    pagination_class = ChatMessageCursorPagination
     http_method_names = ["get", 'post']
 
     def get_queryset(self):
-        """Returns chat rooms filtered by request user and ordering by last message's modified date"""
+        """Returns chat room messages, pagination orders them by (created, id) newest first"""
 
         room_id = self.request.GET.get('room_id')
-        room = ChatRoom.objects.filter(id=room_id).filter(
+        self.room = ChatRoom.objects.filter(id=room_id).filter(
                     Q(room_member_1=self.request.user)|Q(room_member_2=self.request.user)
                 ).first()
 
-        messages = []
+        messages = ChatMessage.objects.none()
 
-        if room:
-            messages = ChatMessage.objects.select_related('sender', 'receiver').filter(room=room).order_by(F('modified').desc(nulls_last=True))
+        if self.room:
+            messages = ChatMessage.objects.select_related('sender', 'receiver').filter(room=self.room)
 
         return messages
 
+    def get_archive_queryset(self):
+        """Returns archived messages of the room, pagination reads them after the oldest room message"""
+
+        if not self.room or not archive_exists():
+            return None
+        return ArchivedChatMessage.objects.select_related('sender', 'receiver').filter(room=self.room)
+
+    @action(detail=False, methods=["GET"], url_path='search')
+    def search(self, request):
+        """Full text search over messages of the request user's rooms
+
+        Parameters:
+            q (str): search text, supports "quoted phrases", or and -word
+            room_id (int): searches only the room (optional)
+
+        Returns:
+            Most relevant messages first with highlighted 'headline'
+        """
+        text = request.GET.get('q', '').strip()
+        if not text:
+            return Response({"message": "Search text is required!"}, status=400)
+
+        query = SearchQuery(text, config=CHAT_SEARCH_CONFIG, search_type='websearch')
+        user = request.user
+
+        # gin index finds the matching rows, room membership and rank are checked on those only
+        messages = ChatMessage.objects.select_related('sender').filter(
+                    Q(room__room_member_1=user)|Q(room__room_member_2=user),
+                    search_vector=query, is_deleted=False,
+                ).annotate(rank=SearchRank(F('search_vector'), query))
+
+        room_id = request.GET.get('room_id')
+        if room_id:
+            if not room_id.isdigit():
+                return Response({"message": "Invalid Room ID!"}, status=400)
+            messages = messages.filter(room_id=room_id)
+
+        paginator = ChatMessageSearchPagination()
+        page = paginator.paginate_queryset(messages, request, view=self)
+
+        # headlines are costly, so they are made for the page rows only
+        headlines = dict(ChatMessage.objects.filter(id__in=[message.id for message in page]).annotate(
+            headline=SearchHeadline('message_text', query, config=CHAT_SEARCH_CONFIG, start_sel='<b>', stop_sel='</b>')
+        ).values_list('id', 'headline'))
+
+        serializer = ChatMessageSearchSerializer(page, many=True, context={'request': request, 'headlines': headlines})
+        return paginator.get_paginated_response(serializer.data)
+
     @action(detail=False, methods=["POST"], url_path='report/(?P<message_id>[^/.]+)')
     def report_message(self, request, message_id):
         """Report a message
@@ -1,12 +1,14 @@
 from rest_framework import permissions, viewsets
-from django.db.models import Q, F, Max
+from django.db.models import Q, F, Case, When
 from chat.api.pagination import ResultSetPagination
 from rest_framework.decorators import action, api_view, permission_classes
 from rest_framework.response import Response
 
-from chat.api.serializers import ChatRoomSerializer, ChatBlockRoomSerializer
+from chat.api.serializers import ChatRoomSerializer, ChatRoomDetailSerializer, ChatBlockRoomSerializer
 from chat.models import ChatRoom, ChatRoomBlockLog
 from chat.api.permissions import ChatRoomPermission
+from chat.presence import online_users
+from chat.utils import send_room_state, schedule_read_receipt
 from django.contrib.auth import get_user_model
 
 User = get_user_model()
@@ -18,13 +20,19 @@ class ChatRoomViewset(viewsets.ModelViewSet):
     Methods
     -------
         get_queryset:
-            Returns chat rooms filtered by request user and ordering by last message modified date
+            Returns chat rooms filtered by request user and ordering by last message date
+        list:
+            Returns a page of chat rooms with online state of the partners
         block_room:
             Block's chat room
         unblock_room:
             Unblock's chat room
         blocked_room_list:
             Block chat room list
+        mark_room_read:
+            Moves read watermark of the request user
+        unread_count:
+            Unread message counts of the request user
     """
 
     serializer_class = ChatRoomSerializer
@@ -33,17 +41,27 @@ class ChatRoomViewset(viewsets.ModelViewSet):
     http_method_names = ["get", "post"]
 
     def get_queryset(self):
-        """Returns chat rooms filtered by request user and ordering by last message modified date"""
+        """Returns chat rooms filtered by request user and ordering by last message date"""
 
-        # filter rooms and order by last room message modified date
+        # last message summary is stored on the room, so the list is a single query
         rooms = ChatRoom.objects.select_related('room_member_1', 'room_member_2').filter(
                     Q(room_member_1=self.request.user)|Q(room_member_2=self.request.user)
-                ).annotate(
-                    latest_message_date=Max(F('chatmessage__modified'))
-                ).order_by(F('latest_message_date').desc(nulls_last=True))
+                ).order_by(F('last_message_at').desc(nulls_last=True), '-id')
 
         return rooms
 
+    def list(self, request, *args, **kwargs):
+        """Returns a page of chat rooms with online state of the partners"""
+
+        rooms = self.paginate_queryset(self.get_queryset())
+
+        # presence of all partners of the page in one redis round trip
+        partner_ids = [room.get_room_partner(request.user).id for room in rooms]
+        context = {**self.get_serializer_context(), 'online_user_ids': online_users(partner_ids)}
+
+        serializer = self.get_serializer_class()(rooms, many=True, context=context)
+        return self.get_paginated_response(serializer.data)
+
     @action(detail=False, methods=["GET"], url_path='block_list')
     def blocked_chat_room_list(self, request):
         """block chat room list
@@ -82,6 +100,7 @@ class ChatRoomViewset(viewsets.ModelViewSet):
             room.is_blocked_by_member_2 = True
 
         room.save() 
+        send_room_state(room)  # connected consumers have the room cached
 
         # chat room block log 
         partner = room.get_room_partner(request.user)
@@ -117,6 +136,7 @@ class ChatRoomViewset(viewsets.ModelViewSet):
             room.is_blocked_by_member_2 = False
 
         room.save()
+        send_room_state(room)  # connected consumers have the room cached
 
         # chat room block log 
         partner = room.get_room_partner(request.user)
@@ -127,6 +147,57 @@ class ChatRoomViewset(viewsets.ModelViewSet):
 
         return Response({"message": "Chat Room is unblocked successfully."}, status=200)
 
+    @action(detail=False, methods=["POST"], url_path='mark_read/(?P<room_id>[^/.]+)')
+    def mark_room_read(self, request, room_id):
+        """Marks room messages as read until a message
+
+        Parameters:
+            room_id (int): room's id
+            message_id (int): last read message id, last message of the room by default
+        Returns:
+            Success or error response
+        """
+        room = ChatRoom.objects.filter(id=room_id).filter(
+                    Q(room_member_1=request.user)|Q(room_member_2=request.user)
+                ).first()
+        if not room:
+            return Response({"message": "Chat Room not found for this room id"}, status=404)
+
+        message_id = request.data.get('message_id')
+        if message_id is not None and not str(message_id).isdigit():
+            return Response({"message": "Invalid message ID!"}, status=400)
+
+        if room.mark_as_read(request.user, int(message_id) if message_id is not None else None):
+            schedule_read_receipt(room.id, request.user.id)
+
+        return Response({"message": "Success!"}, status=200)
+
+    @action(detail=False, methods=["GET"], url_path='unread_count')
+    def unread_count(self, request):
+        """Unread message counts of the request user for badges
+
+        Returns:
+            Total unread count and unread count of the rooms that have unread messages
+        """
+        user = request.user
+
+        # single query over the user's rooms, counts are derived from read watermarks
+        rooms = ChatRoom.objects.filter(
+                    Q(room_member_1=user, message_seq__gt=F('last_read_seq_member_1')) |
+                    Q(room_member_2=user, message_seq__gt=F('last_read_seq_member_2'))
+                ).annotate(
+                    unread=Case(
+                        When(room_member_1=user, then=F('message_seq') - F('last_read_seq_member_1')),
+                        default=F('message_seq') - F('last_read_seq_member_2'),
+                    )
+                ).values_list('id', 'unread')
+
+        rooms = [{"room_id": room_id, "unread_count": unread} for room_id, unread in rooms]
+        return Response({
+            "total": sum(room["unread_count"] for room in rooms),
+            "rooms": rooms,
+        }, status=200)
+
 
 @api_view(['GET',])
 @permission_classes([permissions.IsAuthenticated,])
@@ -135,14 +206,12 @@ def user_and_partner_single_room_info(request, room_partner_username):
     
     room_partner = User.objects.filter(username=room_partner_username).first()
     if room_partner:
-        room = ChatRoom.objects.filter(
-                Q(room_member_1=request.user, room_member_2=room_partner)|
-                Q(room_member_1=room_partner, room_member_2=request.user)
-            ).first()
+        room = ChatRoom.objects.get_for_members(request.user, room_partner)
         if not room and request.user.can_chat_together(room_partner):
-            room = ChatRoom.objects.create(room_member_1=request.user, room_member_2=room_partner)
+            room = ChatRoom.objects.get_or_create_for_members(request.user, room_partner)
 
-        room_serializer = ChatRoomSerializer(room, context={'request': request})
+        online_user_ids = online_users([room_partner.id])
+        room_serializer = ChatRoomDetailSerializer(room, context={'request': request, 'online_user_ids': online_user_ids})
         return Response(room_serializer.data, status=200)
     return Response({"message": "Not found any user with this username"}, status=404)
 
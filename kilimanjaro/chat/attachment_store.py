@@ -0,0 +1,310 @@
+"""Content addressed storage of chat attachment and voice files.
+
+Every distinct content is written once to 'CHAT_BLOB_DIR/<sha256[:2]>/<sha256>.<ext>' (a blob).
+A room gets a hard link of the blob, '<room uuid>/<sha256[:32]>.<ext>' (a reference), so urls
+keep the room layout of media root while forwarded and re-sent files take no extra disk space
+and no extra writes.
+
+    ChatAttachmentBlob.ref_count       number of references of the blob
+    ChatAttachmentReference.ref_count  number of messages using the room file
+
+Deleting a message releases it's files, files are removed when nothing uses them anymore.
+'gc_chat_attachments' management command recounts references from the messages, so files of
+unsent messages and deleted rooms are collected too.
+
+The blob row is locked while it's files are written or removed, so a file can't be removed
+while it's being stored again.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+import uuid
+from datetime import timedelta
+from typing import Optional
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.move import file_move_safe
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+from PIL import UnidentifiedImageError
+
+from chat.models import ArchivedChatMessage, ChatAttachmentBlob, ChatAttachmentReference, ChatMessage
+from chat.partitions import archive_exists
+from core.utils import images
+from core.utils.general_data import CHAT_BLOB_DIR, CHAT_BLOB_GC_GRACE
+
+logger = logging.getLogger(__name__)
+
+
+def media_path(path: str) -> str:
+    """Returns absolute path of a path inside media root"""
+    return os.path.join(settings.MEDIA_ROOT, path)
+
+
+def file_digest(file: File) -> str:
+    """Returns sha256 of the file, chunked uploads are hashed while they are received"""
+
+    digest = getattr(file, "sha256", None)
+    if digest:
+        return digest
+
+    sha256 = hashlib.sha256()
+    file.seek(0)
+    for chunk in file.chunks():
+        sha256.update(chunk)
+    file.seek(0)
+    return sha256.hexdigest()
+
+
+def file_extension(name: str) -> str:
+    """Returns lower case extension of a file name like '.png'"""
+    return os.path.splitext(name or "")[1].lower()[:10]
+
+
+def write_blob(file: File, path: str) -> None:
+    """Writes the file to the blob path, a half written blob is never visible"""
+
+    full_path = media_path(path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    temp_path = f"{full_path}.{uuid.uuid4().hex}.tmp"
+
+    if hasattr(file, "temporary_file_path"):
+        file_move_safe(file.temporary_file_path(), temp_path)  # rename, data isn't copied
+    else:
+        file.seek(0)
+        with open(temp_path, "wb") as blob_file:
+            for chunk in file.chunks():
+                blob_file.write(chunk)
+
+    os.replace(temp_path, full_path)
+
+
+def link_file(blob_path: str, path: str) -> None:
+    """Links the blob file to the room path, copies it when links aren't supported"""
+
+    full_path = media_path(path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    try:
+        os.link(media_path(blob_path), full_path)
+    except FileExistsError:
+        pass
+    except OSError:  # other filesystem or no hard link support
+        shutil.copyfile(media_path(blob_path), full_path)
+
+
+def remove_file(path: str) -> int:
+    """Removes a file inside media root, returns it's size"""
+
+    try:
+        size = os.stat(media_path(path)).st_size
+        os.remove(media_path(path))
+    except FileNotFoundError:
+        return 0
+    return size
+
+
+def store_file(file: File, path: str) -> str:
+    """Saves the file once per content and links it to the path
+
+    Parameters:
+        file (File): attachment or voice file
+        path (str): directory path inside media root like '<room uuid>/'
+
+    Returns:
+        Url path of the file
+    """
+    digest = file_digest(file)
+    extension = file_extension(file.name)
+
+    with transaction.atomic():
+        blob, _ = ChatAttachmentBlob.objects.select_for_update().get_or_create(
+            sha256=digest,
+            defaults={"size": file.size, "path": f"{CHAT_BLOB_DIR}{digest[:2]}/{digest}{extension}"},
+        )
+        if not os.path.exists(media_path(blob.path)):  # new content
+            write_blob(file, blob.path)
+
+        reference, is_created = ChatAttachmentReference.objects.get_or_create(
+            path=f"{path}{digest[:32]}{extension}", defaults={"blob": blob}
+        )
+        if not os.path.exists(media_path(reference.path)):
+            link_file(blob.path, reference.path)
+
+        ChatAttachmentReference.objects.filter(id=reference.id).update(ref_count=F('ref_count') + 1)
+        if is_created:
+            ChatAttachmentBlob.objects.filter(id=blob.id).update(ref_count=F('ref_count') + 1)
+
+    return settings.MEDIA_URL + reference.path
+
+
+def url_to_path(url: str) -> str:
+    """Returns path inside media root of a file url, None for other urls"""
+
+    if url and url.startswith(settings.MEDIA_URL):
+        return url[len(settings.MEDIA_URL):]
+    return None
+
+
+def release_files(urls: list) -> int:
+    """Releases the files of a deleted message, removes files which aren't used anymore
+
+    Parameters:
+        urls (list): attachment and voice urls of the message
+
+    Returns:
+        Number of reclaimed bytes
+    """
+    reclaimed = 0
+    for path in filter(None, map(url_to_path, urls)):
+        blob_id = ChatAttachmentReference.objects.filter(path=path).values_list('blob_id', flat=True).first()
+        if not blob_id:
+            continue  # file was saved before the attachment store
+
+        with transaction.atomic():
+            # blob is locked first like 'store_file' does
+            blob = ChatAttachmentBlob.objects.select_for_update().get(id=blob_id)
+            reference = ChatAttachmentReference.objects.filter(path=path).first()
+            if not reference or reference.ref_count <= 0:
+                continue
+
+            reference.ref_count -= 1
+            if reference.ref_count:
+                reference.save(update_fields=['ref_count', 'modified'])
+                continue
+
+            reclaimed += remove_reference(blob, reference)
+
+    return reclaimed
+
+
+def purge_files(urls: list) -> int:
+    """Releases the files of a purged message, files saved before the attachment store are removed
+
+    Parameters:
+        urls (list): attachment and voice urls of the message
+
+    Returns:
+        Number of reclaimed bytes
+    """
+    reclaimed = 0
+    for path in filter(None, map(url_to_path, urls)):
+        if ChatAttachmentReference.objects.filter(path=path).exists():
+            reclaimed += release_files([settings.MEDIA_URL + path])
+        else:
+            reclaimed += remove_file(path)  # every message had it's own file then
+    return reclaimed
+
+
+def remove_reference(blob: ChatAttachmentBlob, reference: ChatAttachmentReference) -> int:
+    """Removes an unused reference and it's blob when the blob isn't used anymore, blob has to be locked
+
+    Returns:
+        Number of reclaimed bytes, room files are links so only the blob takes space
+    """
+    reference.delete()
+    remove_file(reference.path)
+
+    blob.ref_count -= 1
+    if blob.ref_count > 0:
+        blob.save(update_fields=['ref_count', 'modified'])
+        return 0
+
+    blob.delete()
+    images.remove_variants(blob.variants)
+    return remove_file(blob.path)
+
+
+def image_variants(url: str) -> Optional[dict]:
+    """Returns image variants of an attachment, variants of a content are made once
+
+    Parameters:
+        url (str): attachment url path
+
+    Returns:
+        Variants dict or None when attachment isn't a stored image
+    """
+    path = url_to_path(url)
+    blob = ChatAttachmentBlob.objects.filter(references__path=path).first() if path else None
+    if not blob:
+        return None
+
+    if not blob.variants:
+        try:
+            with open(media_path(blob.path), "rb") as file:
+                variants = images.make_variants(file, f"{CHAT_BLOB_DIR}variants/{blob.sha256}")
+        except (UnidentifiedImageError, OSError):  # not an image
+            variants = {}
+        variants["source"] = blob.path
+
+        with transaction.atomic():
+            blob = ChatAttachmentBlob.objects.select_for_update().filter(id=blob.id).first()
+            if not blob or blob.variants:  # removed or made by another task meanwhile
+                images.remove_variants(variants)
+            else:
+                blob.variants = variants
+                blob.save(update_fields=['variants', 'modified'])
+
+    if not blob or not any(isinstance(variant, dict) for variant in blob.variants.values()):
+        return None
+    return blob.variants
+
+
+def miscounted_references(updated_before) -> list:
+    """Returns (id, blob id, use count) of the references whose 'ref_count' isn't their use count
+
+    Uses are counted by db in one pass over the messages joined against the references, so
+    only the references which need a change are loaded.
+
+    Parameters:
+        updated_before (datetime): references changed after it are skipped
+    """
+    models = [ChatMessage, ArchivedChatMessage] if archive_exists() else [ChatMessage]  # archived messages keep their files
+    uses = " UNION ALL ".join(
+        f"SELECT unnest(attachment_links) AS url FROM {model._meta.db_table} WHERE NOT is_deleted "
+        f"UNION ALL SELECT voice FROM {model._meta.db_table} WHERE NOT is_deleted AND voice IS NOT NULL"
+        for model in models
+    )
+    reference_table = ChatAttachmentReference._meta.db_table
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT reference.id, reference.blob_id, count(used.url) FROM {reference_table} reference "
+            f"LEFT JOIN ({uses}) used ON used.url = %s || reference.path "
+            f"WHERE reference.modified < %s "
+            f"GROUP BY reference.id HAVING count(used.url) <> reference.ref_count",
+            [settings.MEDIA_URL, updated_before],
+        )
+        return cursor.fetchall()
+
+
+def collect_garbage() -> int:
+    """Recounts references from the messages and removes unused files
+
+    References changed in the last 'CHAT_BLOB_GC_GRACE' seconds are skipped, their message may
+    still be on it's way to the db.
+
+    Returns:
+        Number of removed references
+    """
+    removed = 0
+    updated_before = timezone.now() - timedelta(seconds=CHAT_BLOB_GC_GRACE)
+
+    for reference_id, blob_id, uses in miscounted_references(updated_before):
+        with transaction.atomic():
+            blob = ChatAttachmentBlob.objects.select_for_update().get(id=blob_id)
+            reference = ChatAttachmentReference.objects.filter(id=reference_id, modified__lt=updated_before).first()
+            if not reference:
+                continue
+
+            if uses:
+                ChatAttachmentReference.objects.filter(id=reference_id).update(ref_count=uses)
+            else:
+                remove_reference(blob, reference)
+                removed += 1
+
+    logger.info(f"{removed} unused chat attachment files removed")
+    return removed
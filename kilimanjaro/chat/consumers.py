@@ -1,29 +1,72 @@
 import asyncio
-import copy
-from typing import Type
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from typing import Type, Union
 
+import orjson
 from asgiref.sync import sync_to_async
-import mutagen
-from channels.generic.websocket import AsyncJsonWebsocketConsumer
-from channels.db import database_sync_to_async
 from chat.models import ChatRoom, ChatMessage, ChatMessageEditLog
 from django.contrib.auth import get_user_model
+from django.db import transaction
 from django.db.models import Q
 from django.conf import settings
-
-from core.utils.general_func import base64_to_file, upload_file, resize_image
-from core.utils.general_data import MAX_FILE_SIZE_FOR_CHATTING, MAX_VOICE_DURATION_FOR_CHATTING, MAX_VOICE_MESSAGE_FOR_PER_CHATTING_ROOM, MAX_VOICE_DURATION_MIN
+from django.core.files import File
+from redis.exceptions import RedisError
+
+from chat import presence
+from chat.attachment_store import release_files
+from chat.event_log import log_room_event, read_room_events
+from chat.media import read_voice_file, save_attachment_file, save_voice_file
+from chat.write_behind import message_buffer
+from chat.uploads import ChunkedUpload, ChunkedUploadError, parse_upload_frame, UPLOAD_TYPES
+from chat.utils import add_send_by, claim_typing_relay, room_event, schedule_media_tasks, schedule_read_receipt
+from chat.voice_quota import release_voice_message, reserve_voice_message
+from core.utils.custom_modules import OrjsonWebsocketConsumer
+from core.utils.executors import ExecutorBusy, database_pool_to_async, media_executor
+from core.utils.general_data import (MAX_VOICE_DURATION_FOR_CHATTING, MAX_VOICE_DURATION_MIN,
+    MAX_CHUNKED_UPLOAD_SIZE, CHUNKED_UPLOAD_CHUNK_SIZE, MAX_PENDING_UPLOADS_PER_CONNECTION, MAX_JOINED_ROOMS_PER_CONNECTION,
+    SERVER_BUSY_CLOSE_CODE,
+    TYPING_THROTTLE_INTERVAL, TYPING_EXPIRES_IN, RESUME_MAX_EVENTS)
 
 User = get_user_model()
+logger = logging.getLogger(__name__)
 
 
-class ChatConsumer(AsyncJsonWebsocketConsumer):
+class ChatConsumer(OrjsonWebsocketConsumer):
     """Realtime chatting consumer"""
 
     async def connect(self):
         """Accepts the socket connection"""
         await self.accept()
-        self.room_id = None
+        self.rooms = OrderedDict()  # authorized and joined rooms of this connection by room id, least recently used first
+        self.uploads = {}  # chunked uploads of this connection by upload id
+        self.typing_sent_at = {}  # last relayed typing event time by room id
+
+        if self.scope.get("is_server_busy"):  # user couldn't be authenticated
+            await self.close(code=SERVER_BUSY_CLOSE_CODE)
+            return
+
+        user = self.scope["user"]
+        if user.is_authenticated:
+            # presence changes of chat partners are sent to all sockets of the user
+            await self.channel_layer.group_add(presence.user_group_name(user.id), self.channel_name)
+            await presence.tracker.connect(user.id, self.channel_name)
+
+    async def receive(self, text_data: str = None, bytes_data: bytes = None, **kwargs):
+        """Binary frames carry chunked upload data, text frames carry json commands"""
+
+        try:
+            if bytes_data is not None:
+                await self.receive_upload_chunk(bytes_data)
+            else:
+                await super().receive(text_data=text_data, bytes_data=bytes_data, **kwargs)
+        except ExecutorBusy:
+            await self.send_json({
+                "response_type": "Error",
+                "message": "Server is busy, try again later",
+            })
 
     async def receive_json(self, content: dict[str, str]):
         """Receive json data from frontend and do some work
@@ -52,13 +95,34 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         attachment_links = content.get('attachment_links')
         voice_file = content.get('voice_file')
 
+        # Chunked upload handshake, doesn't belong to any room
+        if command == 'upload_begin':
+            await self.begin_upload(content.get('upload_type'), content.get('file_name'), content.get('file_size'))
+            return
+        elif command == 'upload_commit':
+            await self.commit_upload(content.get('upload_id'))
+            return
+        elif command == 'upload_abort':
+            await self.abort_upload(content.get('upload_id'))
+            return
+
+        # Typing indicator is authorized by joined rooms only, it never touches the db
+        if command == 'typing':
+            await self.send_typing(room_id)
+            return
+
+        # Leaving needs no db access, a room which isn't joined is ignored
+        if command == 'leave':
+            await self.leave_room_by_id(room_id)
+            return
+
         # Get's room from room partner id
         if command == 'send_first_message':
             partner_id = content.get('partner_id')
 
             # Gets room partner object 
             try:
-                room_partner = await sync_to_async(User.objects.get)(id=partner_id)
+                room_partner = await database_pool_to_async(User.objects.get)(id=partner_id)
             except User.DoesNotExist:
                 await self.send_json({
                     "response_type": "Error",
@@ -68,18 +132,11 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
 
             room_id = await self.get_room_id_or_none(room_partner)
         
-        # Gets room or return null
+        # Gets room or return null, room is joined at first access ('join' command needs nothing else)
         room = await self.get_room_or_none(room_id)
         if not room: return
-        
-        # join to the room
-        if command == 'join':
-            await self.join_room(room)
-
-        elif command == 'send_first_message':
 
-            if str(self.room_id) != room_id:
-                await self.join_room(room)
+        if command == 'send_first_message':
 
             # validates user can chat to another user or not
             if room_partner and not await can_chat_together(self.user, room_partner):
@@ -89,44 +146,57 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
                 })
                 return
 
-            await self.send_chat_message(room, text_message, attachment_links, voice_file)
+            await self.send_chat_message(room, text_message, attachment_links, voice_file,
+                content.get('attachment_upload_ids'), content.get('voice_upload_id'))
 
         elif command == 'send_message':
 
-            # Joined room when not joined already
-            if str(self.room_id) != room_id:
-                await self.join_room(room)
-
-            await self.send_chat_message(room, text_message, attachment_links, voice_file)
+            await self.send_chat_message(room, text_message, attachment_links, voice_file,
+                content.get('attachment_upload_ids'), content.get('voice_upload_id'))
 
         elif command == 'edit_message':
 
             message_id = content.get('message_id') 
-            # Joined room when not joined already
-            if str(self.room_id) != room_id:
-                await self.join_room(room)
 
             await self.edit_chat_message(room, text_message, message_id)
 
         elif command == 'delete_message':
 
             message_id = content.get('message_id') 
-            # Joined room when not joined already
-            if str(self.room_id) != room_id:
-                await self.join_room(room)
 
             await self.delete_chat_message(room, message_id)
+
+        elif command == 'mark_read':
+
+            await self.mark_read(room, content.get('message_id'))
+
+        elif command == 'resume':
+
+            await self.resume_room(room, content.get('last_seq'))
             
 
     async def disconnect(self, close_code: int) -> None:
         """Disconnect from room"""
 
-        # leave the room
-        if self.room_id != None:
-            await self.leave_room(self.room_id)
+        # removes unfinished uploads
+        self.discard_uploads(self.uploads.values())
+        self.uploads = {}
+
+        # leave the rooms
+        for room in list(self.rooms.values()):
+            await self.leave_room(room)
+
+        user = self.scope["user"]
+        if user.is_authenticated:
+            await self.channel_layer.group_discard(presence.user_group_name(user.id), self.channel_name)
+            await presence.tracker.disconnect(user.id, self.channel_name)
+
+        # write-behind messages of the connection are saved before it's gone
+        await message_buffer.flush()
 
     async def join_room(self, room: Type[ChatRoom]):
-        """Takes room id and adds to group"""
+        """Adds room to group and to the connection's room cache, least recently used room is left
+        when more than 'MAX_JOINED_ROOMS_PER_CONNECTION' rooms are joined"""
 
         # adds room to the channel layer group
         await self.channel_layer.group_add(
@@ -134,43 +204,172 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
             self.channel_name,
         )
 
-        self.room_id = room.id
+        self.rooms[room.id] = room
+
+        while len(self.rooms) > MAX_JOINED_ROOMS_PER_CONNECTION:
+            await self.leave_room(next(iter(self.rooms.values())))
 
-    async def leave_room(self, room_id: int):
+    async def leave_room(self, room: Type[ChatRoom]):
         """Discard from room"""
 
-        room_obj = await get_room_or_error(room_id, self.scope['user'])
+        self.rooms.pop(room.id, None)
 
-        self.room_id = None
+        # Remove room from channel layer group
+        await self.channel_layer.group_discard(
+            room.group_name,
+            self.channel_name
+        )
 
-        if room_obj:
-            # Remove room from channel layer group
-            await self.channel_layer.group_discard(
-                room_obj.group_name,
-                self.channel_name
-            )
+    async def leave_room_by_id(self, room_id: int):
+        """Leaves a joined room, sent by 'leave' command when user navigates away from the room"""
+
+        try:
+            room = self.rooms.get(int(room_id))
+        except (TypeError, ValueError):
+            room = None
+
+        if room:
+            await self.leave_room(room)
 
-    async def forward_message(self, event: dict[str, str]):
-        """Formates sends message
+    async def room_state_changed(self, event: dict):
+        """Updates block state of the cached room, sent by 'chat.utils.send_room_state'"""
+
+        room = self.rooms.get(event['room_id'])
+        if room:
+            room.is_blocked_by_member_1 = event['is_blocked_by_member_1']
+            room.is_blocked_by_member_2 = event['is_blocked_by_member_2']
+
+    async def presence_changed(self, event: dict):
+        """Sends online state of a chat partner, sent by 'chat.presence.publish_presence'"""
+
+        await self.send_json({
+            "response_type": "presence",
+            "user_id": event['user_id'],
+            "is_online": event['is_online'],
+        })
+
+    async def send_room_event(self, room: Type[ChatRoom], event: dict) -> None:
+        """Adds event to the room's event log, then sends it to the room
+
+        An event which can't be logged is sent without 'seq', 'resume' of the room reports a gap then.
+        """
+        try:
+            event = await sync_to_async(log_room_event, thread_sensitive=False)(room.id, event)
+        except (RedisError, OSError) as e:
+            logger.error(f"Can't log event of room {room.id}: {e!r}")
+        await self.channel_layer.group_send(room.group_name, event)
+
+    async def resume_room(self, room: Type[ChatRoom], last_seq: int) -> None:
+        """Replays room events after 'last_seq', when some of them aren't logged anymore
+        client gets 'resume_gap' and has to fetch history pages instead"""
+
+        if not str(last_seq).isdigit():
+            await self.send_json({
+                "response_type": "Error",
+                "message": "Invalid sequence number!",
+            })
+            return
+
+        events, current_seq, is_gap = await sync_to_async(read_room_events, thread_sensitive=False)(
+            room.id, int(last_seq), RESUME_MAX_EVENTS
+        )
+
+        if is_gap:
+            await self.send_json({
+                "response_type": "resume_gap",
+                "room_id": room.id,
+                "seq": current_seq,
+            })
+            return
+
+        for event in events:
+            await self.send(text_data=add_send_by(event, self.user.id).decode())
+
+        await self.send_json({
+            "response_type": "resumed",
+            "room_id": room.id,
+            "seq": events[-1]["seq"] if events else current_seq,
+            "has_more": bool(events) and events[-1]["seq"] < current_seq,  # resume again from 'seq'
+        })
+
+    async def send_typing(self, room_id: int) -> None:
+        """Relays typing indicator of the user to the room, throttled per user per room"""
+
+        try:
+            room = self.rooms.get(int(room_id))
+        except (TypeError, ValueError):
+            room = None
+
+        if not room:
+            await self.send_json({
+                "response_type": "Error",
+                "message": "Invalid Room ID!",
+            })
+            return
+        self.rooms.move_to_end(room.id)  # recently used
+
+        if room.is_blocked_by_member_1 or room.is_blocked_by_member_2:
+            return
+
+        if TYPING_THROTTLE_INTERVAL:
+            # this socket's throttle saves a cache round trip, the cache one covers other sockets of the user
+            now = time.monotonic()
+            if now - self.typing_sent_at.get(room.id, -TYPING_THROTTLE_INTERVAL) < TYPING_THROTTLE_INTERVAL:
+                return
+            self.typing_sent_at[room.id] = now
+
+            if not await sync_to_async(claim_typing_relay, thread_sensitive=False)(room.id, self.user.id):
+                return
+
+        await self.channel_layer.group_send(room.group_name, {
+            "type": "typing_indicator",
+            "user_id": self.user.id,
+            "payload": orjson.dumps({
+                "response_type": "typing",
+                "room_id": room.id,
+                "user_id": self.user.id,
+                "expires_in": TYPING_EXPIRES_IN,
+            }),
+        })
+
+    async def typing_indicator(self, event: dict):
+        """Sends typing indicator of the room partner, sent by 'send_typing'"""
+
+        if event['user_id'] != self.scope['user'].id:
+            await self.send(text_data=event['payload'].decode())
+
+    async def forward_message(self, event: dict):
+        """Sends message payload of a room event, made by 'chat.utils.room_event'
 
         Parameters:
-            event(dict): dict message data
+            event(dict): event with json encoded message payload
 
         Returns:
             None
         """
 
-        # couldn't remove unnecessary key from 'event' that's why copies from 'event' and remove unnecessary key
-        newEvent = copy.deepcopy(event)
-        newEvent.pop('type', None)
+        # payload is encoded once by the sender, only recipient related keys are added here
+        await self.send(text_data=add_send_by(event, self.scope['user'].id).decode())
+
+    async def mark_read(self, room: Type[ChatRoom], message_id: int = None) -> None:
+        """Moves read watermark of the user to the message, partner gets a coalesced 'read_receipt'"""
+
+        if message_id is not None and not str(message_id).isdigit():
+            await self.send_json({
+                "response_type": "Error",
+                "message": "Invalid message ID!",
+            })
+            return
 
-        # add send_by to message 
-        if newEvent.get('response_type') == 'new_message':
-            newEvent['send_by'] = "me" if self.user.id == newEvent['sender']['id'] else "other"
+        if message_id is None:
+            await message_buffer.ensure_room_persisted(room.id)
+        else:
+            await message_buffer.ensure_persisted(message_id)
 
-        await self.send_json(newEvent)
+        await mark_room_read(room, self.user, int(message_id) if message_id is not None else None)
 
-    async def send_chat_message(self, room: Type[ChatRoom], text_message: str, attachment_links: list, voice_file: str) -> None:
+    async def send_chat_message(self, room: Type[ChatRoom], text_message: str, attachment_links: list, voice_file: str,
+            attachment_upload_ids: list = None, voice_upload_id: str = None) -> None:
         """Takes some parameters and sends message payload"""
 
         if room and (room.is_blocked_by_member_1 or room.is_blocked_by_member_2):  # Checks room already block or not
@@ -180,20 +379,72 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
             })
             return False
 
-        # Process attachment files
-        attachment_link_list = []
-        if attachment_links:
-            attachment_link_list = await self.process_attachment_file(room, attachment_links)
+        # Committed chunked uploads are sent along with base64 files
+        uploads = self.pop_committed_uploads(attachment_upload_ids or [], voice_upload_id)
+        if uploads is None:
+            await self.send_json({
+                "response_type": "Error",
+                "message": "Invalid upload ID!",
+            })
+            return False
+
+        attachment_uploads, voice_upload = uploads
+        if attachment_uploads:
+            attachment_links = (attachment_links or []) + [upload.file for upload in attachment_uploads]
+        if voice_upload:
+            voice_file = voice_upload.file
 
-        # process voice file
-        if voice_file:
-            voice_file = await self.process_voice_file(room, voice_file)
+        try:
+            await self.create_and_send_chat_message(room, text_message, attachment_links, voice_file)
+        finally:
+            self.discard_uploads([upload for upload in attachment_uploads + [voice_upload] if upload])
+
+    async def create_and_send_chat_message(self, room: Type[ChatRoom], text_message: str, attachment_links: list, voice_file: str) -> None:
+        """Processes files, creates the message and sends it to the room"""
+
+        # Check's total voice message limit for per room before the voice file is read
+        if voice_file and not await reserve_voice_message(room.id, self.user.id):
+            await self.send_json({
+                "response_type": "Error",
+                "message": "You already cross your voice send limit",
+            })
+            return
+
+        is_voice_reserved, is_voice_sent = bool(voice_file), False
+        try:
+            # Process attachment files
+            attachment_link_list = []
+            if attachment_links:
+                attachment_link_list = await self.process_attachment_file(room, attachment_links)
+
+            # process voice file
+            if voice_file:
+                voice_file = await self.process_voice_file(room, voice_file)
+
+            await self.send_new_message(room, text_message, attachment_link_list, voice_file)
+            is_voice_sent = bool(voice_file)
+        except ExecutorBusy:
+            await self.send_json({
+                "response_type": "Error",
+                "message": "Server is busy, try again later",
+            })
+        finally:
+            if is_voice_reserved and not is_voice_sent:
+                await release_voice_message(room.id, self.user.id)
+
+    async def send_new_message(self, room: Type[ChatRoom], text_message: str, attachment_link_list: list, voice_file: str) -> None:
+        """Creates the message and sends it to the room"""
 
         # Sends message process
         if text_message and text_message.lstrip() or attachment_link_list or voice_file:
 
             # asyncio.gather for waitting on a bunch of futures and returns their results in a given order
-            message = await asyncio.gather(create_chat_message(room, self.user, text_message, attachment_link_list, voice_file))
+            if settings.CHAT_WRITE_BEHIND:
+                # message is sent right away and saved by the next buffer flush
+                message = [await message_buffer.add(
+                    build_chat_message(room, self.user, text_message, attachment_link_list, voice_file))]
+            else:
+                message = await asyncio.gather(create_chat_message(room, self.user, text_message, attachment_link_list, voice_file))
 
             # Adds site host to all attachment link
             attachment_links = []
@@ -201,10 +452,9 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
                 attachment_links = [f"{settings.SITE_HOST}{link}" for link in message[0].attachment_links]
             
             # sends message to group
-            await self.channel_layer.group_send(
-                room.group_name,
-                {
-                    'type': 'forward_message',
+            await self.send_room_event(
+                room,
+                room_event({
                     'response_type': 'new_message',
                     'id': message[0].id,
                     'sender': {
@@ -212,16 +462,16 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
                         'username': self.user.__str__(),
                         'profile_pic': self.user.profile_image
                     },
-                    'send_by': "me" if self.user == message[0].sender else "other",
                     'text_message': message[0].message_text,
                     'message_type': message[0].message_type,
                     'attachment_links': attachment_links,
                     'voice': message[0].voice,
+                    'voice_waveform': message[0].voice_waveform,
                     'created_at': {
                         "date": message[0].created.strftime("%d %b, %Y"),
                         "time": message[0].created.strftime("%I:%M %p")
                     }
-                }
+                }, sender_id=self.user.id)
             )
 
     async def edit_chat_message(self, room: Type[ChatRoom], text_message: str, message_id: int) -> None:
@@ -238,6 +488,7 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         if text_message and text_message.lstrip():
 
             # asyncio.gather for waitting on a bunch of futures and returns their results in a given order
+            await message_buffer.ensure_persisted(message_id)
             message = await asyncio.gather(update_chat_message(self.scope['user'], text_message, message_id))
             if not message[0]:
                 await self.send_json({
@@ -252,22 +503,23 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
                 attachment_links = [f"{settings.SITE_HOST}{link}" for link in message[0].attachment_links]
 
             # Notifies chat room that message is edited
-            await self.channel_layer.group_send(
-                room.group_name,
-                {
-                    'type': 'forward_message',
+            await self.send_room_event(
+                room,
+                room_event({
                     'response_type': 'edited_message',
                     'id': message[0].id,
                     'text_message': message[0].message_text,
                     'message_type': message[0].message_type,
                     'attachment_links': attachment_links,
                     'voice': message[0].voice,
-                }
+                    'voice_waveform': message[0].voice_waveform,
+                })
             )
 
     async def delete_chat_message(self, room: Type[ChatRoom], message_id: int):
         """Deletes chat message and notify to the room"""
 
+        await message_buffer.ensure_persisted(message_id)
         message = await asyncio.gather(delete_chat_message(self.scope['user'], room, message_id))
 
         if not message[0]:
@@ -278,14 +530,13 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
             return
 
         # Notifies room that message is deleted
-        await self.channel_layer.group_send(
-            room.group_name,
-            {
-                'type': 'forward_message',
+        await self.send_room_event(
+            room,
+            room_event({
                 'response_type': 'deleted_message',
                 'id': message_id,
                 'is_deleted': True
-            }
+            })
         )
 
     async def process_attachment_file(self, room: Type[ChatRoom], attachment_links: list) -> list:
@@ -293,57 +544,189 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
 
         attachment_link_list = []
         for attachment_link in attachment_links:  # loop through all attachment files blob
-            file = base64_to_file(attachment_link)  # convert blob to file
-
-            if file.size > MAX_FILE_SIZE_FOR_CHATTING:
-                file = resize_image(file)  # resize file
+            # decoding, resizing and saving runs outside of the event loop
+            link = await media_executor.run(save_attachment_file, attachment_link, f"{room.uuid}/")
 
             # after resizing still file is more than MAX_FILE_SIZE_FOR_CHATTING through an error
-            if file.size > MAX_FILE_SIZE_FOR_CHATTING:
+            if not link:
                 await self.send_json({
                     "response_type": "Error",
                     'message': "File is too large",
                 })
             else:
-                # upload file using filesystemstorage
-                attachment_link_list.append(upload_file(file, f"{room.uuid}/"))
+                attachment_link_list.append(link)
 
         return attachment_link_list
 
-    async def process_voice_file(self, room: Type[ChatRoom], voice_file: list) -> list:
-        """Takes voice file as blob and returns as file"""
+    async def process_voice_file(self, room: Type[ChatRoom], voice_file: Union[str, File]) -> str:
+        """Takes voice file as blob or uploaded file and returns as file"""
 
-        file = base64_to_file(voice_file)  # convert blob to file
-        audio_info = mutagen.File(file).info  # reads audio file metadata
+        file, duration = await media_executor.run(read_voice_file, voice_file)  # reads audio file metadata
 
         # Verifies duration limit is cross or not
-        if audio_info.length > MAX_VOICE_DURATION_FOR_CHATTING:
+        if duration > MAX_VOICE_DURATION_FOR_CHATTING:
             await self.send_json({
                 "response_type": "Error",
                 "message": f"You can send only {MAX_VOICE_DURATION_MIN} minutes duration's voice",
             })
             return
 
-        # Check's total voice message limit for per room
-        total_voice_msg = await asyncio.gather(count_user_voice_chat(self.user, room))
-        if  total_voice_msg[0] > MAX_VOICE_MESSAGE_FOR_PER_CHATTING_ROOM:
+        return await media_executor.run(save_voice_file, file, f"{room.uuid}/") # saves the file once per content
+
+    async def begin_upload(self, upload_type: str, file_name: str, file_size: int) -> None:
+        """Starts a chunked upload and tells client the upload id"""
+
+        error_message = None
+        if upload_type not in UPLOAD_TYPES:
+            error_message = "Invalid upload type!"
+        elif not isinstance(file_size, int) or file_size <= 0:
+            error_message = "Invalid file size!"
+        elif file_size > MAX_CHUNKED_UPLOAD_SIZE:
+            error_message = "File is too large"
+        elif len(self.uploads) >= MAX_PENDING_UPLOADS_PER_CONNECTION:
+            error_message = "Too many unfinished uploads"
+
+        if error_message:
             await self.send_json({
                 "response_type": "Error",
-                "message": "You already cross your voice send limit",
+                "message": error_message,
+            })
+            return
+
+        upload = ChunkedUpload(upload_type, file_name, file_size)
+        self.uploads[upload.id] = upload
+
+        await self.send_json({
+            "response_type": "upload_ready",
+            "upload_id": upload.id.hex,
+            "chunk_size": CHUNKED_UPLOAD_CHUNK_SIZE,
+        })
+
+    async def receive_upload_chunk(self, bytes_data: bytes) -> None:
+        """Writes a binary frame to it's upload file"""
+
+        # Authentication is required
+        if not self.scope["user"].is_authenticated:
+            await self.send_json({
+                "response_type": "Error",
+                "message": "Authentication is required.",
+            })
+            return
+
+        upload = None
+        try:
+            upload_id, chunk = parse_upload_frame(bytes_data)
+            upload = self.uploads.get(upload_id)
+            if not upload:
+                raise ChunkedUploadError("Invalid upload ID!")
+            if len(chunk) > CHUNKED_UPLOAD_CHUNK_SIZE:
+                raise ChunkedUploadError("Chunk is too large")
+
+            upload.write(chunk)
+        except ChunkedUploadError as e:
+            # broken upload can't be continued
+            if upload:
+                self.uploads.pop(upload.id, None)
+                upload.discard()
+
+            await self.send_json({
+                "response_type": "Error",
+                "message": str(e),
+            })
+
+    async def commit_upload(self, upload_id: str) -> None:
+        """Finishes a chunked upload, after that it can be sent with a message"""
+
+        upload = self.get_upload_or_none(upload_id)
+        if not upload:
+            await self.send_json({
+                "response_type": "Error",
+                "message": "Invalid upload ID!",
+            })
+            return
+
+        try:
+            upload.commit()
+        except ChunkedUploadError as e:
+            await self.send_json({
+                "response_type": "Error",
+                "message": str(e),
             })
             return
-            
 
-        return upload_file(file, f"{room.uuid}/") # upload file to file system by filestystem storage
+        await self.send_json({
+            "response_type": "upload_complete",
+            "upload_id": upload.id.hex,
+        })
+
+    async def abort_upload(self, upload_id: str) -> None:
+        """Cancels a chunked upload and removes it's file"""
+
+        upload = self.get_upload_or_none(upload_id)
+        if upload:
+            self.uploads.pop(upload.id)
+            upload.discard()
+
+    def get_upload_or_none(self, upload_id: str):
+        """Returns this connection's upload by hex upload id"""
+
+        try:
+            return self.uploads.get(uuid.UUID(hex=str(upload_id)))
+        except ValueError:
+            return None
+
+    def pop_committed_uploads(self, attachment_upload_ids: list, voice_upload_id: str):
+        """Takes committed uploads out of pending uploads
+
+        Returns:
+            (attachment uploads, voice upload) or None when any upload id is invalid
+        """
+        attachment_uploads = [self.get_upload_or_none(upload_id) for upload_id in attachment_upload_ids]
+        voice_upload = self.get_upload_or_none(voice_upload_id) if voice_upload_id else None
+
+        if any(
+            not upload or not upload.is_committed or upload.upload_type != 'attachment'
+            for upload in attachment_uploads
+        ):
+            return None
+
+        if voice_upload_id and (not voice_upload or not voice_upload.is_committed or voice_upload.upload_type != 'voice'):
+            return None
+
+        for upload in attachment_uploads + [voice_upload]:
+            if upload:
+                self.uploads.pop(upload.id, None)
+
+        return attachment_uploads, voice_upload
+
+    def discard_uploads(self, uploads) -> None:
+        """Removes temporary files of uploads"""
+
+        for upload in uploads:
+            upload.discard()
 
     async def get_room_or_none(self, room_id: int):
-        room = await get_room_or_error(room_id, self.user)
+        """Returns room from the connection's cache, otherwise from db and joins it"""
+
+        try:
+            room_id = int(room_id)
+        except (TypeError, ValueError):
+            room_id = None
+
+        room = self.rooms.get(room_id)
+        if room:
+            self.rooms.move_to_end(room_id)  # recently used
+            return room
+
+        room = await get_room_or_error(room_id, self.user) if room_id else None
         if not room:
             await self.send_json({
                 "response_type": "Error",
                 "message": "Invalid Room ID!",
             })
             return False
+
+        await self.join_room(room)
         return room
 
     async def get_room_id_or_none(self, partner: Type[User]):
@@ -354,7 +737,7 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         return room_id
 
 
-@database_sync_to_async
+@database_pool_to_async
 def get_room_or_error(room_id: int, user: Type[User]) -> Type[ChatRoom]:
     """Gets room object by room id and request user
 
@@ -370,7 +753,7 @@ def get_room_or_error(room_id: int, user: Type[User]) -> Type[ChatRoom]:
 
     return room
 
-@database_sync_to_async
+@database_pool_to_async
 def get_room_or_create(room_partner: Type[User], user: Type[User]) -> Type[ChatRoom]:
     """Gets or creates a chat room
 
@@ -382,20 +765,11 @@ def get_room_or_create(room_partner: Type[User], user: Type[User]) -> Type[ChatR
         Room object
     """
 
-    # get or create chat room 
-    room_obj = ChatRoom.objects.filter(
-        Q(room_member_1=user, room_member_2=room_partner) |
-        Q(room_member_1=room_partner, room_member_2=user)
-    ).first()
+    # get or create chat room, concurrent first messages get the same room
+    return ChatRoom.objects.get_or_create_for_members(user, room_partner)
 
-    if not room_obj:
-        room_obj = ChatRoom.objects.create(room_member_1=user, room_member_2=room_partner)
-
-    return room_obj
-
-@database_sync_to_async
-def create_chat_message(room: Type[ChatRoom], user: Type[User], message_text: str, attachment_links: list, voice_file: str) -> Type[ChatMessage]:
-    """Creates chat message object
+def build_chat_message(room: Type[ChatRoom], user: Type[User], message_text: str, attachment_links: list, voice_file: str) -> Type[ChatMessage]:
+    """Returns unsaved chat message object
 
     Parameters: 
         room (object): chat room where sends message
@@ -428,11 +802,30 @@ def create_chat_message(room: Type[ChatRoom], user: Type[User], message_text: st
         message.voice = voice_file
     if message_text:
         message.message_text = message_text
-    
-    message.save()
+
     return message
 
-@database_sync_to_async
+@database_pool_to_async
+def create_chat_message(room: Type[ChatRoom], user: Type[User], message_text: str, attachment_links: list, voice_file: str) -> Type[ChatMessage]:
+    """Creates chat message object
+
+    Parameters: 
+        room (object): chat room where sends message
+        user (object): message sender
+        message (str): text message like 'hello'
+
+    Returns:
+        Message object
+    """
+    message = build_chat_message(room, user, message_text, attachment_links, voice_file)
+
+    # message, it's room sequence number and room inbox summary are saved together
+    with transaction.atomic():
+        room.add_messages([message])
+        schedule_media_tasks([message])
+    return message
+
+@database_pool_to_async
 def update_chat_message(user: Type[User], message_text: str, message_id: int) -> Type[ChatMessage]:
     """update chat message object
 
@@ -445,7 +838,7 @@ def update_chat_message(user: Type[User], message_text: str, message_id: int) ->
         message object
     """
 
-    message = ChatMessage.objects.filter(id=message_id, sender=user).first()
+    message = ChatMessage.objects.filter(id=message_id, sender=user).select_related('room').first()
 
     # When edit message contains text message
     if message and not message.is_deleted:
@@ -454,12 +847,15 @@ def update_chat_message(user: Type[User], message_text: str, message_id: int) ->
             message=message, previous_text_message=message.message_text, message_text=message_text)
 
         message.message_text = message_text
+        message.update_search_vector()
 
-        message.save()
+        with transaction.atomic():
+            message.save()
+            message.room.message_changed(message)
 
     return message
 
-@database_sync_to_async
+@database_pool_to_async
 def delete_chat_message(user: Type[User], room: Type[ChatRoom], message_id: int) -> Type[ChatMessage]:
     """Delete chat message object
 
@@ -473,23 +869,39 @@ def delete_chat_message(user: Type[User], room: Type[ChatRoom], message_id: int)
 
     message = ChatMessage.objects.filter(
         room=room, id=message_id, sender=user).first()
-    if message:
+    if message and not message.is_deleted:
+        files = (message.attachment_links or []) + [message.voice]
         message.is_deleted = True
-        message.save()
+        message.attachment_links, message.voice = None, None  # deleted message files are removed
+        message.attachment_variants = None
+        message.update_search_vector()
+
+        with transaction.atomic():
+            message.save()
+            room.message_changed(message)
+
+        release_files(files)
 
     return message
 
-@database_sync_to_async
-def count_user_voice_chat(user: Type[User], room: Type[ChatRoom]) -> Type[ChatMessage]:
-    """Return the number of voice chat of user
+@database_pool_to_async
+def mark_room_read(room: Type[ChatRoom], user: Type[User], message_id: int = None) -> bool:
+    """Moves user's read watermark of the room and schedules read receipt
 
-    Parameters: 
-        room (object) : chat room message object's
-        user (object): message sender
+    Parameters:
+        room (object): chat room
+        user (object): room member who has read the messages
+        message_id (int): last read message id, last message of the room by default
+
+    Returns:
+        True when watermark is moved
     """
-    return ChatMessage.objects.filter(room=room, sender=user).exclude(voice__isnull=True, voice="").count()
+    is_moved = room.mark_as_read(user, message_id)
+    if is_moved:
+        schedule_read_receipt(room.id, user.id)
+    return is_moved
 
-@database_sync_to_async
+@database_pool_to_async
 def can_chat_together(user: Type[User], room_partner: Type[User]) -> Type[ChatMessage]:
     """Return the number of voice chat of user
 
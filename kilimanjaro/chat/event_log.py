@@ -0,0 +1,86 @@
+"""Bounded per-room log of chat events, so reconnected clients can replay what they missed.
+
+Redis keys:
+    chat:room:<room id>:events  stream of the room events, entry id is '<seq>-0'
+
+Events get their 'seq' key while they are logged, then they are sent to the room as usual.
+A client keeps the 'seq' of the last event it got and sends it with 'resume' after reconnect.
+
+The stream is the only state: the next 'seq' follows it's last entry, so an expired or evicted
+log starts again from 1 and clients with a newer 'seq' get a gap on 'resume'.
+"""
+
+from django_redis import get_redis_connection
+
+from core.utils.general_data import ROOM_EVENT_LOG_MAXLEN, ROOM_EVENT_LOG_TTL
+
+# KEYS: room events; ARGV: json payload, sender id, max length, ttl
+# Returns sequence number and payload with 'seq' key, trimming always keeps the last entry
+LOG_EVENT_SCRIPT = """
+local last = redis.call('XREVRANGE', KEYS[1], '+', '-', 'COUNT', 1)[1]
+local seq = 1
+if last then
+    seq = tonumber(string.match(last[1], '^(%d+)')) + 1
+end
+local payload = string.sub(ARGV[1], 1, -2) .. ',"seq":' .. seq .. '}'
+redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[3], seq .. '-0', 'payload', payload, 'sender_id', ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return {seq, payload}
+"""
+
+
+def events_key(room_id: int) -> str:
+    """Returns redis key of the room's event stream"""
+    return f"chat:room:{room_id}:events"
+
+
+def log_room_event(room_id: int, event: dict) -> dict:
+    """Adds a room event made by 'chat.utils.room_event' to the room's log
+
+    Parameters:
+        room_id (int): chat room id
+        event (dict): 'forward_message' channel layer event
+
+    Returns:
+        Same event with sequence number in it's payload
+    """
+    sender_id = event.get("sender_id")
+    seq, payload = get_redis_connection("default").eval(
+        LOG_EVENT_SCRIPT, 1, events_key(room_id),
+        event["payload"], sender_id or "", ROOM_EVENT_LOG_MAXLEN, ROOM_EVENT_LOG_TTL,
+    )
+    return {**event, "payload": payload}
+
+
+def read_room_events(room_id: int, last_seq: int, count: int):
+    """Returns room events after 'last_seq'
+
+    Parameters:
+        room_id (int): chat room id
+        last_seq (int): sequence number of the last event that client has
+        count (int): maximum number of returned events
+
+    Returns:
+        (events, current sequence number of the room, is_gap), 'is_gap' is True when some events
+        after 'last_seq' aren't in the log anymore
+    """
+    pipeline = get_redis_connection("default").pipeline(transaction=False)
+    pipeline.xrevrange(events_key(room_id), max="+", min="-", count=1)
+    pipeline.xrange(events_key(room_id), min=f"{last_seq + 1}-0", max="+", count=count)
+    last_entries, entries = pipeline.execute()
+    current_seq = int(last_entries[0][0].split(b"-")[0]) if last_entries else 0
+
+    events = []
+    for entry_id, fields in entries:
+        sender_id = fields.get(b"sender_id")
+        events.append({
+            "seq": int(entry_id.split(b"-")[0]),
+            "payload": fields[b"payload"],
+            "sender_id": int(sender_id) if sender_id else None,
+        })
+
+    # log was trimmed/expired after 'last_seq' or client has sequence of an older log
+    is_gap = last_seq > current_seq or (
+        current_seq > last_seq and (not events or events[0]["seq"] != last_seq + 1)
+    )
+    return events, current_seq, is_gap
@@ -0,0 +1,26 @@
+"""
+    Chat messages of old months are moved from the partitioned chat message table to the
+    read only archive table, see 'chat/partitions.py'. Room history pages still return them.
+    Set 'CHAT_ARCHIVE_TABLESPACE' to keep the archive on compressed storage.
+"""
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat.partitions import archive_partitions
+
+
+class Command(BaseCommand):
+    """
+    To running this command start env and type
+            ```python manage.py archive_chat_messages```
+    """
+
+    help = "Move chat message partitions of old months to the archive"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--older-than-months", type=int, default=settings.CHAT_ARCHIVE_AFTER_MONTHS)
+
+    def handle(self, *args, **kwargs):
+        archived = archive_partitions(kwargs["older_than_months"])
+        self.stdout.write(f"{len(archived)} chat message partitions archived")  # for terminal log
@@ -0,0 +1,22 @@
+"""
+    Chat attachment files are removed when their messages are deleted.
+    This command recounts the file references from the messages and removes the files which
+    aren't used by any message, like files of unsent messages and deleted rooms.
+"""
+
+from django.core.management.base import BaseCommand
+
+from chat.attachment_store import collect_garbage
+
+
+class Command(BaseCommand):
+    """
+    To running this command start env and type
+            ```python manage.py gc_chat_attachments```
+    """
+
+    help = "Remove chat attachment files which aren't used by any message"
+
+    def handle(self, *args, **kwargs):
+        removed = collect_garbage()
+        self.stdout.write(f"{removed} unused chat attachment files removed")  # for terminal log
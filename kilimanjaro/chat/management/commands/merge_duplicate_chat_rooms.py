@@ -0,0 +1,116 @@
+"""
+    Chat rooms have a unique (low user id, high user id) member pair. Rooms created before
+    that may have no pair yet and two users may have more than one room.
+    This command merges the rooms of the same two users into their oldest room and sets the
+    member pair of every room, run it once after adding the member pair fields.
+    Rooms with archived messages aren't merged, archived messages keep their room and numbers.
+"""
+
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from chat.models import ArchivedChatMessage, ChatMessage, ChatRoom
+from chat.partitions import archive_exists
+
+
+class Command(BaseCommand):
+    """
+    To running this command start env and type
+            ```python manage.py merge_duplicate_chat_rooms```
+    """
+
+    help = "Merge chat rooms of the same two users and set member pair of the rooms"
+
+    def handle(self, *args, **kwargs):
+
+        # room ids by member pair, oldest first
+        rooms_by_pair = defaultdict(list)
+        rooms = ChatRoom.objects.filter(
+            room_member_1__isnull=False, room_member_2__isnull=False
+        ).order_by('id').values_list('id', 'room_member_1_id', 'room_member_2_id', 'low_user_id')
+
+        for room_id, member_1, member_2, low_user_id in rooms:
+            rooms_by_pair[tuple(sorted((member_1, member_2)))].append((room_id, low_user_id))
+
+        merged = 0
+        for pair, pair_rooms in rooms_by_pair.items():
+            if len(pair_rooms) == 1 and pair_rooms[0][1] is not None:
+                continue  # single room which already has it's pair
+
+            room_ids = [room_id for room_id, _ in pair_rooms]
+            if len(room_ids) > 1 and archive_exists() and ArchivedChatMessage.objects.filter(room_id__in=room_ids).exists():
+                self.stdout.write(f"Chat rooms {room_ids} have archived messages, they aren't merged")  # for terminal log
+                continue
+
+            merged += self.merge_rooms(pair, room_ids)
+
+        self.stdout.write(f"{merged} duplicate chat rooms merged")  # for terminal log
+
+    @transaction.atomic
+    def merge_rooms(self, pair: tuple, room_ids: list) -> int:
+        """Moves messages and block state of the rooms to the first room, returns number of merged rooms"""
+
+        rooms = list(ChatRoom.objects.select_for_update().filter(id__in=room_ids).order_by('id'))
+        room, duplicates = rooms[0], rooms[1:]
+
+        last_read_message_ids = self.merged_read_watermarks(rooms)
+
+        for duplicate in duplicates:
+            ChatMessage.objects.filter(room=duplicate).update(room=room)
+
+            # block state is kept per user, members may be in the other order in the duplicate
+            for member_number in (1, 2):
+                user_id = getattr(duplicate, f"room_member_{member_number}_id")
+                if getattr(duplicate, f"is_blocked_by_member_{member_number}"):
+                    setattr(room, f"is_blocked_by_member_{1 if user_id == room.room_member_1_id else 2}", True)
+
+        ChatRoom.objects.filter(id__in=[duplicate.id for duplicate in duplicates]).delete()
+
+        room.low_user_id, room.high_user_id = pair
+        ChatRoom.objects.filter(id=room.id).update(
+            low_user_id=room.low_user_id, high_user_id=room.high_user_id,
+            is_blocked_by_member_1=room.is_blocked_by_member_1,
+            is_blocked_by_member_2=room.is_blocked_by_member_2,
+            last_read_message_id_member_1=last_read_message_ids.get(room.room_member_1_id),
+            last_read_message_id_member_2=last_read_message_ids.get(room.room_member_2_id),
+        )
+
+        if duplicates:
+            # messages are renumbered in creation order, read watermarks follow the last read messages
+            room.rebuild_inbox_summary(renumber=True)
+
+        return len(duplicates)
+
+    def merged_read_watermarks(self, rooms: list) -> dict:
+        """Returns {user id: last read message id} of the members in the merged room
+
+        Merged messages are in creation order and a watermark reads every message before it, so
+        it's the last message before the first one which the member hasn't read in it's own room.
+        A message which wasn't read stays unread, messages after it too.
+        """
+        # members' last read message id of each room, by user id
+        room_watermarks = {}
+        for merged_room in rooms:
+            for member_number in (1, 2):
+                user_id = getattr(merged_room, f"room_member_{member_number}_id")
+                message_id = getattr(merged_room, f"last_read_message_id_member_{member_number}")
+                room_watermarks.setdefault(user_id, {})[merged_room.id] = message_id
+
+        last_read_message_ids = {}
+        unread_found = set()
+        messages = ChatMessage.objects.filter(room__in=rooms).order_by('created', 'id').values_list('id', 'room_id')
+        for message_id, room_id in messages.iterator(chunk_size=2000):
+            for user_id, watermarks in room_watermarks.items():
+                if user_id in unread_found:
+                    continue
+                watermark = watermarks.get(room_id)
+                if watermark is not None and message_id <= watermark:
+                    last_read_message_ids[user_id] = message_id
+                else:
+                    unread_found.add(user_id)
+            if len(unread_found) == len(room_watermarks):
+                break
+
+        return last_read_message_ids
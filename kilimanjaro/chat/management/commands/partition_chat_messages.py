@@ -0,0 +1,34 @@
+"""
+    Chat messages are partitioned by month of their creation, see 'chat/partitions.py'.
+    This command creates the partitions of the next months, with --convert it first moves
+    the messages of an unpartitioned table into a partitioned one (run it once, the table
+    is locked while the messages are copied).
+"""
+
+from django.core.management.base import BaseCommand
+
+from chat.partitions import convert_to_partitioned, create_future_partitions
+from core.utils.general_data import CHAT_PARTITION_MONTHS_AHEAD
+
+
+class Command(BaseCommand):
+    """
+    To running this command start env and type
+            ```python manage.py partition_chat_messages --convert```
+    """
+
+    help = "Partition chat messages by month and create partitions of the next months"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--convert", action="store_true", help="Convert the unpartitioned table")
+        parser.add_argument("--months-ahead", type=int, default=CHAT_PARTITION_MONTHS_AHEAD)
+
+    def handle(self, *args, **kwargs):
+        months_ahead = kwargs["months_ahead"]
+
+        if kwargs["convert"]:
+            created = convert_to_partitioned(months_ahead)
+            self.stdout.write(f"Chat messages are moved into {created} partitions")  # for terminal log
+
+        created = create_future_partitions(months_ahead)
+        self.stdout.write(f"{len(created)} chat message partitions created")  # for terminal log
@@ -0,0 +1,26 @@
+"""
+    Chat rooms keep a summary of their last message for the inbox list.
+    This command fills the summary of the rooms from their messages, run it once
+    after adding the summary fields or whenever the summary needs to be recomputed.
+"""
+
+from django.core.management.base import BaseCommand
+
+from chat.models import ChatRoom
+
+
+class Command(BaseCommand):
+    """
+    To running this command start env and type
+            ```python manage.py rebuild_chat_inbox```
+    """
+
+    help = "Recompute last message summary and message sequence of all chat rooms"
+
+    def handle(self, *args, **kwargs):
+
+        rooms = ChatRoom.objects.only('id').iterator()
+        for room in rooms:
+            room.rebuild_inbox_summary()
+
+        self.stdout.write("Chat inbox rebuilt")  # for terminal log
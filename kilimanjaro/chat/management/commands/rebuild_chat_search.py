@@ -0,0 +1,41 @@
+"""
+    Chat messages keep a search vector of their text for the message search.
+    This command fills the search vector of the messages that don't have it,
+    run it once after adding the search vector field.
+"""
+
+from django.contrib.postgres.search import SearchVector
+from django.core.management.base import BaseCommand
+
+from chat.models import ChatMessage
+from core.utils.general_data import CHAT_SEARCH_CONFIG
+
+
+class Command(BaseCommand):
+    """
+    To running this command start env and type
+            ```python manage.py rebuild_chat_search```
+    """
+
+    help = "Fill search vector of chat messages"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=10000)
+
+    def handle(self, *args, **kwargs):
+        batch_size = kwargs["batch_size"]
+        messages = ChatMessage.objects.filter(
+            search_vector__isnull=True, is_deleted=False, message_text__isnull=False
+        ).exclude(message_text="")
+
+        # batches keep transactions and locks short on a large table
+        updated = 0
+        while True:
+            ids = list(messages.values_list("id", flat=True)[:batch_size])
+            if not ids:
+                break
+            updated += ChatMessage.objects.filter(id__in=ids).update(
+                search_vector=SearchVector("message_text", config=CHAT_SEARCH_CONFIG)
+            )
+
+        self.stdout.write(f"Search vector of {updated} chat messages filled")  # for terminal log
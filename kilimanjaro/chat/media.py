@@ -0,0 +1,151 @@
+"""Blocking chat media work (decoding, resizing, audio parsing, file saving).
+
+These functions are CPU/disk bound, consumers run them in 'core.utils.executors.media_executor'
+so the event loop keeps serving other sockets meanwhile. Files are saved by 'chat.attachment_store',
+which keeps one file per content.
+"""
+
+import array
+import logging
+import subprocess
+import wave
+from typing import Optional, Union
+
+import mutagen
+from django.conf import settings
+from django.core.files import File
+from mutagen.oggopus import OggOpus
+
+from chat.attachment_store import store_file
+from core.utils.executors import run_with_db_connection
+from core.utils.general_data import (MAX_FILE_SIZE_FOR_CHATTING, VOICE_OPUS_BITRATE, VOICE_WAVEFORM_POINTS,
+    VOICE_TRANSCODE_TIMEOUT)
+from core.utils.general_func import base64_to_file, resize_image
+
+logger = logging.getLogger(__name__)
+
+WAVEFORM_SAMPLE_RATE = 8000  # voice is decoded to 8 kHz mono 16 bit samples for the waveform
+
+
+def to_file(source: Union[str, File]) -> File:
+    """Returns file of a base64 blob, uploaded files are returned as it is"""
+
+    if isinstance(source, File):
+        return source
+    return base64_to_file(source)
+
+
+def save_attachment_file(source: Union[str, File], path: str) -> Optional[str]:
+    """Saves an attachment file
+
+    Parameters:
+        source (str/File): base64 blob or uploaded file
+        path (str): directory path inside media root like '<room uuid>/'
+
+    Returns:
+        Url path of the file or None when file is too large
+    """
+    file = to_file(source)  # convert blob to file
+
+    if file.size > MAX_FILE_SIZE_FOR_CHATTING:
+        file = resize_image(file)  # resize file
+
+    # after resizing still file is more than MAX_FILE_SIZE_FOR_CHATTING
+    if file.size > MAX_FILE_SIZE_FOR_CHATTING:
+        return None
+
+    # saves the file once per content
+    return run_with_db_connection(store_file, file, path)
+
+
+def save_voice_file(file: File, path: str) -> str:
+    """Saves a voice file read by 'read_voice_file', returns it's url path"""
+    return run_with_db_connection(store_file, file, path)
+
+
+def read_voice_file(source: Union[str, File]):
+    """Returns voice file and it's duration in seconds
+
+    Parameters:
+        source (str/File): base64 blob or uploaded file
+    """
+    file = to_file(source)  # convert blob to file
+    audio_info = mutagen.File(file).info  # reads audio file metadata
+    return file, audio_info.length
+
+
+def run_ffmpeg(*args: str) -> Optional[bytes]:
+    """Runs ffmpeg, returns it's output or None when ffmpeg isn't installed or fails"""
+
+    try:
+        return subprocess.run(
+            [settings.FFMPEG_BINARY, "-nostdin", "-loglevel", "error", *args],
+            check=True, capture_output=True, timeout=VOICE_TRANSCODE_TIMEOUT,
+        ).stdout
+    except FileNotFoundError:
+        logger.warning("ffmpeg isn't installed, voice messages aren't transcoded")
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+        logger.error(f"ffmpeg {args[:2]} failed: {e!r}")
+    return None
+
+
+def transcode_voice(path: str) -> Optional[bytes]:
+    """Returns voice file transcoded to mono Opus in an OGG container
+
+    Parameters:
+        path (str): absolute path of the voice file
+
+    Returns:
+        OGG file content or None when the file is already Opus or it can't be transcoded
+    """
+    try:
+        if isinstance(mutagen.File(path), OggOpus):
+            return None
+    except mutagen.MutagenError:
+        pass  # ffmpeg may still decode it
+
+    return run_ffmpeg(
+        "-i", path, "-vn", "-ac", "1", "-c:a", "libopus", "-b:a", VOICE_OPUS_BITRATE,
+        "-application", "voip", "-f", "ogg", "pipe:1",
+    )
+
+
+def waveform_from_samples(samples: array.array, points: int = VOICE_WAVEFORM_POINTS) -> list:
+    """Returns peak level (0-100) of each of 'points' equal parts of 16 bit samples"""
+
+    if not samples:
+        return []
+
+    bucket_size = max(len(samples) // points, 1)
+    peaks = [
+        max(abs(sample) for sample in samples[start:start + bucket_size])
+        for start in range(0, bucket_size * min(points, len(samples)), bucket_size)
+    ]
+    loudest = max(peaks) or 1
+    return [round(peak * 100 / loudest) for peak in peaks]
+
+
+def voice_waveform(path: str) -> Optional[list]:
+    """Returns waveform of a voice file, decoded by ffmpeg or by 'wave' module for WAV files
+
+    Parameters:
+        path (str): absolute path of the voice file
+
+    Returns:
+        List of 'VOICE_WAVEFORM_POINTS' levels or None when the file can't be decoded
+    """
+    pcm = run_ffmpeg("-i", path, "-vn", "-ac", "1", "-ar", str(WAVEFORM_SAMPLE_RATE), "-f", "s16le", "pipe:1")
+
+    if pcm is None:  # pure python fallback, only uncompressed WAV can be decoded
+        try:
+            with wave.open(path, "rb") as wav_file:
+                if wav_file.getsampwidth() != 2:
+                    return None
+                channels = wav_file.getnchannels()
+                samples = array.array("h", wav_file.readframes(wav_file.getnframes()))[::channels]
+        except (wave.Error, EOFError, OSError):
+            return None
+    else:
+        samples = array.array("h", pcm[:len(pcm) - len(pcm) % 2])
+
+    return waveform_from_samples(samples)
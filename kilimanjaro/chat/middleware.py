@@ -1,14 +1,15 @@
 from django.contrib.auth.models import AnonymousUser
 from rest_framework_simplejwt.tokens import AccessToken
-from channels.db import database_sync_to_async
 from channels.middleware import BaseMiddleware
 from django.contrib.auth import get_user_model
 
+from core.utils.executors import ExecutorBusy, database_pool_to_async
+
 
 User = get_user_model()
 
 
-@database_sync_to_async
+@database_pool_to_async
 def get_user(token_key):
     try:
         access_token = AccessToken(token_key)
@@ -34,6 +35,11 @@ class TokenAuthMiddleware(BaseMiddleware):
         if b'authorization' in headers:
             token_key = headers[b'authorization'].decode().split()[0]
  
-        scope['user'] = AnonymousUser() if token_key is None else await get_user(token_key)
+        try:
+            scope['user'] = AnonymousUser() if token_key is None else await get_user(token_key)
+        except ExecutorBusy:
+            # consumer closes the socket with 'SERVER_BUSY_CLOSE_CODE', client reconnects later
+            scope['user'] = AnonymousUser()
+            scope['is_server_busy'] = True
 
         return await super().__call__(scope, receive, send)
\ No newline at end of file
@@ -1,2 +1,3 @@
 from .chat_room import *
-from .chat_message import *
\ No newline at end of file
+from .chat_message import *
+from .chat_attachment import *
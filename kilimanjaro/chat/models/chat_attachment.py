@@ -0,0 +1,34 @@
+from django.db import models
+from model_utils.models import TimeStampedModel
+
+
+class ChatAttachmentBlob(TimeStampedModel):
+    """Stored content of chat attachment and voice files, one row and one file per content"""
+
+    sha256 = models.CharField(max_length=64, unique=True)
+    size = models.PositiveBigIntegerField(default=0)
+    path = models.CharField(max_length=200)  # file path inside media root
+    ref_count = models.PositiveIntegerField(default=0)  # number of references
+    variants = models.JSONField(default=dict, blank=True)  # image variants, see 'core.utils.images'
+
+    class Meta:
+        verbose_name = "Chat Attachment Blob"
+        verbose_name_plural = "Chat Attachment Blobs"
+
+    def __str__(self):
+        return self.sha256
+
+
+class ChatAttachmentReference(TimeStampedModel):
+    """Room file of a blob, it's a hard link of the blob file under the room directory"""
+
+    blob = models.ForeignKey(ChatAttachmentBlob, on_delete=models.PROTECT, related_name='references')
+    path = models.CharField(max_length=300, unique=True)  # file path inside media root like '<room uuid>/<hash>.png'
+    ref_count = models.PositiveIntegerField(default=0)  # number of messages using the file
+
+    class Meta:
+        verbose_name = "Chat Attachment Reference"
+        verbose_name_plural = "Chat Attachment References"
+
+    def __str__(self):
+        return self.path
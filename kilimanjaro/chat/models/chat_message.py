@@ -1,15 +1,20 @@
 import uuid
 from django.db import models
 from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector, SearchVectorField
+from django.db.models import Value
 
 from model_utils.models import TimeStampedModel
 from django.contrib.auth import get_user_model
 from chat.models import ChatRoom
+from core.utils.general_data import CHAT_SEARCH_CONFIG
 
 User = get_user_model()
 
 
-class ChatMessage(TimeStampedModel):
+class AbstractChatMessage(TimeStampedModel):
+    """Columns of chat messages, shared by the messages and the archived messages"""
 
     _MESSAGE_TYPE = (
         ('text', 'Text'),
@@ -18,27 +23,87 @@ class ChatMessage(TimeStampedModel):
         ('voice', 'Voice')
     ) 
 
-    uuid = models.UUIDField(default=uuid.uuid4, unique=True)
-    sender = models.ForeignKey(User, null=True, on_delete=models.SET_NULL, related_name='sender')
-    receiver = models.ForeignKey(User, null=True, on_delete=models.SET_NULL, related_name='receiver')
-    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE)
+    uuid = models.UUIDField(default=uuid.uuid4)  # (uuid, created) is unique, see 'ChatMessage.Meta.constraints'
     message_text = models.TextField(max_length=140, null=True, blank=True)
     message_type = models.CharField(max_length=20, choices=_MESSAGE_TYPE)
     attachment_links = ArrayField(models.TextField(null=True, blank=True), blank=True, null=True) # url path of attachments file
     voice = models.CharField(max_length=500, null=True, blank=True) # url path of voice file
+    voice_waveform = ArrayField(models.PositiveSmallIntegerField(), blank=True, null=True, editable=False) # levels 0-100, set by celery
+    attachment_variants = ArrayField(models.JSONField(null=True), blank=True, null=True, editable=False) # image variants of 'attachment_links' items, set by celery
     is_deleted = models.BooleanField(default=False)
+    seq = models.PositiveBigIntegerField(default=0)  # position in the room, given by 'ChatRoom.add_messages'
+    search_vector = SearchVectorField(null=True, editable=False)  # set by 'update_search_vector'
 
     class Meta:
-        verbose_name = "Chat Message"
-        verbose_name_plural = "Chat Messages"
+        abstract = True
 
     def __str__(self):
         return str(self.message_text)
 
+    @property
+    def preview(self) -> str:
+        """Returns short text of the message for chat room list"""
+
+        if self.is_deleted:
+            return None
+        if self.message_text:
+            return self.message_text[:140]
+        if self.message_type == 'voice':
+            return "Voice message"
+        return "Attachment"
+
+
+class ChatMessage(AbstractChatMessage):
+    """Chat message, table is partitioned by month of 'created' when 'partition_chat_messages' is run,
+    see 'chat.partitions'"""
+
+    sender = models.ForeignKey(User, null=True, on_delete=models.SET_NULL, related_name='sender')
+    receiver = models.ForeignKey(User, null=True, on_delete=models.SET_NULL, related_name='receiver')
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE)
+
+    class Meta:
+        verbose_name = "Chat Message"
+        verbose_name_plural = "Chat Messages"
+        indexes = [
+            # room history pages are ordered by (created, id)
+            models.Index(fields=['room', 'created', 'id'], name='chat_message_history_idx'),
+            GinIndex(fields=['search_vector'], name='chat_message_search_idx'),
+        ]
+        constraints = [
+            # partitioned table's unique constraints include 'created', same name as 'chat.partitions' gives it
+            models.UniqueConstraint(fields=['uuid', 'created'], name='chat_chatmessage_uuid_created_uniq'),
+        ]
+
+    def update_search_vector(self) -> None:
+        """Sets search vector of the message text, it's computed by db in the same INSERT/UPDATE"""
+
+        if self.message_text and not self.is_deleted:
+            self.search_vector = SearchVector(Value(self.message_text), config=CHAT_SEARCH_CONFIG)
+        else:
+            self.search_vector = None  # deleted messages aren't searched, so they aren't indexed
+
+
+class ArchivedChatMessage(AbstractChatMessage):
+    """Chat message of an archived month, read only
+
+    Table is made by 'archive_chat_messages' command from the detached old month partitions of
+    the chat message table, history pages continue into it after the newest archived message.
+    """
+
+    sender = models.ForeignKey(User, null=True, on_delete=models.DO_NOTHING, related_name='+', db_constraint=False)
+    receiver = models.ForeignKey(User, null=True, on_delete=models.DO_NOTHING, related_name='+', db_constraint=False)
+    room = models.ForeignKey(ChatRoom, on_delete=models.DO_NOTHING, related_name='+', db_constraint=False)
+
+    class Meta:
+        managed = False
+        db_table = 'chat_chatmessage_archive'
+        verbose_name = "Archived Chat Message"
+        verbose_name_plural = "Archived Chat Messages"
+
 
 class ChatMessageEditLog(TimeStampedModel):
     uuid = models.UUIDField(default=uuid.uuid4, unique=True)
-    message = models.ForeignKey(ChatMessage, null=True, on_delete=models.SET_NULL)
+    message = models.ForeignKey(ChatMessage, null=True, on_delete=models.SET_NULL, db_constraint=False)  # partitioned table has (id, created) key
     previous_text_message = models.TextField(max_length=140, null=True, blank=True)
     message_text = models.TextField(max_length=140, null=True, blank=True)
 
@@ -53,7 +118,7 @@ class ChatMessageEditLog(TimeStampedModel):
 class ChatMessageReport(TimeStampedModel):
     uuid = models.UUIDField(default=uuid.uuid4, unique=True)
     reported_by = models.ForeignKey(User, null=True, on_delete=models.SET_NULL)
-    message = models.ForeignKey(ChatMessage, null=True, on_delete=models.SET_NULL)
+    message = models.ForeignKey(ChatMessage, null=True, on_delete=models.SET_NULL, db_constraint=False)  # partitioned table has (id, created) key
     reason = models.TextField(max_length=1000, null=True, blank=True)
 
     class Meta:
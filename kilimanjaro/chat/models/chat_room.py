@@ -1,8 +1,8 @@
 import uuid
 from django.core.exceptions import ValidationError
 
-from django.db import models
-from django.db.models import Q
+from django.db import models, transaction
+from django.db.models import F, Max
 from model_utils.models import TimeStampedModel
 from django.contrib.auth import get_user_model
 
@@ -10,6 +10,38 @@ from django.contrib.auth import get_user_model
 User = get_user_model()
 
 
+def member_pair(user_a, user_b) -> tuple:
+    """Returns (low user id, high user id) of two users, same for both orders"""
+    return tuple(sorted((user_a.id, user_b.id)))
+
+
+class ChatRoomManager(models.Manager):
+    def get_for_members(self, user_a, user_b):
+        """Returns room of two users or None, one unique index probe"""
+
+        low_user_id, high_user_id = member_pair(user_a, user_b)
+        return self.filter(low_user_id=low_user_id, high_user_id=high_user_id).first()
+
+    def get_or_create_for_members(self, user_a, user_b):
+        """Returns room of two users, creates it when it doesn't exist
+
+        Concurrent calls for the same users can't create two rooms, the loser's
+        INSERT ... ON CONFLICT DO NOTHING inserts nothing and it reads the winner's room.
+        """
+        room = self.get_for_members(user_a, user_b)
+        if not room:
+            self.bulk_create([ChatRoom(room_member_1=user_a, room_member_2=user_b)], ignore_conflicts=True)
+            room = self.get_for_members(user_a, user_b)
+        return room
+
+    def bulk_create(self, objs, **kwargs):
+        """Rooms are created with their member pair, 'save' isn't called by bulk create"""
+
+        for obj in objs:
+            obj.set_member_pair()
+        return super().bulk_create(objs, **kwargs)
+
+
 class ChatRoom(TimeStampedModel):
     uuid = models.UUIDField(default=uuid.uuid4, unique=True)
     room_member_1 = models.ForeignKey(User, null=True, related_name='member_1', on_delete=models.SET_NULL)
@@ -17,13 +49,52 @@ class ChatRoom(TimeStampedModel):
     is_blocked_by_member_1 = models.BooleanField(default=False)
     is_blocked_by_member_2 = models.BooleanField(default=False)
 
+    # (low, high) user ids of the members, same for (member_1, member_2) and (member_2, member_1)
+    low_user_id = models.BigIntegerField(null=True, editable=False)
+    high_user_id = models.BigIntegerField(null=True, editable=False)
+
+    # Inbox summary, kept current by message create/update/delete functions of 'chat.consumers'
+    last_message = models.ForeignKey('ChatMessage', null=True, blank=True, related_name='+', on_delete=models.SET_NULL, db_constraint=False)
+    last_message_preview = models.CharField(max_length=140, null=True, blank=True)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+
+    # Sequence number of the newest message, messages of the room are numbered from 1 in sending order
+    message_seq = models.PositiveBigIntegerField(default=0)
+
+    # Read watermarks, unread count of a member is 'message_seq - last_read_seq_member_<n>'
+    last_read_seq_member_1 = models.PositiveBigIntegerField(default=0)
+    last_read_seq_member_2 = models.PositiveBigIntegerField(default=0)
+    last_read_message_id_member_1 = models.BigIntegerField(null=True, blank=True)
+    last_read_message_id_member_2 = models.BigIntegerField(null=True, blank=True)
+
     class Meta:
         verbose_name = "Chat Room"
         verbose_name_plural = "Chat Rooms"
+        constraints = [
+            # one room per two users, also used for the room lookup of two users
+            models.UniqueConstraint(fields=['low_user_id', 'high_user_id'], name='chat_room_member_pair_unique'),
+        ]
+        indexes = [
+            # inbox of a member ordered by last activity
+            models.Index(fields=['room_member_1', '-last_message_at'], name='chat_room_member_1_inbox_idx'),
+            models.Index(fields=['room_member_2', '-last_message_at'], name='chat_room_member_2_inbox_idx'),
+        ]
+
+    objects = ChatRoomManager()
 
     def __str__(self):
         return f"{self.room_member_1}-{self.room_member_2}"
 
+    def save(self, *args, **kwargs):
+        self.set_member_pair()
+        return super().save(*args, **kwargs)
+
+    def set_member_pair(self) -> None:
+        """Sets (low, high) user id pair of the members"""
+
+        if self.room_member_1_id and self.room_member_2_id:
+            self.low_user_id, self.high_user_id = sorted((self.room_member_1_id, self.room_member_2_id))
+
     @property
     def group_name(self):
         """Returns private chat room name"""
@@ -32,10 +103,8 @@ class ChatRoom(TimeStampedModel):
     def clean(self, *args, **kwargs):
         """Unique together between room_member_1 and room_member_2"""
 
-        rooms = ChatRoom.objects.filter(
-                    Q(Q(room_member_1=self.room_member_1) & Q(room_member_2=self.room_member_1)) |
-                    Q(Q(room_member_2=self.room_member_2) & Q(room_member_2=self.room_member_2)) 
-                )
+        self.set_member_pair()
+        rooms = ChatRoom.objects.filter(low_user_id=self.low_user_id, high_user_id=self.high_user_id)
 
         if self.id: # when update exclude self instance
             rooms = rooms.exclude(id=self.id)
@@ -51,6 +120,136 @@ class ChatRoom(TimeStampedModel):
             return self.room_member_2
         return self.room_member_1
 
+    def member_field(self, user, field_prefix: str) -> str:
+        """Returns name of a per-member field of the user like 'last_read_seq_member_1'"""
+        return f"{field_prefix}_member_{1 if user.id == self.room_member_1_id else 2}"
+
+    def get_unread_count(self, user) -> int:
+        """Returns number of messages that user hasn't read yet"""
+        return max(0, self.message_seq - getattr(self, self.member_field(user, 'last_read_seq')))
+
+    def get_last_read_message_id(self, user) -> int:
+        """Returns id of the last message that user has read"""
+        return getattr(self, self.member_field(user, 'last_read_message_id'))
+
+    def add_messages(self, messages: list) -> None:
+        """Saves new messages of the room with the next sequence numbers
+
+        Inbox summary moves to the last message and senders' read watermarks too, sender has read
+        own message. Must run in a transaction, the room row stays locked until it ends.
+
+        Parameters:
+            messages (list): unsaved messages of the room in sending order, they may have
+                preallocated ids
+        """
+        self.message_seq = ChatRoom.objects.select_for_update().values_list(
+            'message_seq', flat=True).get(id=self.id)
+
+        for message in messages:
+            self.message_seq += 1
+            message.seq = self.message_seq
+            message.update_search_vector()
+
+        messages[0].__class__.objects.bulk_create(messages)
+
+        read_watermarks = {}
+        for message in messages:
+            read_watermarks[self.member_field(message.sender, 'last_read_seq')] = message.seq
+            read_watermarks[self.member_field(message.sender, 'last_read_message_id')] = message.id
+
+        last_message = messages[-1]
+        ChatRoom.objects.filter(id=self.id).update(
+            message_seq=self.message_seq, last_message=last_message,
+            last_message_preview=last_message.preview, last_message_at=last_message.created,
+            **read_watermarks
+        )
+
+    def message_changed(self, message) -> None:
+        """Refreshes inbox preview when the edited/deleted message is the last one of the room"""
+
+        ChatRoom.objects.filter(id=self.id, last_message_id=message.id).update(
+            last_message_preview=message.preview
+        )
+
+    def mark_as_read(self, user, message_id: int = None) -> bool:
+        """Moves user's read watermark forward to the message
+
+        Parameters:
+            user (object): room member
+            message_id (int): message of the room, last message of the room by default
+
+        Returns:
+            True when watermark is moved, False when message is invalid or already read
+        """
+        seq_field = self.member_field(user, 'last_read_seq')
+        message_id_field = self.member_field(user, 'last_read_message_id')
+        rooms = ChatRoom.objects.filter(id=self.id)
+
+        if message_id is None:
+            # single statement, also covers messages that this instance doesn't know yet
+            return bool(rooms.filter(**{f"{seq_field}__lt": F('message_seq')}).update(
+                **{seq_field: F('message_seq'), message_id_field: F('last_message_id')}
+            ))
+
+        seq = self.chatmessage_set.filter(id=message_id).values_list('seq', flat=True).first()
+        if seq is None:
+            return False
+
+        # watermark only moves forward
+        return bool(rooms.filter(**{f"{seq_field}__lt": seq}).update(**{seq_field: seq, message_id_field: message_id}))
+
+    def rebuild_inbox_summary(self, renumber: bool = False) -> None:
+        """Recomputes last message summary and message sequence from room messages
+
+        Messages without sequence number (0) are numbered by their creation order after the newest
+        numbered message, numbered ones and read watermarks are kept. Deleted and archived
+        messages keep their numbers, so the sequence isn't the number of messages.
+
+        Parameters:
+            renumber (bool): numbers every message of the room from 1 by creation order, e.g. after
+                merging rooms. Read watermarks are moved to the new numbers of the members' last
+                read messages.
+        """
+        messages_model = self.chatmessage_set.model
+
+        with transaction.atomic():
+            message_seq = ChatRoom.objects.select_for_update().values_list('message_seq', flat=True).get(id=self.id)
+            messages = self.chatmessage_set.order_by('created', 'id').only('id', 'seq')
+
+            if renumber:
+                message_seq = 0
+            else:
+                message_seq = max(message_seq, messages.aggregate(max_seq=Max('seq'))['max_seq'] or 0)
+                messages = messages.filter(seq=0)
+
+            messages = list(messages)
+            for message in messages:
+                message_seq += 1
+                message.seq = message_seq
+            messages_model.objects.bulk_update(messages, ['seq'], batch_size=1000)
+
+            read_watermarks = {}
+            if renumber:
+                room = ChatRoom.objects.only(
+                    'last_read_message_id_member_1', 'last_read_message_id_member_2').get(id=self.id)
+                for member_number in (1, 2):
+                    last_read_message_id = getattr(room, f"last_read_message_id_member_{member_number}")
+                    seq = None
+                    if last_read_message_id is not None:
+                        # last read message may be deleted, the newest message before it is read too
+                        seq = self.chatmessage_set.filter(id__lte=last_read_message_id).order_by('-id').values_list(
+                            'seq', flat=True).first()
+                    read_watermarks[f"last_read_seq_member_{member_number}"] = seq or 0
+
+            last_message = self.chatmessage_set.order_by('-created', '-id').first()
+            ChatRoom.objects.filter(id=self.id).update(
+                message_seq=message_seq,
+                last_message=last_message,
+                last_message_preview=last_message.preview if last_message else None,
+                last_message_at=last_message.created if last_message else None,
+                **read_watermarks
+            )
+
 
 class ChatRoomBlockLog(TimeStampedModel):
     __BLOCK_TYPE = (
@@ -0,0 +1,309 @@
+"""Monthly partitions of the chat message table and the archive of old months.
+
+'partition_chat_messages --convert' turns the chat message table into a table partitioned by
+range of 'created', one partition per month:
+
+    chat_chatmessage              partitioned table, (id, created) is the primary key
+        chat_chatmessage_y2024m01
+        chat_chatmessage_y2024m02
+        ...                       'CHAT_PARTITION_MONTHS_AHEAD' empty months are kept ready
+
+History pages are ordered by (created, id) with a 'created' bound, so db skips the partitions
+out of the bound and reads the rest newest first until the page is full, a recent page reads
+one or two partitions.
+
+'archive_chat_messages' detaches the months older than 'CHAT_ARCHIVE_AFTER_MONTHS' and attaches
+them to 'chat_chatmessage_archive' (the 'ArchivedChatMessage' model), which is read only and
+can be moved to 'CHAT_ARCHIVE_TABLESPACE' on compressed storage. Room history pages continue
+into the archive, search and message actions use the hot table only.
+
+'create_chat_message_partitions' celery beat task makes the partitions of the next months
+daily. When it doesn't run for 'CHAT_PARTITION_MONTHS_AHEAD' months, new messages go to the
+default partition 'chat_chatmessage_default' instead of failing; the task moves them to their
+month partition when it runs again and logs an error. The default partition is empty otherwise,
+a history page bound by 'created' to existing months doesn't read it.
+
+The model state isn't the partitioned table: Django keeps 'id' as the primary key, the table's
+is (id, created), and (uuid, created) is unique for both by 'ChatMessage.Meta.constraints'.
+A migration which changes the 'id' or 'created' column of a converted table has to be written
+as 'SeparateDatabaseAndState' with the state operation and 'RunSQL' on the partitioned table.
+"""
+
+import logging
+import re
+from datetime import date
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.utils import timezone
+
+from chat.models import ArchivedChatMessage, ChatMessage, ChatRoom
+from core.utils.general_data import CHAT_ARCHIVE_CACHE_TTL, CHAT_PARTITION_MONTHS_AHEAD
+
+logger = logging.getLogger(__name__)
+
+TABLE = ChatMessage._meta.db_table
+DEFAULT_PARTITION = f"{TABLE}_default"
+ARCHIVE_TABLE = ArchivedChatMessage._meta.db_table
+ARCHIVE_CACHE_KEY = "chat:archive:exists"
+PARTITION_NAME = re.compile(r"_y(\d{4})m(\d{2})$")
+
+
+def add_months(month: date, months: int) -> date:
+    """Returns first day of the month 'months' after the month"""
+
+    years, month_index = divmod(month.month - 1 + months, 12)
+    return date(month.year + years, month_index + 1, 1)
+
+
+def current_month() -> date:
+    """Returns first day of the current month in UTC"""
+    return timezone.now().date().replace(day=1)
+
+
+def partition_name(month: date) -> str:
+    """Returns partition table name of a month like 'chat_chatmessage_y2024m01'"""
+    return f"{TABLE}_y{month:%Y}m{month:%m}"
+
+
+def partition_bounds(month: date) -> list:
+    """Returns [from, to) 'created' range of a month partition"""
+    return [f"{month.isoformat()} 00:00:00+00", f"{add_months(month, 1).isoformat()} 00:00:00+00"]
+
+
+def is_partitioned(cursor, table: str = TABLE) -> bool:
+    """Returns whether the table is a partitioned table"""
+
+    cursor.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)", [table])
+    return cursor.fetchone() is not None
+
+
+def partition_months(cursor, table: str = TABLE) -> dict:
+    """Returns {first day of month: partition name} of the partitions of a table"""
+
+    cursor.execute(
+        "SELECT child.relname FROM pg_inherits JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE pg_inherits.inhparent = to_regclass(%s)",
+        [table],
+    )
+    months = {}
+    for (name,) in cursor.fetchall():
+        match = PARTITION_NAME.search(name)
+        if match:
+            months[date(int(match[1]), int(match[2]), 1)] = name
+    return months
+
+
+def create_partition(cursor, month: date) -> bool:
+    """Creates partition of a month, returns False when it already exists"""
+
+    name = partition_name(month)
+    cursor.execute("SELECT to_regclass(%s)", [name])
+    if cursor.fetchone()[0]:
+        return False
+
+    cursor.execute(f'CREATE TABLE "{name}" PARTITION OF "{TABLE}" FOR VALUES FROM (%s) TO (%s)', partition_bounds(month))
+    return True
+
+
+def create_default_partition(cursor) -> None:
+    """Creates the default partition when it doesn't exist, it takes messages of the months without a partition"""
+    cursor.execute(f'CREATE TABLE IF NOT EXISTS "{DEFAULT_PARTITION}" PARTITION OF "{TABLE}" DEFAULT')
+
+
+def move_default_rows(cursor) -> int:
+    """Moves the messages of the default partition to their month partitions, table is locked meanwhile
+
+    A month partition can't be created while the default partition has messages of that month,
+    so the default partition is detached while the messages are moved.
+
+    Returns:
+        Number of moved messages
+    """
+    cursor.execute(
+        f"SELECT DISTINCT date_trunc('month', created AT TIME ZONE 'UTC')::date FROM \"{DEFAULT_PARTITION}\""
+    )
+    months = [month for (month,) in cursor.fetchall()]
+    if not months:
+        return 0
+
+    cursor.execute(f'ALTER TABLE "{TABLE}" DETACH PARTITION "{DEFAULT_PARTITION}"')
+    for month in months:
+        create_partition(cursor, month)
+    cursor.execute(f'INSERT INTO "{TABLE}" SELECT * FROM "{DEFAULT_PARTITION}"')
+    moved = cursor.rowcount
+    cursor.execute(f'TRUNCATE "{DEFAULT_PARTITION}"')
+    cursor.execute(f'ALTER TABLE "{TABLE}" ATTACH PARTITION "{DEFAULT_PARTITION}" DEFAULT')
+    return moved
+
+
+def create_indexes(cursor) -> None:
+    """Creates indexes and foreign keys of the partitioned table, every partition gets them"""
+
+    user_table = ChatMessage._meta.get_field('sender').related_model._meta.db_table
+    statements = [
+        f'ALTER TABLE "{TABLE}" ADD PRIMARY KEY (id, created)',
+        f'ALTER TABLE "{TABLE}" ADD CONSTRAINT "{TABLE}_uuid_created_uniq" UNIQUE (uuid, created)',
+        # same names as the indexes of the model, history pages are ordered by (created, id)
+        f'CREATE INDEX "chat_message_history_idx" ON "{TABLE}" (room_id, created, id)',
+        f'CREATE INDEX "chat_message_search_idx" ON "{TABLE}" USING gin (search_vector)',
+        f'CREATE INDEX "{TABLE}_sender_id_idx" ON "{TABLE}" (sender_id)',
+        f'CREATE INDEX "{TABLE}_receiver_id_idx" ON "{TABLE}" (receiver_id)',
+        f'ALTER TABLE "{TABLE}" ADD CONSTRAINT "{TABLE}_sender_id_fk" FOREIGN KEY (sender_id) '
+        f'REFERENCES "{user_table}" (id) DEFERRABLE INITIALLY DEFERRED',
+        f'ALTER TABLE "{TABLE}" ADD CONSTRAINT "{TABLE}_receiver_id_fk" FOREIGN KEY (receiver_id) '
+        f'REFERENCES "{user_table}" (id) DEFERRABLE INITIALLY DEFERRED',
+        f'ALTER TABLE "{TABLE}" ADD CONSTRAINT "{TABLE}_room_id_fk" FOREIGN KEY (room_id) '
+        f'REFERENCES "{ChatRoom._meta.db_table}" (id) DEFERRABLE INITIALLY DEFERRED',
+    ]
+    for statement in statements:
+        cursor.execute(statement)
+
+
+def convert_to_partitioned(months_ahead: int = CHAT_PARTITION_MONTHS_AHEAD) -> int:
+    """Moves the messages into a new table partitioned by month, table is locked meanwhile
+
+    Parameters:
+        months_ahead (int): number of next months to create partitions for
+
+    Returns:
+        Number of created partitions, 0 when table is already partitioned
+    """
+    old_table = f"{TABLE}_unpartitioned"
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        if is_partitioned(cursor):
+            return 0
+
+        cursor.execute(f'LOCK TABLE "{TABLE}" IN ACCESS EXCLUSIVE MODE')
+        cursor.execute(f'ALTER TABLE "{TABLE}" RENAME TO "{old_table}"')
+        cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [old_table])
+        sequence = cursor.fetchone()[0]
+
+        cursor.execute(
+            f'CREATE TABLE "{TABLE}" (LIKE "{old_table}" INCLUDING DEFAULTS INCLUDING STORAGE) PARTITION BY RANGE (created)'
+        )
+        # write-behind saving takes ids by 'pg_get_serial_sequence', sequence mustn't be dropped with the old table
+        cursor.execute(f'ALTER SEQUENCE {sequence} OWNED BY "{TABLE}".id')
+
+        cursor.execute(f'SELECT min(created), max(created) FROM "{old_table}"')
+        oldest, newest = cursor.fetchone()
+        month = oldest.date().replace(day=1) if oldest else current_month()
+        last_month = add_months(current_month(), months_ahead)
+        if newest:
+            last_month = max(last_month, newest.date().replace(day=1))
+
+        created = 0
+        while month <= last_month:
+            created += create_partition(cursor, month)
+            month = add_months(month, 1)
+
+        create_default_partition(cursor)
+        cursor.execute(f'INSERT INTO "{TABLE}" SELECT * FROM "{old_table}"')
+        # every message has to be in it's month partition, the default one is for the missed months only
+        cursor.execute(f'SELECT count(*) FROM "{DEFAULT_PARTITION}"')
+        uncovered = cursor.fetchone()[0]
+        if uncovered:
+            raise RuntimeError(f"{uncovered} chat messages have no month partition, {TABLE} isn't converted")
+
+        # foreign keys to the old table are dropped too, a partitioned table's key includes 'created'
+        cursor.execute(f'DROP TABLE "{old_table}" CASCADE')
+        create_indexes(cursor)
+
+    logger.info(f"{TABLE} is partitioned by month, {created} partitions created")
+    return created
+
+
+def create_future_partitions(months_ahead: int = CHAT_PARTITION_MONTHS_AHEAD) -> list:
+    """Creates partitions of the current and next months which don't exist yet, moves messages
+    of the default partition to their month partitions
+
+    Parameters:
+        months_ahead (int): number of next months to create partitions for
+
+    Returns:
+        Names of the created partitions
+    """
+    created = []
+    with transaction.atomic(), connection.cursor() as cursor:
+        if not is_partitioned(cursor):
+            return created
+
+        create_default_partition(cursor)
+        moved = move_default_rows(cursor)
+        if moved:
+            logger.error(f"{moved} chat messages were saved without a month partition, partitions weren't created in time")
+
+        for months in range(months_ahead + 1):
+            month = add_months(current_month(), months)
+            if create_partition(cursor, month):
+                created.append(partition_name(month))
+
+    return created
+
+
+def create_archive_table(cursor) -> None:
+    """Creates the partitioned archive table when it doesn't exist"""
+
+    cursor.execute("SELECT to_regclass(%s)", [ARCHIVE_TABLE])
+    if cursor.fetchone()[0]:
+        return
+
+    cursor.execute(f'CREATE TABLE "{ARCHIVE_TABLE}" (LIKE "{TABLE}") PARTITION BY RANGE (created)')
+    cursor.execute(f'ALTER TABLE "{ARCHIVE_TABLE}" ADD PRIMARY KEY (id, created)')
+    # attached partitions already have an index like this one, it's used instead of building a new one
+    cursor.execute(f'CREATE INDEX "chat_message_archive_history_idx" ON "{ARCHIVE_TABLE}" (room_id, created, id)')
+
+
+def archive_partitions(older_than_months: int = None) -> list:
+    """Moves partitions of the months older than 'older_than_months' to the archive table
+
+    Each partition is detached and attached in one transaction, so it's messages are always
+    readable from one of the tables. Then it's moved to 'CHAT_ARCHIVE_TABLESPACE' when it's set.
+
+    Parameters:
+        older_than_months (int): number of the latest months kept in the hot table
+
+    Returns:
+        Names of the archived partitions
+    """
+    if older_than_months is None:
+        older_than_months = settings.CHAT_ARCHIVE_AFTER_MONTHS
+    cutoff = add_months(current_month(), -older_than_months)
+
+    with connection.cursor() as cursor:
+        if not is_partitioned(cursor):
+            return []
+        old_months = sorted(month for month in partition_months(cursor) if month < cutoff)
+
+    archived = []
+    for month in old_months:
+        name = partition_name(month)
+        with transaction.atomic(), connection.cursor() as cursor:
+            create_archive_table(cursor)
+            cursor.execute(f'ALTER TABLE "{TABLE}" DETACH PARTITION "{name}"')
+            cursor.execute(f'ALTER TABLE "{ARCHIVE_TABLE}" ATTACH PARTITION "{name}" FOR VALUES FROM (%s) TO (%s)', partition_bounds(month))
+
+        if settings.CHAT_ARCHIVE_TABLESPACE:
+            # table is rewritten, only the archived month is locked meanwhile; it's indexes stay on fast storage
+            with connection.cursor() as cursor:
+                cursor.execute(f'ALTER TABLE "{name}" SET TABLESPACE "{settings.CHAT_ARCHIVE_TABLESPACE}"')
+
+        archived.append(name)
+        logger.info(f"{name} is archived")
+
+    cache.delete(ARCHIVE_CACHE_KEY)
+    return archived
+
+
+def archive_exists() -> bool:
+    """Returns whether the archive table exists, history pages read it only then"""
+
+    exists = cache.get(ARCHIVE_CACHE_KEY)
+    if exists is None:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT to_regclass(%s)", [ARCHIVE_TABLE])
+            exists = cursor.fetchone()[0] is not None
+        cache.set(ARCHIVE_CACHE_KEY, exists, CHAT_ARCHIVE_CACHE_TTL)
+    return exists
@@ -0,0 +1,235 @@
+"""Online presence of users, stored in redis so every ASGI process sees the same state.
+
+Redis keys:
+    presence:user:<user id>  sorted set of the user's socket channel names, score is expiry time
+    presence:online          sorted set of online user ids, score is expiry time of the user's
+                             latest socket
+
+A socket stays alive while it's process refreshes it's expiry ('PRESENCE_HEARTBEAT_INTERVAL'),
+one pipelined call per process refreshes all sockets of that process. Sockets of a crashed
+process simply expire and are swept by the heartbeat of any other process.
+
+Going offline is debounced by 'PRESENCE_OFFLINE_DELAY', so page reloads and short reconnects
+don't send presence changes to chat partners.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Iterable
+
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.db.models import Q
+from django_redis import get_redis_connection
+
+from chat.models import ChatRoom
+from core.utils.executors import database_pool_to_async
+from core.utils.general_data import PRESENCE_TTL, PRESENCE_HEARTBEAT_INTERVAL, PRESENCE_OFFLINE_DELAY
+
+logger = logging.getLogger(__name__)
+
+ONLINE_KEY = "presence:online"
+
+# KEYS: user sockets, online users; ARGV: channel name, user id, expiry, now, key ttl
+# Returns 1 when the user was offline before
+CONNECT_SCRIPT = """
+local online_until = redis.call('ZSCORE', KEYS[2], ARGV[2])
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+redis.call('ZADD', KEYS[2], ARGV[3], ARGV[2])
+if online_until and tonumber(online_until) > tonumber(ARGV[4]) then
+    return 0
+end
+return 1
+"""
+
+# KEYS: user sockets, online users; ARGV: channel name, user id, now
+# Returns 1 when the user has no other alive socket
+DISCONNECT_SCRIPT = """
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[3])
+local latest = redis.call('ZREVRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+if #latest == 0 then
+    redis.call('ZREM', KEYS[2], ARGV[2])
+    return 1
+end
+redis.call('ZADD', KEYS[2], latest[2], ARGV[2])
+return 0
+"""
+
+# KEYS: online users; ARGV: now, max count
+# Removes and returns users whose all sockets are expired
+SWEEP_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+if #expired > 0 then
+    redis.call('ZREM', KEYS[1], unpack(expired))
+end
+return expired
+"""
+
+
+def user_key(user_id: int) -> str:
+    """Returns redis key of the user's sockets"""
+    return f"presence:user:{user_id}"
+
+
+def user_group_name(user_id: int) -> str:
+    """Returns channel layer group of all chat sockets of the user"""
+    return f"chat_user_{user_id}"
+
+
+def get_redis():
+    """Returns redis connection of the default cache"""
+    return get_redis_connection("default")
+
+
+def online_users(user_ids: Iterable[int]) -> set:
+    """Returns ids of the online users among 'user_ids' with one redis round trip
+
+    Parameters:
+        user_ids (list): user ids like the partners of a room list page
+
+    Returns:
+        Set of online user ids
+    """
+    user_ids = list(user_ids)
+    if not user_ids:
+        return set()
+
+    pipeline = get_redis().pipeline(transaction=False)
+    for user_id in user_ids:
+        pipeline.zscore(ONLINE_KEY, user_id)
+
+    now = time.time()
+    return {user_id for user_id, online_until in zip(user_ids, pipeline.execute())
+            if online_until and online_until > now}
+
+
+def is_online(user_id: int) -> bool:
+    """Returns True when the user has an alive socket"""
+    return user_id in online_users([user_id])
+
+
+def get_chat_partner_ids(user_id: int) -> list:
+    """Returns ids of the users who have a chat room with the user"""
+
+    rooms = ChatRoom.objects.filter(Q(room_member_1_id=user_id) | Q(room_member_2_id=user_id))
+    return [
+        member_2 if member_1 == user_id else member_1
+        for member_1, member_2 in rooms.values_list('room_member_1_id', 'room_member_2_id')
+        if member_1 and member_2
+    ]
+
+
+class PresenceTracker:
+    """Presence of the sockets of this process
+
+    Methods
+    -------
+    connect(user_id=int, channel_name=str):
+        Marks the socket alive, notifies chat partners when user comes online
+    disconnect(user_id=int, channel_name=str):
+        Removes the socket, notifies chat partners when user stays offline
+    """
+
+    def __init__(self):
+        self.channels = {}  # channel name -> user id of alive sockets of this process
+        self.heartbeat_task = None
+        self.offline_checks = {}  # user id -> pending debounced offline check
+
+    async def connect(self, user_id: int, channel_name: str) -> None:
+        """Marks the socket alive, notifies chat partners when user comes online"""
+
+        self.channels[channel_name] = user_id
+        self.start_heartbeat()
+
+        pending_check = self.offline_checks.pop(user_id, None)
+        if pending_check:
+            pending_check.cancel()
+
+        now = time.time()
+        came_online = await sync_to_async(get_redis().eval, thread_sensitive=False)(
+            CONNECT_SCRIPT, 2, user_key(user_id), ONLINE_KEY,
+            channel_name, user_id, now + PRESENCE_TTL, now, PRESENCE_TTL + PRESENCE_HEARTBEAT_INTERVAL,
+        )
+        if came_online and not pending_check:
+            await publish_presence(user_id, True)
+
+    async def disconnect(self, user_id: int, channel_name: str) -> None:
+        """Removes the socket, notifies chat partners when user stays offline"""
+
+        self.channels.pop(channel_name, None)
+
+        went_offline = await sync_to_async(get_redis().eval, thread_sensitive=False)(
+            DISCONNECT_SCRIPT, 2, user_key(user_id), ONLINE_KEY, channel_name, user_id, time.time(),
+        )
+        if went_offline and user_id not in self.offline_checks:
+            self.offline_checks[user_id] = asyncio.get_running_loop().call_later(
+                PRESENCE_OFFLINE_DELAY, lambda: asyncio.ensure_future(self.check_offline(user_id))
+            )
+
+    async def check_offline(self, user_id: int) -> None:
+        """Notifies chat partners when user hasn't come back in offline delay"""
+
+        self.offline_checks.pop(user_id, None)
+        if not await sync_to_async(is_online, thread_sensitive=False)(user_id):
+            await publish_presence(user_id, False)
+
+    def start_heartbeat(self) -> None:
+        """Starts heartbeat loop of this process once"""
+
+        task = self.heartbeat_task
+        if task is None or task.done() or task.get_loop() is not asyncio.get_running_loop():
+            self.heartbeat_task = asyncio.ensure_future(self.heartbeat())
+
+    async def heartbeat(self) -> None:
+        """Refreshes expiry of sockets of this process and sweeps expired users"""
+
+        while self.channels:
+            await asyncio.sleep(PRESENCE_HEARTBEAT_INTERVAL)
+            try:
+                expired_user_ids = await sync_to_async(self.refresh, thread_sensitive=False)(dict(self.channels))
+                for user_id in expired_user_ids:
+                    await publish_presence(int(user_id), False)
+            except Exception as e:  # heartbeat has to keep running when redis is down for a while
+                logger.error(f"Presence heartbeat failed: {e!r}")
+
+    def refresh(self, channels: dict) -> list:
+        """Refreshes expiry of the sockets with one pipeline, returns users whose sockets are expired"""
+
+        redis = get_redis()
+        now = time.time()
+        online_until = now + PRESENCE_TTL
+
+        pipeline = redis.pipeline(transaction=False)
+        for channel_name, user_id in channels.items():
+            pipeline.zadd(user_key(user_id), {channel_name: online_until})
+            pipeline.expire(user_key(user_id), PRESENCE_TTL + PRESENCE_HEARTBEAT_INTERVAL)
+        for user_id in set(channels.values()):
+            pipeline.zadd(ONLINE_KEY, {user_id: online_until})
+        pipeline.execute()
+
+        return redis.eval(SWEEP_SCRIPT, 1, ONLINE_KEY, now, 1000)
+
+
+async def publish_presence(user_id: int, is_online: bool) -> None:
+    """Sends presence change of the user to the sockets of online chat partners"""
+
+    # sent for closed sockets too, so it's queued when db pool is busy
+    partner_ids = await database_pool_to_async(get_chat_partner_ids, must_run=True)(user_id)
+    online_partner_ids = await sync_to_async(online_users, thread_sensitive=False)(partner_ids)
+
+    channel_layer = get_channel_layer()
+    await asyncio.gather(*[
+        channel_layer.group_send(user_group_name(partner_id), {
+            "type": "presence_changed",
+            "user_id": user_id,
+            "is_online": is_online,
+        })
+        for partner_id in online_partner_ids
+    ])
+
+
+# Sockets of this process
+tracker = PresenceTracker()
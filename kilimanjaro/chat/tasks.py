@@ -0,0 +1,100 @@
+"""Contains chat celery tasks"""
+
+from django.core.files.base import ContentFile
+
+from chat import attachment_store, media, partitions, utils, voice_quota
+from chat.models import ChatMessage, ChatRoom
+from kilimanjaro.celery import app
+
+
+@app.task(name="send_read_receipt")
+def send_read_receipt(room_id: int, user_id: int) -> None:
+    """
+    Sending coalesced read receipt of a room member, scheduled by 'chat.utils.schedule_read_receipt'
+
+        Parameters:
+            room_id (int) : Chat room id
+            user_id (int) : Room member who has read the messages
+
+        Returns:
+            None
+    """
+    room = ChatRoom.objects.filter(id=room_id).select_related('room_member_1', 'room_member_2').first()
+    if room:
+        utils.send_read_receipt(room, user_id)
+
+
+@app.task(name="reconcile_voice_counters")
+def reconcile_voice_counters() -> int:
+    """
+    Resetting cached voice message counters to the counts of the db, run by celery beat
+
+        Returns:
+            Number of reconciled counters
+    """
+    return voice_quota.reconcile_counters()
+
+
+@app.task(name="generate_attachment_variants")
+def generate_attachment_variants(message_id: int) -> None:
+    """
+    Making image variants of the message attachments, variants of a content are made once
+
+        Parameters:
+            message_id (int) : Chat message id
+
+        Returns:
+            None
+    """
+    message = ChatMessage.objects.filter(id=message_id, is_deleted=False).first()
+    if message and message.attachment_links:
+        attachment_variants = [attachment_store.image_variants(link) for link in message.attachment_links]
+        ChatMessage.objects.filter(id=message_id, is_deleted=False).update(attachment_variants=attachment_variants)
+
+
+@app.task(name="transcode_voice_message")
+def transcode_voice_message(message_id: int) -> None:
+    """
+    Transcoding voice of a message to Opus and computing it's waveform, then sends 'edited_message' to the room
+
+        Parameters:
+            message_id (int) : Chat message id
+
+        Returns:
+            None
+    """
+    message = ChatMessage.objects.filter(id=message_id, is_deleted=False).select_related('room').first()
+    path = attachment_store.url_to_path(message.voice) if message else None
+    if not path:
+        return
+
+    opus = media.transcode_voice(attachment_store.media_path(path))
+    voice = message.voice
+    if opus:
+        voice = attachment_store.store_file(ContentFile(opus, name="voice.ogg"), f"{message.room.uuid}/")
+    waveform = media.voice_waveform(attachment_store.media_path(attachment_store.url_to_path(voice)))
+
+    if voice == message.voice and waveform is None:
+        return
+
+    # voice is replaced only when message isn't deleted or changed meanwhile
+    is_updated = ChatMessage.objects.filter(id=message_id, voice=message.voice, is_deleted=False).update(
+        voice=voice, voice_waveform=waveform
+    )
+    if voice != message.voice:
+        attachment_store.release_files([message.voice if is_updated else voice])
+
+    if is_updated:
+        message.voice, message.voice_waveform = voice, waveform
+        utils.send_voice_transcoded(message)
+
+
+@app.task(name="create_chat_message_partitions")
+def create_chat_message_partitions() -> list:
+    """
+    Creating the chat message partitions of the next months, run by celery beat
+
+        Returns:
+            Names of the created partitions
+    """
+    return partitions.create_future_partitions()
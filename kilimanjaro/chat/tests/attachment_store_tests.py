@@ -0,0 +1,70 @@
+import os
+
+import pytest
+from asgiref.sync import async_to_sync
+from django.core.files.base import ContentFile
+
+from chat.attachment_store import collect_garbage, media_path, store_file, url_to_path
+from chat.consumers import create_chat_message, delete_chat_message
+from chat.models import ChatAttachmentBlob, ChatAttachmentReference
+
+
+@pytest.fixture
+def media_root(settings, tmp_path):
+    settings.MEDIA_ROOT = str(tmp_path)
+    return tmp_path
+
+
+@pytest.mark.django_db(transaction=True)
+def test_same_content_is_stored_once(media_root, chat_room_obj, chat_room_obj3):
+    url1 = store_file(ContentFile(b"photo", name="a.png"), f"{chat_room_obj.uuid}/")
+    url2 = store_file(ContentFile(b"photo", name="forwarded.png"), f"{chat_room_obj3.uuid}/")
+    url3 = store_file(ContentFile(b"photo", name="again.png"), f"{chat_room_obj.uuid}/")
+
+    blob = ChatAttachmentBlob.objects.get()
+    assert blob.ref_count == 2  # two rooms
+    assert url1 == url3
+    assert ChatAttachmentReference.objects.get(path=url_to_path(url1)).ref_count == 2
+
+    # room files are hard links of the blob
+    room_file = os.stat(media_path(url_to_path(url2)))
+    assert room_file.st_ino == os.stat(media_path(blob.path)).st_ino
+
+
+@pytest.mark.django_db(transaction=True)
+def test_deleted_message_files_are_removed(media_root, chat_room_obj, user_obj):
+    url = store_file(ContentFile(b"photo", name="a.png"), f"{chat_room_obj.uuid}/")
+    forwarded_url = store_file(ContentFile(b"photo", name="a.png"), f"{chat_room_obj.uuid}/")
+    message = async_to_sync(create_chat_message)(chat_room_obj, user_obj, None, [url], None)
+    forwarded = async_to_sync(create_chat_message)(chat_room_obj, user_obj, None, [forwarded_url], None)
+    blob_path = media_path(ChatAttachmentBlob.objects.get().path)
+
+    async_to_sync(delete_chat_message)(user_obj, chat_room_obj, message.id)
+    assert os.path.exists(media_path(url_to_path(url)))  # still used by the forwarded message
+
+    async_to_sync(delete_chat_message)(user_obj, chat_room_obj, forwarded.id)
+    assert not os.path.exists(media_path(url_to_path(url)))
+    assert not os.path.exists(blob_path)
+    assert not ChatAttachmentBlob.objects.exists()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_unused_files_are_collected(media_root, chat_room_obj):
+    url = store_file(ContentFile(b"never sent", name="a.png"), f"{chat_room_obj.uuid}/")
+
+    assert collect_garbage() == 0  # message may still be on it's way
+
+    ChatAttachmentReference.objects.update(modified="2000-01-01T00:00Z")
+    assert collect_garbage() == 1
+    assert not os.path.exists(media_path(url_to_path(url)))
+
+
+@pytest.mark.django_db(transaction=True)
+def test_used_files_are_recounted(media_root, chat_room_obj, user_obj):
+    url = store_file(ContentFile(b"photo", name="a.png"), f"{chat_room_obj.uuid}/")
+    async_to_sync(create_chat_message)(chat_room_obj, user_obj, None, [url, url], None)
+
+    ChatAttachmentReference.objects.update(ref_count=5, modified="2000-01-01T00:00Z")
+    assert collect_garbage() == 0
+    assert ChatAttachmentReference.objects.get().ref_count == 2
+    assert os.path.exists(media_path(url_to_path(url)))
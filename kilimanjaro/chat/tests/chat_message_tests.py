@@ -1,6 +1,34 @@
+import array
+import os
+import shutil
+import time
+import wave
+from datetime import timedelta
+
 import pytest
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
+from django.core.files import File
+from django.db import connection
+from django.utils import timezone
 
+from chat.consumers import create_chat_message, delete_chat_message
+from chat.attachment_store import media_path, store_file, url_to_path
+from chat.media import transcode_voice, voice_waveform, waveform_from_samples
 from chat.models import ChatMessage, ChatMessageEditLog, ChatMessageReport
+from chat.partitions import (
+    ARCHIVE_CACHE_KEY, DEFAULT_PARTITION, add_months, archive_partitions, convert_to_partitioned,
+    create_future_partitions, current_month, partition_name)
+from chat.tasks import transcode_voice_message
+from core.utils.general_data import VOICE_WAVEFORM_POINTS
+
+
+@pytest.fixture
+def partitioned_chat_messages(settings):
+    # table changes are rolled back with the test transaction, cached archive state has to be too
+    settings.CHAT_ARCHIVE_TABLESPACE = ""
+    yield convert_to_partitioned
+    cache.delete(ARCHIVE_CACHE_KEY)
 
 
 @pytest.mark.django_db
@@ -26,6 +54,102 @@ class TestChatMessage:
         )
         assert response.status_code == 200
 
+    def test_chat_message_history_pages(self, api_client, auth_headers, user_obj, user_obj2, chat_room_obj):
+        messages = [
+            ChatMessage.objects.create(
+                sender=user_obj2, receiver=user_obj, room=chat_room_obj,
+                message_text=f"message {number}", message_type='text'
+            )
+            for number in range(15)
+        ]
+
+        response = api_client.get(
+            f"{self.api_end}?room_id={chat_room_obj.id}",
+            HTTP_AUTHORIZATION=auth_headers,
+        )
+        assert [message['id'] for message in response.data['results']] == [message.id for message in messages[:4:-1]]
+        assert response.data['pagination']['has_older'] == True
+        assert response.data['pagination']['has_newer'] == False
+
+        response = api_client.get(
+            f"{self.api_end}?room_id={chat_room_obj.id}&before={response.data['pagination']['before']}",
+            HTTP_AUTHORIZATION=auth_headers,
+        )
+        assert [message['id'] for message in response.data['results']] == [message.id for message in messages[4::-1]]
+        assert response.data['pagination']['has_older'] == False
+
+        response = api_client.get(
+            f"{self.api_end}?room_id={chat_room_obj.id}&after={messages[4].id}&page_size=3",
+            HTTP_AUTHORIZATION=auth_headers,
+        )
+        assert [message['id'] for message in response.data['results']] == [message.id for message in messages[7:4:-1]]
+        assert response.data['pagination']['has_newer'] == True
+
+    def test_chat_message_history_continues_into_archive(
+        self, api_client, auth_headers, user_obj, user_obj2, chat_room_obj, partitioned_chat_messages
+    ):
+        old = timezone.now() - timedelta(days=800)
+        messages = [
+            ChatMessage.objects.create(
+                sender=user_obj2, receiver=user_obj, room=chat_room_obj,
+                message_text=f"message {number}", message_type='text',
+                created=old + timedelta(minutes=number) if number < 3 else timezone.now()
+            )
+            for number in range(6)
+        ]
+
+        partitioned_chat_messages()
+        assert archive_partitions(older_than_months=12) == [partition_name(old.date().replace(day=1))]
+        assert not ChatMessage.objects.filter(id=messages[0].id).exists()
+
+        response = api_client.get(
+            f"{self.api_end}?room_id={chat_room_obj.id}&page_size=4",
+            HTTP_AUTHORIZATION=auth_headers,
+        )
+        assert [message['id'] for message in response.data['results']] == [message.id for message in messages[:1:-1]]
+
+        response = api_client.get(
+            f"{self.api_end}?room_id={chat_room_obj.id}&page_size=4&before={response.data['pagination']['before']}",
+            HTTP_AUTHORIZATION=auth_headers,
+        )
+        assert [message['id'] for message in response.data['results']] == [message.id for message in messages[1::-1]]
+        assert response.data['pagination']['has_older'] == False
+
+        response = api_client.get(
+            f"{self.api_end}?room_id={chat_room_obj.id}&page_size=2&after={messages[1].id}",
+            HTTP_AUTHORIZATION=auth_headers,
+        )
+        assert [message['id'] for message in response.data['results']] == [message.id for message in messages[3:1:-1]]
+
+    def test_chat_message_without_month_partition_is_moved(
+        self, user_obj, user_obj2, chat_room_obj, partitioned_chat_messages
+    ):
+        partitioned_chat_messages(months_ahead=0)
+        later = timezone.now() + timedelta(days=100)  # partitions weren't created in time
+        message = ChatMessage.objects.create(
+            sender=user_obj2, receiver=user_obj, room=chat_room_obj,
+            message_text="hello", message_type='text', created=later
+        )
+
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT count(*) FROM "{DEFAULT_PARTITION}"')
+            assert cursor.fetchone()[0] == 1
+
+        assert partition_name(add_months(current_month(), 1)) in create_future_partitions(months_ahead=1)
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT count(*) FROM "{DEFAULT_PARTITION}"')
+            assert cursor.fetchone()[0] == 0
+            cursor.execute(f'SELECT count(*) FROM "{partition_name(later.date().replace(day=1))}"')
+            assert cursor.fetchone()[0] == 1
+        assert ChatMessage.objects.filter(id=message.id).exists()
+
+    def test_chat_message_history_with_invalid_cursor(self, api_client, auth_headers, chat_room_obj):
+        response = api_client.get(
+            f"{self.api_end}?room_id={chat_room_obj.id}&before=999999",
+            HTTP_AUTHORIZATION=auth_headers,
+        )
+        assert response.status_code == 400
+
     def test_chat_message_post(self, api_client, auth_headers, chat_room_obj):
         response = api_client.post(
             f"{self.api_end}",
@@ -84,3 +208,136 @@ class TestChatMessageReport:
         )
         assert chat_message_edit_log.__str__() == chat_message_obj.__str__()
 
+
+# messages are made by the consumer helpers on the db pool threads, they have to be committed
+@pytest.mark.django_db(transaction=True)
+class TestChatMessageSearch:
+
+    api_end = '/chat/messages/'
+
+    def test_chat_message_search(self, api_client, auth_headers, user_obj, user_obj2, user_obj3, chat_room_obj, chat_room_obj3):
+        create_message = async_to_sync(create_chat_message)
+        found = create_message(chat_room_obj, user_obj2, "the blue bicycle is ready", [], None)
+        create_message(chat_room_obj, user_obj2, "see you tomorrow", [], None)
+        deleted = create_message(chat_room_obj, user_obj2, "blue paint", [], None)
+        async_to_sync(delete_chat_message)(user_obj2, chat_room_obj, deleted.id)
+        create_message(chat_room_obj3, user_obj2, "blue car", [], None)  # room of other users
+
+        response = api_client.get(f"{self.api_end}search/?q=blue", HTTP_AUTHORIZATION=auth_headers)
+
+        assert response.status_code == 200
+        assert [message['id'] for message in response.data['results']] == [found.id]
+        assert response.data['results'][0]['headline'] == "the <b>blue</b> bicycle is ready"
+
+    def test_chat_message_search_pages(self, api_client, auth_headers, user_obj2, chat_room_obj):
+        create_message = async_to_sync(create_chat_message)
+        messages = [create_message(chat_room_obj, user_obj2, f"order number {number}", [], None) for number in range(25)]
+
+        response = api_client.get(f"{self.api_end}search/?q=order", HTTP_AUTHORIZATION=auth_headers)
+        next_page = api_client.get(
+            f"{self.api_end}search/?q=order&before={response.data['pagination']['before']}",
+            HTTP_AUTHORIZATION=auth_headers,
+        )
+
+        # equal ranks are ordered by id
+        ids = [message['id'] for message in response.data['results'] + next_page.data['results']]
+        assert ids == [message.id for message in reversed(messages)]
+        assert next_page.data['pagination']['has_older'] == False
+
+    def test_chat_message_search_pages_with_tied_ranks(self, api_client, auth_headers, user_obj2, chat_room_obj):
+        create_message = async_to_sync(create_chat_message)
+        messages = [create_message(chat_room_obj, user_obj2, "order", [], None) for _ in range(5)]
+
+        ids = []
+        endpoint = f"{self.api_end}search/?q=order&page_size=2"
+        for _ in range(len(messages)):  # a repeated page would never end
+            response = api_client.get(endpoint, HTTP_AUTHORIZATION=auth_headers)
+            ids += [message['id'] for message in response.data['results']]
+            if not response.data['pagination']['has_older']:
+                break
+            endpoint = f"{self.api_end}search/?q=order&page_size=2&before={response.data['pagination']['before']}"
+
+        # every page has the same rank, rows are ordered by id
+        assert ids == [message.id for message in reversed(messages)]
+
+    def test_chat_message_search_text_required(self, api_client, auth_headers):
+        response = api_client.get(f"{self.api_end}search/?q=", HTTP_AUTHORIZATION=auth_headers)
+
+        assert response.status_code == 400
+
+    @pytest.mark.skipif(not os.environ.get("CHAT_SEARCH_BENCHMARK"), reason="set CHAT_SEARCH_BENCHMARK=1 to run")
+    def test_chat_message_search_benchmark(self, api_client, auth_headers, user_obj, user_obj2, chat_room_obj):
+        """Search over a million seeded messages uses the gin index and answers in milliseconds"""
+
+        words = ['invoice', 'garden', 'plumber', 'kitchen', 'painting', 'delivery', 'window', 'roof']
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO {ChatMessage._meta.db_table}
+                    (created, modified, uuid, sender_id, receiver_id, room_id, message_text,
+                     message_type, is_deleted, seq, search_vector)
+                SELECT now(), now(), md5(n::text)::uuid, %s, %s, %s, text, 'text', false, n,
+                       to_tsvector('simple', text)
+                FROM (
+                    SELECT n, (%s::text[])[1 + n %% 8] || ' ' || (%s::text[])[1 + (n / 8) %% 8] || ' number ' || n AS text
+                    FROM generate_series(1, 1000000) AS n
+                ) AS seed
+                """,
+                [user_obj2.id, user_obj.id, chat_room_obj.id, words, words],
+            )
+            cursor.execute(f"ANALYZE {ChatMessage._meta.db_table}")
+
+        started_at = time.perf_counter()
+        response = api_client.get(f"{self.api_end}search/?q=number 424242", HTTP_AUTHORIZATION=auth_headers)
+        elapsed = time.perf_counter() - started_at
+
+        assert response.status_code == 200
+        assert response.data['results'][0]['message_text'].endswith("number 424242")
+        assert elapsed < 0.5
+
+
+def write_wav(path, seconds=1, rate=8000):
+    """Writes a 16 bit mono WAV file whose loudness grows"""
+
+    samples = array.array("h", (int(30000 * n / (seconds * rate)) * (1 if n % 2 else -1) for n in range(seconds * rate)))
+    with wave.open(str(path), "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(rate)
+        wav_file.writeframes(samples.tobytes())
+
+
+class TestVoiceTranscoding:
+
+    def test_waveform_from_samples(self):
+        samples = array.array("h", [0, 100, -200, 50, 400, -400, 10, 20])
+
+        assert waveform_from_samples(samples, points=4) == [25, 50, 100, 5]
+        assert waveform_from_samples(array.array("h"), points=4) == []
+
+    def test_waveform_of_wav_without_ffmpeg(self, settings, tmp_path):
+        settings.FFMPEG_BINARY = str(tmp_path / "missing-ffmpeg")
+        write_wav(tmp_path / "voice.wav")
+
+        waveform = voice_waveform(str(tmp_path / "voice.wav"))
+
+        assert len(waveform) == VOICE_WAVEFORM_POINTS
+        assert waveform[-1] == 100 and waveform[0] < waveform[-1]
+        assert transcode_voice(str(tmp_path / "voice.wav")) is None  # voice is kept as it is
+
+    @pytest.mark.django_db(transaction=True)
+    @pytest.mark.skipif(not shutil.which("ffmpeg"), reason="ffmpeg isn't installed")
+    def test_voice_message_is_transcoded_to_opus(self, settings, tmp_path, chat_room_obj, user_obj):
+        settings.MEDIA_ROOT = str(tmp_path)
+        write_wav(tmp_path / "voice.wav", seconds=3)
+        with open(tmp_path / "voice.wav", "rb") as file:
+            voice = store_file(File(file, name="voice.wav"), f"{chat_room_obj.uuid}/")
+        message = async_to_sync(create_chat_message)(chat_room_obj, user_obj, None, [], voice)
+
+        transcode_voice_message(message.id)
+
+        message.refresh_from_db()
+        assert message.voice.endswith(".ogg")
+        assert len(message.voice_waveform) == VOICE_WAVEFORM_POINTS
+        assert os.path.getsize(media_path(url_to_path(message.voice))) < os.path.getsize(tmp_path / "voice.wav")
+        assert not os.path.exists(media_path(url_to_path(voice)))  # wav file is released
@@ -1,6 +1,14 @@
+from unittest.mock import patch
+
 import pytest
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
-from chat.models import ChatRoom, ChatRoomBlockLog
+from chat.consumers import create_chat_message, update_chat_message, delete_chat_message
+from chat.models import ChatMessage, ChatRoom, ChatRoomBlockLog
 
 
 @pytest.mark.django_db
@@ -43,6 +51,162 @@ class TestChatRoom:
 
         assert response.status_code == 200
 
+    # messages are made on the db pool threads, their connections only see committed rows
+    @pytest.mark.django_db(transaction=True)
+    def test_chat_room_inbox_summary(self, chat_room_obj, user_obj, user_obj2):
+        message = async_to_sync(create_chat_message)(chat_room_obj, user_obj2, "hello", [], None)
+        chat_room_obj.refresh_from_db()
+
+        assert chat_room_obj.last_message_id == message.id
+        assert chat_room_obj.last_message_preview == "hello"
+        assert chat_room_obj.get_unread_count(user_obj) == 1
+        assert chat_room_obj.get_unread_count(user_obj2) == 0
+
+        async_to_sync(update_chat_message)(user_obj2, "hello there", message.id)
+        chat_room_obj.refresh_from_db()
+        assert chat_room_obj.last_message_preview == "hello there"
+
+        async_to_sync(delete_chat_message)(user_obj2, chat_room_obj, message.id)
+        chat_room_obj.refresh_from_db()
+        assert chat_room_obj.last_message_preview is None
+
+    @pytest.mark.django_db(transaction=True)
+    def test_chat_room_list_single_query(self, api_client, auth_headers, chat_room_obj, user_obj2):
+        async_to_sync(create_chat_message)(chat_room_obj, user_obj2, "hello", [], None)
+        api_client.get(f"{self.api_end}", HTTP_AUTHORIZATION=auth_headers)  # warm up auth lookups
+
+        with CaptureQueriesContext(connection) as queries:
+            response = api_client.get(f"{self.api_end}", HTTP_AUTHORIZATION=auth_headers)
+
+        room_queries = [query for query in queries if '"chat_chatmessage"' in query['sql']]
+        room = response.data['results'][0]
+
+        assert response.status_code == 200
+        assert room_queries == []
+        assert room['last_message']['preview'] == "hello"
+        assert room['unread_count'] == 1
+
+    @pytest.mark.django_db(transaction=True)
+    def test_chat_room_is_not_read_by_history(self, api_client, auth_headers, chat_room_obj, user_obj, user_obj2):
+        async_to_sync(create_chat_message)(chat_room_obj, user_obj2, "hello", [], None)
+
+        with patch("chat.tasks.send_read_receipt.apply_async") as send_read_receipt:
+            response = api_client.get(
+                f"/chat/messages/?room_id={chat_room_obj.id}", HTTP_AUTHORIZATION=auth_headers
+            )
+        chat_room_obj.refresh_from_db()
+
+        assert response.status_code == 200
+        assert chat_room_obj.get_unread_count(user_obj) == 1  # only 'mark_read' moves the watermark
+        assert not send_read_receipt.called
+
+    @pytest.mark.django_db(transaction=True)
+    def test_chat_room_mark_read(self, api_client, auth_headers, chat_room_obj, user_obj, user_obj2):
+        create_message = async_to_sync(create_chat_message)
+        first = create_message(chat_room_obj, user_obj2, "hello", [], None)
+        create_message(chat_room_obj, user_obj2, "are you there?", [], None)
+        cache.delete(f"chat_read_receipt:{chat_room_obj.id}:{user_obj.id}")
+
+        with patch("chat.tasks.send_read_receipt.apply_async") as send_read_receipt:
+            response = api_client.post(
+                f"{self.api_end}mark_read/{chat_room_obj.id}/", {"message_id": first.id},
+                HTTP_AUTHORIZATION=auth_headers,
+            )
+            # coalesced with the previous receipt
+            api_client.post(f"{self.api_end}mark_read/{chat_room_obj.id}/", HTTP_AUTHORIZATION=auth_headers)
+
+        chat_room_obj.refresh_from_db()
+
+        assert response.status_code == 200
+        assert send_read_receipt.call_count == 1
+        assert chat_room_obj.get_unread_count(user_obj) == 0
+        assert chat_room_obj.get_unread_count(user_obj2) == 0  # sender has read own messages
+
+    @pytest.mark.django_db(transaction=True)
+    def test_chat_room_mark_read_backwards(self, chat_room_obj, user_obj, user_obj2):
+        create_message = async_to_sync(create_chat_message)
+        first = create_message(chat_room_obj, user_obj2, "hello", [], None)
+        second = create_message(chat_room_obj, user_obj2, "are you there?", [], None)
+
+        assert chat_room_obj.mark_as_read(user_obj, second.id) == True
+        assert chat_room_obj.mark_as_read(user_obj, first.id) == False  # watermark only moves forward
+
+        chat_room_obj.refresh_from_db()
+        assert chat_room_obj.get_last_read_message_id(user_obj) == second.id
+        assert (first.seq, second.seq) == (1, 2)
+
+    @pytest.mark.django_db(transaction=True)
+    def test_chat_room_rebuild_keeps_unread_count(self, chat_room_obj, user_obj, user_obj2):
+        create_message = async_to_sync(create_chat_message)
+        first = create_message(chat_room_obj, user_obj2, "hello", [], None)
+        second = create_message(chat_room_obj, user_obj2, "are you there?", [], None)
+        create_message(chat_room_obj, user_obj2, "hi?", [], None)
+        chat_room_obj.mark_as_read(user_obj, second.id)
+
+        ChatMessage.objects.filter(id=first.id).delete()  # e.g. retention
+        unnumbered = ChatMessage.objects.create(sender=user_obj2, receiver=user_obj, room=chat_room_obj, message_type='text')
+
+        chat_room_obj.rebuild_inbox_summary()
+        chat_room_obj.refresh_from_db()
+        unnumbered.refresh_from_db()
+
+        assert unnumbered.seq == 4
+        assert chat_room_obj.message_seq == 4
+        assert chat_room_obj.get_unread_count(user_obj) == 2
+
+    @pytest.mark.django_db(transaction=True)
+    def test_merge_duplicate_chat_rooms_keeps_unread_count(self, chat_room_obj, user_obj, user_obj2):
+        create_message = async_to_sync(create_chat_message)
+        create_message(chat_room_obj, user_obj2, "hello", [], None)
+        second = create_message(chat_room_obj, user_obj2, "are you there?", [], None)
+        chat_room_obj.mark_as_read(user_obj, second.id)
+
+        # room made before the member pair, members are in the other order
+        ChatRoom.objects.filter(id=chat_room_obj.id).update(low_user_id=None, high_user_id=None)
+        duplicate = ChatRoom.objects.create(room_member_1=user_obj2, room_member_2=user_obj)
+        create_message(duplicate, user_obj2, "hi?", [], None)
+
+        call_command("merge_duplicate_chat_rooms")
+        chat_room_obj.refresh_from_db()
+
+        assert not ChatRoom.objects.filter(id=duplicate.id).exists()
+        assert chat_room_obj.message_seq == 3
+        assert chat_room_obj.get_unread_count(user_obj) == 1
+        assert chat_room_obj.get_unread_count(user_obj2) == 0
+
+    @pytest.mark.django_db(transaction=True)
+    def test_merge_duplicate_chat_rooms_keeps_unread_messages_of_other_room(self, chat_room_obj, user_obj, user_obj2):
+        create_message = async_to_sync(create_chat_message)
+        create_message(chat_room_obj, user_obj2, "hello", [], None)  # never read
+
+        ChatRoom.objects.filter(id=chat_room_obj.id).update(low_user_id=None, high_user_id=None)
+        duplicate = ChatRoom.objects.create(room_member_1=user_obj2, room_member_2=user_obj)
+        newer = create_message(duplicate, user_obj2, "hi?", [], None)
+        duplicate.mark_as_read(user_obj, newer.id)
+
+        call_command("merge_duplicate_chat_rooms")
+        chat_room_obj.refresh_from_db()
+
+        assert chat_room_obj.get_unread_count(user_obj) == 2  # older unread message keeps the newer one unread
+        assert chat_room_obj.get_unread_count(user_obj2) == 0
+
+    def test_chat_room_unread_count_is_not_negative(self, chat_room_obj, user_obj):
+        chat_room_obj.last_read_seq_member_1 = chat_room_obj.message_seq + 5
+
+        assert chat_room_obj.get_unread_count(chat_room_obj.room_member_1) == 0
+
+    @pytest.mark.django_db(transaction=True)
+    def test_chat_room_unread_count(self, api_client, auth_headers, chat_room_obj, user_obj2):
+        create_message = async_to_sync(create_chat_message)
+        create_message(chat_room_obj, user_obj2, "hello", [], None)
+        create_message(chat_room_obj, user_obj2, "are you there?", [], None)
+
+        response = api_client.get(f"{self.api_end}unread_count/", HTTP_AUTHORIZATION=auth_headers)
+
+        assert response.status_code == 200
+        assert response.data["total"] == 2
+        assert response.data["rooms"] == [{"room_id": chat_room_obj.id, "unread_count": 2}]
+
     def test_chat_room_post(self, api_client, auth_headers):
         response = api_client.post(
             f"{self.api_end}",
@@ -113,6 +277,22 @@ class TestChatRoom:
         )
         assert response.status_code == 200
 
+    def test_get_or_create_for_members_in_any_order(self, user_obj1, user_obj2):
+        room = ChatRoom.objects.get_or_create_for_members(user_obj1, user_obj2)
+
+        assert ChatRoom.objects.get_or_create_for_members(user_obj2, user_obj1) == room
+        assert ChatRoom.objects.get_for_members(user_obj2, user_obj1) == room
+        assert (room.low_user_id, room.high_user_id) == tuple(sorted((user_obj1.id, user_obj2.id)))
+        assert ChatRoom.objects.count() == 1
+
+    def test_member_pair_insert_conflict_is_ignored(self, user_obj1, user_obj2):
+        room = ChatRoom.objects.create(room_member_1=user_obj1, room_member_2=user_obj2)
+
+        # concurrent creator of the same room inserts nothing
+        ChatRoom.objects.bulk_create([ChatRoom(room_member_1=user_obj2, room_member_2=user_obj1)], ignore_conflicts=True)
+
+        assert list(ChatRoom.objects.all()) == [room]
+
     def test_user_and_partner_single_room_info_with_invalid_username(self, api_client, auth_headers):
         response = api_client.get(
             f"/chat/k/test-user-invalid/",
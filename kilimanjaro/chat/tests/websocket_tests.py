@@ -1,8 +1,29 @@
+import asyncio
+import json
+import time
+import uuid
+from unittest.mock import patch
+
 import pytest
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.core.cache import cache
+from django.db import connection
+from django.db.backends.utils import CursorWrapper
+from redis.exceptions import RedisError
 
 from .test_gn_data import (GREATHER_THAN_2MIN_AUDIO_FILE, VOICE_STRING_FILE, 
     IMAGE_STRING_FILE, GREATHER_THAN_5_MB_FILE)
-from core.utils.general_data import MAX_VOICE_MESSAGE_FOR_PER_CHATTING_ROOM
+from chat import event_log, presence, voice_quota
+from chat.consumers import ChatConsumer, get_room_or_error
+from chat.models import ChatMessage
+from core.utils.executors import BoundedExecutor, ExecutorBusy, database_pool_to_async
+from kilimanjaro.asgi import application
+from chat.tasks import send_read_receipt
+from chat.utils import add_send_by, room_event, send_room_state, typing_throttle_key
+from core.utils.general_data import (MAX_VOICE_MESSAGE_FOR_PER_CHATTING_ROOM, MAX_CHUNKED_UPLOAD_SIZE, TYPING_EXPIRES_IN,
+    SERVER_BUSY_CLOSE_CODE)
+from core.utils.general_func import file_object
 
 
 @pytest.mark.django_db(transaction=True)
@@ -244,7 +265,8 @@ async def test_send_attachment_and_text_message(ws_communicator2, ws_chat_room1)
 
 @pytest.mark.django_db(transaction=True)
 @pytest.mark.asyncio
-async def test_send_voice_message(ws_communicator, ws_chat_room1):
+async def test_send_voice_message(ws_communicator, ws_chat_room1, ws_user1):
+    await database_sync_to_async(reset_voice_counter)(ws_chat_room1, ws_user1)
 
     await ws_communicator.connect()
 
@@ -443,7 +465,8 @@ async def test_try_to_delete_message_with_invalid_msg_id(ws_communicator, ws_cha
 
 @pytest.mark.django_db(transaction=True)
 @pytest.mark.asyncio
-async def test_send_max_limit_voice_message(ws_communicator, ws_chat_room1):
+async def test_send_max_limit_voice_message(ws_communicator, ws_chat_room1, ws_user1):
+    await database_sync_to_async(reset_voice_counter)(ws_chat_room1, ws_user1)
 
     await ws_communicator.connect()
 
@@ -464,3 +487,662 @@ async def test_send_max_limit_voice_message(ws_communicator, ws_chat_room1):
     assert response.get('message') == 'You already cross your voice send limit'
 
     await ws_communicator.disconnect()
+
+
+def reset_voice_counter(room, user):
+    presence.get_redis().delete(voice_quota.counter_key(room.id, user.id))
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_voice_limit_is_checked_before_reading_file(ws_communicator, ws_chat_room1, ws_user1):
+    await database_sync_to_async(reset_voice_counter)(ws_chat_room1, ws_user1)
+    presence.get_redis().set(voice_quota.counter_key(ws_chat_room1.id, ws_user1.id), MAX_VOICE_MESSAGE_FOR_PER_CHATTING_ROOM)
+
+    await ws_communicator.connect()
+
+    with patch("chat.consumers.read_voice_file") as read_voice_file:
+        await ws_communicator.send_json_to(
+            {
+                "command": "send_message",
+                "room_id": ws_chat_room1.id,
+                "voice_file": VOICE_STRING_FILE,
+            }
+        )
+        response = await ws_communicator.receive_json_from()
+
+    assert response.get('message') == 'You already cross your voice send limit'
+    assert not read_voice_file.called
+
+    await ws_communicator.disconnect()
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_rejected_voice_message_releases_its_slot(ws_communicator, ws_chat_room1, ws_user1):
+    await database_sync_to_async(reset_voice_counter)(ws_chat_room1, ws_user1)
+
+    await ws_communicator.connect()
+    await ws_communicator.send_json_to(
+        {
+            "command": "send_message",
+            "room_id": ws_chat_room1.id,
+            "voice_file": GREATHER_THAN_2MIN_AUDIO_FILE,
+        }
+    )
+    await ws_communicator.receive_json_from()
+    await ws_communicator.disconnect()
+
+    assert int(presence.get_redis().get(voice_quota.counter_key(ws_chat_room1.id, ws_user1.id))) == 0
+
+
+@pytest.mark.django_db(transaction=True)
+def test_reconcile_voice_counters(chat_room_obj, user_obj):
+    ChatMessage.objects.create(room=chat_room_obj, sender=user_obj, receiver=chat_room_obj.room_member_2,
+        message_type='voice', voice='/media/voice.mp3')
+    key = voice_quota.counter_key(chat_room_obj.id, user_obj.id)
+    presence.get_redis().set(key, 7)  # drifted counter
+
+    voice_quota.reconcile_counters()
+
+    assert int(presence.get_redis().get(key)) == 1
+
+
+async def upload_file_in_chunks(communicator, upload_type, file_name, file_content):
+    """Uploads file by binary frames and returns upload id"""
+
+    await communicator.send_json_to(
+        {
+            "command": "upload_begin",
+            "upload_type": upload_type,
+            "file_name": file_name,
+            "file_size": len(file_content),
+        }
+    )
+    response = await communicator.receive_json_from()
+    assert response.get('response_type') == 'upload_ready'
+
+    upload_id = response.get('upload_id')
+    chunk_size = response.get('chunk_size')
+    for start in range(0, len(file_content), chunk_size):
+        await communicator.send_to(bytes_data=uuid.UUID(upload_id).bytes + file_content[start:start + chunk_size])
+
+    await communicator.send_json_to({"command": "upload_commit", "upload_id": upload_id})
+    response = await communicator.receive_json_from()
+    assert response.get('response_type') == 'upload_complete'
+
+    return upload_id
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_send_chunked_attachment_message(ws_communicator, ws_chat_room1):
+
+    await ws_communicator.connect()
+
+    upload_id = await upload_file_in_chunks(ws_communicator, "attachment", "photo.png", file_object(name="photo.png").read())
+
+    # sends uploaded attachment
+    await ws_communicator.send_json_to(
+        {
+            "command": "send_message",
+            "room_id": ws_chat_room1.id,
+            "text_message": "photo",
+            "attachment_upload_ids": [upload_id]
+        }
+    )
+    response = await ws_communicator.receive_json_from()
+    assert response.get('response_type') == 'new_message'
+    assert len(response.get('attachment_links')) == 1
+
+    await ws_communicator.disconnect()
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_try_to_send_message_with_uncommitted_upload(ws_communicator, ws_chat_room1):
+
+    await ws_communicator.connect()
+
+    await ws_communicator.send_json_to(
+        {
+            "command": "upload_begin",
+            "upload_type": "attachment",
+            "file_name": "photo.png",
+            "file_size": 100,
+        }
+    )
+    response = await ws_communicator.receive_json_from()
+
+    await ws_communicator.send_json_to(
+        {
+            "command": "send_message",
+            "room_id": ws_chat_room1.id,
+            "attachment_upload_ids": [response.get('upload_id')]
+        }
+    )
+    response = await ws_communicator.receive_json_from()
+    assert response.get('response_type') == 'Error'
+    assert response.get('message') == 'Invalid upload ID!'
+
+    await ws_communicator.disconnect()
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_try_to_upload_more_than_declared_file_size(ws_communicator):
+
+    await ws_communicator.connect()
+
+    await ws_communicator.send_json_to(
+        {
+            "command": "upload_begin",
+            "upload_type": "attachment",
+            "file_name": "photo.png",
+            "file_size": 10,
+        }
+    )
+    response = await ws_communicator.receive_json_from()
+
+    await ws_communicator.send_to(bytes_data=uuid.UUID(response.get('upload_id')).bytes + b"x" * 11)
+    response = await ws_communicator.receive_json_from()
+    assert response.get('response_type') == 'Error'
+    assert response.get('message') == 'Upload is larger than the declared file size'
+
+    await ws_communicator.disconnect()
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_try_to_begin_too_large_upload(ws_communicator):
+
+    await ws_communicator.connect()
+
+    await ws_communicator.send_json_to(
+        {
+            "command": "upload_begin",
+            "upload_type": "voice",
+            "file_name": "voice.mp3",
+            "file_size": MAX_CHUNKED_UPLOAD_SIZE + 1,
+        }
+    )
+    response = await ws_communicator.receive_json_from()
+    assert response.get('response_type') == 'Error'
+    assert response.get('message') == 'File is too large'
+
+    await ws_communicator.disconnect()
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_joined_room_is_not_fetched_again(ws_communicator, ws_chat_room1):
+
+    fetched_room_ids = []
+
+    async def fetch_room(room_id, user):
+        fetched_room_ids.append(room_id)
+        return await get_room_or_error(room_id, user)
+
+    await ws_communicator.connect()
+
+    with patch("chat.consumers.get_room_or_error", fetch_room):
+        for text_message in ("hi", "hello"):
+            await ws_communicator.send_json_to(
+                {
+                    "command": "send_message",
+                    "room_id": ws_chat_room1.id,
+                    "text_message": text_message
+                }
+            )
+            response = await ws_communicator.receive_json_from()
+            assert response.get('response_type') == 'new_message'
+
+    assert fetched_room_ids == [ws_chat_room1.id]
+
+    await ws_communicator.disconnect()
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_least_recently_used_room_is_left(ws_communicator, ws_chat_room1, ws_chat_room2):
+
+    await ws_communicator.connect()
+
+    with patch("chat.consumers.MAX_JOINED_ROOMS_PER_CONNECTION", 1):
+        for room in (ws_chat_room1, ws_chat_room2):
+            await ws_communicator.send_json_to({"command": "join", "room_id": room.id})
+
+        # typing is allowed for joined rooms only
+        await ws_communicator.send_json_to({"command": "typing", "room_id": ws_chat_room1.id})
+        response = await ws_communicator.receive_json_from()
+        assert response.get('message') == 'Invalid Room ID!'
+
+    await ws_communicator.disconnect()
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_leave_room(ws_communicator, ws_chat_room1):
+
+    await ws_communicator.connect()
+
+    await ws_communicator.send_json_to({"command": "join", "room_id": ws_chat_room1.id})
+    await ws_communicator.send_json_to({"command": "leave", "room_id": ws_chat_room1.id})
+
+    await ws_communicator.send_json_to({"command": "typing", "room_id": ws_chat_room1.id})
+    response = await ws_communicator.receive_json_from()
+    assert response.get('message') == 'Invalid Room ID!'
+
+    await ws_communicator.disconnect()
+
+
+@database_sync_to_async
+def block_room_by_member_2(room):
+    room.is_blocked_by_member_2 = True
+    room.save()
+    send_room_state(room)
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_blocking_room_updates_joined_room(ws_communicator, ws_chat_room1):
+
+    await ws_communicator.connect()
+
+    await ws_communicator.send_json_to({"command": "join", "room_id": ws_chat_room1.id})
+    await block_room_by_member_2(ws_chat_room1)
+    await asyncio.sleep(0.1)  # lets consumer handle the room state event
+
+    await ws_communicator.send_json_to(
+        {
+            "command": "send_message",
+            "room_id": ws_chat_room1.id,
+            "text_message": 'hi'
+        }
+    )
+    response = await ws_communicator.receive_json_from()
+    assert response.get('response_type') == 'Error'
+    assert response.get('message') == 'Chat Room is already blocked'
+
+    await ws_communicator.disconnect()
+
+
+async def connect_partners(communicator, partner_communicator):
+    """Connects both sockets, first one receives partner's online presence"""
+
+    await communicator.connect()
+    await partner_communicator.connect()
+    assert (await communicator.receive_json_from()).get('response_type') == 'presence'
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_send_by_is_added_per_recipient(ws_communicator, ws_communicator2, ws_chat_room1):
+
+    await connect_partners(ws_communicator, ws_communicator2)
+
+    await ws_communicator2.send_json_to({"command": "join", "room_id": ws_chat_room1.id})
+    await asyncio.sleep(0.1)  # lets user2 join before the message is sent
+
+    await ws_communicator.send_json_to(
+        {
+            "command": "send_message",
+            "room_id": ws_chat_room1.id,
+            "text_message": 'hi'
+        }
+    )
+    assert (await ws_communicator.receive_json_from()).get('send_by') == 'me'
+    assert (await ws_communicator2.receive_json_from()).get('send_by') == 'other'
+
+    await ws_communicator2.disconnect()
+    await ws_communicator.disconnect()
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_mark_read_sends_read_receipt(ws_communicator, ws_communicator2, ws_chat_room1, ws_user2):
+
+    await connect_partners(ws_communicator, ws_communicator2)
+
+    await ws_communicator2.send_json_to({"command": "join", "room_id": ws_chat_room1.id})
+    await asyncio.sleep(0.1)  # lets user2 join before the message is sent
+
+    await ws_communicator.send_json_to(
+        {
+            "command": "send_message",
+            "room_id": ws_chat_room1.id,
+            "text_message": 'hi'
+        }
+    )
+    await ws_communicator.receive_json_from()
+    message = await ws_communicator2.receive_json_from()
+
+    await database_sync_to_async(cache.delete)(f"chat_read_receipt:{ws_chat_room1.id}:{ws_user2.id}")
+
+    # receipt task runs right away instead of after the coalescing interval
+    with patch("chat.tasks.send_read_receipt.apply_async", lambda args, countdown: send_read_receipt(*args)):
+        await ws_communicator2.send_json_to(
+            {
+                "command": "mark_read",
+                "room_id": ws_chat_room1.id,
+                "message_id": message['id']
+            }
+        )
+        response = await ws_communicator.receive_json_from()
+
+    assert response.get('response_type') == 'read_receipt'
+    assert response.get('user_id') == ws_user2.id
+    assert response.get('last_read_message_id') == message['id']
+    assert response.get('unread_count') == 0
+
+    await ws_communicator2.disconnect()
+    await ws_communicator.disconnect()
+
+
+def reset_presence(*users):
+    redis = presence.get_redis()
+    for user in users:
+        redis.delete(presence.user_key(user.id))
+        redis.zrem(presence.ONLINE_KEY, user.id)
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_presence_is_sent_to_chat_partner(ws_communicator, ws_communicator2, ws_chat_room1, ws_user1, ws_user2):
+    await database_sync_to_async(reset_presence)(ws_user1, ws_user2)
+
+    await ws_communicator2.connect()
+    await ws_communicator.connect()
+
+    response = await ws_communicator2.receive_json_from()
+    assert response == {"response_type": "presence", "user_id": ws_user1.id, "is_online": True}
+    assert await database_sync_to_async(presence.online_users)([ws_user1.id, ws_user2.id]) == {ws_user1.id, ws_user2.id}
+
+    with patch("chat.presence.PRESENCE_OFFLINE_DELAY", 0):
+        await ws_communicator.disconnect()
+        response = await ws_communicator2.receive_json_from()
+
+    assert response == {"response_type": "presence", "user_id": ws_user1.id, "is_online": False}
+
+    await ws_communicator2.disconnect()
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_presence_of_user_with_several_sockets(ws_user1):
+    await database_sync_to_async(reset_presence)(ws_user1)
+    tracker = presence.PresenceTracker()
+
+    with patch("chat.presence.publish_presence") as publish_presence:
+        await tracker.connect(ws_user1.id, "socket-1")
+        await tracker.connect(ws_user1.id, "socket-2")
+        await tracker.disconnect(ws_user1.id, "socket-1")
+
+        assert await database_sync_to_async(presence.is_online)(ws_user1.id)
+
+        await tracker.disconnect(ws_user1.id, "socket-2")
+
+        assert not await database_sync_to_async(presence.is_online)(ws_user1.id)
+        assert publish_presence.call_count == 1  # going offline is debounced
+
+    for check in tracker.offline_checks.values():
+        check.cancel()
+    tracker.heartbeat_task.cancel()
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_typing_is_relayed_to_partner(ws_communicator, ws_communicator2, ws_chat_room1, ws_user1):
+    cache.delete(typing_throttle_key(ws_chat_room1.id, ws_user1.id))
+
+    await connect_partners(ws_communicator, ws_communicator2)
+    for communicator in (ws_communicator, ws_communicator2):
+        await communicator.send_json_to({"command": "join", "room_id": ws_chat_room1.id})
+    await asyncio.sleep(0.1)  # lets both join
+
+    # second event is throttled
+    for _ in range(2):
+        await ws_communicator.send_json_to({"command": "typing", "room_id": ws_chat_room1.id})
+
+    response = await ws_communicator2.receive_json_from()
+    assert response == {
+        "response_type": "typing", "room_id": ws_chat_room1.id,
+        "user_id": ws_user1.id, "expires_in": TYPING_EXPIRES_IN,
+    }
+    assert await ws_communicator2.receive_nothing(timeout=0.2)
+    assert await ws_communicator.receive_nothing(timeout=0.1)  # sender doesn't get own typing
+
+    await ws_communicator2.disconnect()
+    await ws_communicator.disconnect()
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_typing_is_throttled_per_user(ws_communicator, ws_communicator2, auth_token_for_user1, ws_chat_room1, ws_user1):
+    cache.delete(typing_throttle_key(ws_chat_room1.id, ws_user1.id))
+    second_tab = WebsocketCommunicator(application, "/chat/", [(b'authorization', auth_token_for_user1.encode('ascii'))])
+
+    await connect_partners(ws_communicator, ws_communicator2)
+    await second_tab.connect()
+    for communicator in (ws_communicator, second_tab, ws_communicator2):
+        await communicator.send_json_to({"command": "join", "room_id": ws_chat_room1.id})
+    await asyncio.sleep(0.1)  # lets all join
+
+    # second socket of the same user is throttled too
+    for communicator in (ws_communicator, second_tab):
+        await communicator.send_json_to({"command": "typing", "room_id": ws_chat_room1.id})
+
+    assert (await ws_communicator2.receive_json_from()).get('response_type') == 'typing'
+    assert await ws_communicator2.receive_nothing(timeout=0.2)
+
+    await second_tab.disconnect()
+    await ws_communicator2.disconnect()
+    await ws_communicator.disconnect()
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_typing_is_not_allowed_before_join(ws_communicator, ws_chat_room1):
+
+    await ws_communicator.connect()
+
+    await ws_communicator.send_json_to({"command": "typing", "room_id": ws_chat_room1.id})
+    response = await ws_communicator.receive_json_from()
+    assert response.get('message') == 'Invalid Room ID!'
+
+    await ws_communicator.disconnect()
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_typing_benchmark(ws_communicator, ws_chat_room1):
+    """A stream of typing events makes no db query and each relayed event is handled under 1ms
+
+    Throttle is disabled, so every event goes through the channel layer.
+    """
+
+    events = 500
+    durations = []
+    queries = []
+    receive_json = ChatConsumer.receive_json
+
+    async def timed_receive_json(consumer, content):
+        started_at = time.perf_counter()
+        await receive_json(consumer, content)
+        if content.get('command') == 'typing':
+            durations.append(time.perf_counter() - started_at)
+
+    execute_with_wrappers = CursorWrapper._execute_with_wrappers
+
+    def counted_execute_with_wrappers(cursor, sql, *args):
+        queries.append(sql)
+        return execute_with_wrappers(cursor, sql, *args)
+
+    relayed = []
+
+    async def counted_typing_indicator(consumer, event):
+        relayed.append(event)  # sender's socket is in the room group too
+
+    await ws_communicator.connect()
+    await ws_communicator.send_json_to({"command": "join", "room_id": ws_chat_room1.id})
+    await asyncio.sleep(0.1)  # join is the only db access
+
+    with patch.object(ChatConsumer, "receive_json", timed_receive_json), \
+            patch.object(CursorWrapper, "_execute_with_wrappers", counted_execute_with_wrappers), \
+            patch("chat.consumers.TYPING_THROTTLE_INTERVAL", 0), \
+            patch.object(ChatConsumer, "typing_indicator", counted_typing_indicator):
+        for _ in range(events):
+            await ws_communicator.send_json_to({"command": "typing", "room_id": ws_chat_room1.id})
+
+        async def handled_all():
+            while len(durations) < events or len(relayed) < events:
+                await asyncio.sleep(0.01)
+        await asyncio.wait_for(handled_all(), timeout=10)
+
+    assert queries == []
+    assert len(relayed) == events  # every event went through the channel layer
+    assert sum(durations) / events < 0.001
+
+    await ws_communicator.disconnect()
+
+
+def reset_room_event_log(room):
+    presence.get_redis().delete(event_log.events_key(room.id))
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_resume_replays_missed_events(ws_communicator, ws_chat_room1):
+    await database_sync_to_async(reset_room_event_log)(ws_chat_room1)
+
+    await ws_communicator.connect()
+
+    seqs = []
+    for text_message in ("hi", "hello"):
+        await ws_communicator.send_json_to(
+            {
+                "command": "send_message",
+                "room_id": ws_chat_room1.id,
+                "text_message": text_message
+            }
+        )
+        seqs.append((await ws_communicator.receive_json_from())['seq'])
+
+    assert seqs == [1, 2]
+
+    await ws_communicator.send_json_to({"command": "resume", "room_id": ws_chat_room1.id, "last_seq": 1})
+
+    response = await ws_communicator.receive_json_from()
+    assert response.get('response_type') == 'new_message'
+    assert response.get('text_message') == 'hello'
+    assert response.get('send_by') == 'me'
+
+    response = await ws_communicator.receive_json_from()
+    assert response == {"response_type": "resumed", "room_id": ws_chat_room1.id, "seq": 2, "has_more": False}
+
+    await ws_communicator.disconnect()
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_resume_reports_gap(ws_communicator, ws_chat_room1):
+    await database_sync_to_async(reset_room_event_log)(ws_chat_room1)
+
+    await ws_communicator.connect()
+
+    # client has sequence of a log that doesn't exist anymore
+    await ws_communicator.send_json_to({"command": "resume", "room_id": ws_chat_room1.id, "last_seq": 5})
+
+    response = await ws_communicator.receive_json_from()
+    assert response == {"response_type": "resume_gap", "room_id": ws_chat_room1.id, "seq": 0}
+
+    await ws_communicator.disconnect()
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_event_is_sent_when_it_can_not_be_logged(ws_communicator, ws_chat_room1):
+    await ws_communicator.connect()
+
+    with patch("chat.consumers.log_room_event", side_effect=RedisError("log is down")):
+        await ws_communicator.send_json_to(
+            {
+                "command": "send_message",
+                "room_id": ws_chat_room1.id,
+                "text_message": "hi"
+            }
+        )
+        response = await ws_communicator.receive_json_from()
+
+    assert response.get('response_type') == 'new_message'
+    assert 'seq' not in response  # 'resume' reports a gap
+
+    await ws_communicator.disconnect()
+
+
+def slow_get_room_or_error(room_id, user):
+    """Room lookup behind a 50ms query"""
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_sleep(0.05)")
+    return get_room_or_error.__wrapped__(room_id, user)
+
+
+async def resume_storm(communicators, room, pool_size):
+    """Returns seconds taken by the first room lookup of every socket with a db pool of 'pool_size'"""
+
+    executor = BoundedExecutor(f"test_db_executor_{pool_size}", max_workers=pool_size, max_queue=100)
+
+    with patch("core.utils.executors.db_executor", executor), \
+            patch("chat.consumers.get_room_or_error", database_pool_to_async(slow_get_room_or_error)):
+        started_at = time.perf_counter()
+        for communicator in communicators:
+            await communicator.send_json_to({"command": "resume", "room_id": room.id, "last_seq": 0})
+        for communicator in communicators:
+            assert (await communicator.receive_json_from(timeout=5)).get('response_type') in ('resumed', 'resume_gap')
+        return time.perf_counter() - started_at
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_db_pool_benchmark(auth_token_for_user1, ws_chat_room1):
+    """Throughput of db bound websocket commands scales with db pool size"""
+
+    await database_sync_to_async(reset_room_event_log)(ws_chat_room1)
+
+    elapsed = {}
+    for pool_size in (1, 4):
+        headers = [(b'authorization', auth_token_for_user1.encode('ascii'))]
+        communicators = [WebsocketCommunicator(application, "/chat/", headers) for _ in range(8)]
+        for communicator in communicators:
+            await communicator.connect()
+
+        elapsed[pool_size] = await resume_storm(communicators, ws_chat_room1, pool_size)
+
+        for communicator in communicators:
+            await communicator.disconnect()
+
+    # 8 lookups of 50ms: ~400ms on one connection, ~100ms on four
+    assert elapsed[4] < elapsed[1] / 2
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_busy_db_pool_closes_socket_with_retry_code(ws_communicator):
+
+    async def busy_get_user(token_key):
+        raise ExecutorBusy("db_executor queue is full")
+
+    with patch("chat.middleware.get_user", busy_get_user):
+        connected, _ = await ws_communicator.connect()
+
+    assert connected
+    assert await ws_communicator.receive_output() == {"type": "websocket.close", "code": SERVER_BUSY_CLOSE_CODE}
+
+
+def test_room_event_payload_is_encoded_once():
+    event = room_event({"response_type": "new_message", "id": 1}, sender_id=5)
+
+    assert json.loads(add_send_by(event, 5)) == {"response_type": "new_message", "id": 1, "send_by": "me"}
+    assert json.loads(add_send_by(event, 6)) == {"response_type": "new_message", "id": 1, "send_by": "other"}
+    assert json.loads(add_send_by(room_event({"id": 1}), 5)) == {"id": 1}
@@ -0,0 +1,176 @@
+import asyncio
+from unittest.mock import patch
+
+import pytest
+from channels.db import database_sync_to_async
+from django.db import IntegrityError
+
+from chat.consumers import build_chat_message
+from chat.models import ChatMessage, ChatRoom
+from chat.write_behind import MessageBuffer, MessageBufferFull, save_messages
+from core.utils.general_data import CHAT_WRITE_BEHIND_MAX_ATTEMPTS
+
+
+@database_sync_to_async
+def saved_messages(room):
+    return list(ChatMessage.objects.filter(room=room).order_by('seq').values_list('id', 'seq', 'message_text'))
+
+
+@database_sync_to_async
+def get_room(room):
+    return ChatRoom.objects.get(id=room.id)
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_buffer_flushes_full_batch(ws_chat_room1, ws_user1):
+    buffer = MessageBuffer(batch_size=3, flush_interval=60, max_size=10)
+
+    messages = [await buffer.add(build_chat_message(ws_chat_room1, ws_user1, text, [], None)) for text in "abc"]
+    await asyncio.sleep(0.2)  # full batch is flushed right away
+
+    # ids are given before saving and kept
+    assert await saved_messages(ws_chat_room1) == [(message.id, seq, message.message_text) for seq, message in enumerate(messages, start=1)]
+
+    room = await get_room(ws_chat_room1)
+    assert room.last_message_id == messages[-1].id
+    assert room.message_seq == 3
+    assert buffer.snapshot()["flushed"] == 3
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_buffer_flushes_after_interval(ws_chat_room1, ws_user1):
+    buffer = MessageBuffer(batch_size=100, flush_interval=0.05, max_size=1000)
+
+    await buffer.add(build_chat_message(ws_chat_room1, ws_user1, "hi", [], None))
+    assert await saved_messages(ws_chat_room1) == []
+
+    await asyncio.sleep(0.3)
+    assert len(await saved_messages(ws_chat_room1)) == 1
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_buffer_is_flushed_on_exit(ws_chat_room1, ws_user1):
+    buffer = MessageBuffer(batch_size=100, flush_interval=60, max_size=1000)
+
+    await buffer.add(build_chat_message(ws_chat_room1, ws_user1, "hi", [], None))
+    buffer.flush_handle.cancel()
+
+    await database_sync_to_async(buffer.flush_sync)()  # registered with 'atexit'
+    assert len(await saved_messages(ws_chat_room1)) == 1
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_failed_flush_is_retried(ws_chat_room1, ws_user1):
+    buffer = MessageBuffer(batch_size=100, flush_interval=60, max_size=1000)
+    await buffer.add(build_chat_message(ws_chat_room1, ws_user1, "hi", [], None))
+
+    with patch("chat.write_behind.save_messages", side_effect=ConnectionError):
+        await buffer.flush()
+
+    assert len(buffer.messages) == 1
+    assert buffer.snapshot()["failed_flushes"] == 1
+
+    await buffer.flush()
+    assert len(await saved_messages(ws_chat_room1)) == 1
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_message_which_can_not_be_saved_is_dropped(ws_chat_room1, ws_user1):
+    buffer = MessageBuffer(batch_size=100, flush_interval=60, max_size=1000)
+    for text in ("bad", "good"):
+        await buffer.add(build_chat_message(ws_chat_room1, ws_user1, text, [], None))
+
+    def save_without_bad(messages):
+        if any(message.message_text == "bad" for message in messages):
+            raise IntegrityError("bad row")
+        save_messages(messages)
+
+    with patch("chat.write_behind.save_messages", save_without_bad):
+        await buffer.flush()
+        assert [text for _, _, text in await saved_messages(ws_chat_room1)] == ["good"]  # isn't held back
+
+        for _ in range(CHAT_WRITE_BEHIND_MAX_ATTEMPTS - 1):
+            assert len(buffer.messages) == 1
+            await buffer.flush()
+
+    assert buffer.messages == []
+    assert buffer.pending_ids == set()
+    assert buffer.snapshot()["dropped"] == 1
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_full_buffer_refuses_messages(ws_chat_room1, ws_user1):
+    buffer = MessageBuffer(batch_size=100, flush_interval=60, max_size=1)
+    await buffer.add(build_chat_message(ws_chat_room1, ws_user1, "hi", [], None))
+
+    with patch("chat.write_behind.save_messages", side_effect=ConnectionError):
+        with pytest.raises(MessageBufferFull):
+            await buffer.add(build_chat_message(ws_chat_room1, ws_user1, "hello", [], None))
+
+    assert len(buffer.messages) == 1
+    buffer.flush_handle.cancel()
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_write_behind_message_is_saved_on_disconnect(settings, ws_communicator, ws_chat_room1):
+    settings.CHAT_WRITE_BEHIND = True
+    buffer = MessageBuffer(batch_size=100, flush_interval=60, max_size=1000)
+
+    with patch("chat.consumers.message_buffer", buffer):
+        await ws_communicator.connect()
+        await ws_communicator.send_json_to(
+            {
+                "command": "send_message",
+                "room_id": ws_chat_room1.id,
+                "text_message": 'hi'
+            }
+        )
+        response = await ws_communicator.receive_json_from()
+
+        # sent before it's saved
+        assert response.get('response_type') == 'new_message'
+        assert await saved_messages(ws_chat_room1) == []
+
+        await ws_communicator.disconnect()
+
+    assert await saved_messages(ws_chat_room1) == [(response['id'], 1, 'hi')]
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_editing_buffered_message_saves_it_first(settings, ws_communicator, ws_chat_room1):
+    settings.CHAT_WRITE_BEHIND = True
+    buffer = MessageBuffer(batch_size=100, flush_interval=60, max_size=1000)
+
+    with patch("chat.consumers.message_buffer", buffer):
+        await ws_communicator.connect()
+        await ws_communicator.send_json_to(
+            {
+                "command": "send_message",
+                "room_id": ws_chat_room1.id,
+                "text_message": 'hi'
+            }
+        )
+        message = await ws_communicator.receive_json_from()
+
+        await ws_communicator.send_json_to(
+            {
+                "command": "edit_message",
+                "room_id": ws_chat_room1.id,
+                "message_id": message['id'],
+                "text_message": 'hello'
+            }
+        )
+        response = await ws_communicator.receive_json_from()
+
+        assert response.get('response_type') == 'edited_message'
+        assert await saved_messages(ws_chat_room1) == [(message['id'], 1, 'hello')]
+
+        await ws_communicator.disconnect()
@@ -0,0 +1,104 @@
+"""Chunked attachment/voice uploads over binary websocket frames.
+
+Instead of sending a whole file as a base64 blob inside one json frame, a client can
+stream it to the server:
+
+    1. {"command": "upload_begin", "upload_type": "attachment", "file_name": "photo.png", "file_size": 12345}
+       -> {"response_type": "upload_ready", "upload_id": "<hex>", "chunk_size": 65536}
+    2. binary frames, each one is the 16 bytes of the upload id followed by max `chunk_size` bytes of the file
+    3. {"command": "upload_commit", "upload_id": "<hex>"}
+       -> {"response_type": "upload_complete", "upload_id": "<hex>"}
+    4. {"command": "send_message", "room_id": 1, "attachment_upload_ids": ["<hex>"]} or "voice_upload_id": "<hex>"
+
+Every chunk is written straight to a temporary file, so the memory used by an upload
+never grows beyond one frame. The file is hashed while it's written, 'chat.attachment_store'
+uses the hash to find an already stored copy of it.
+"""
+
+import hashlib
+import os
+import uuid
+
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.utils.text import get_valid_filename
+
+UPLOAD_ID_LENGTH = 16  # bytes of an uuid at the beginning of every binary frame
+UPLOAD_TYPES = ("attachment", "voice")
+
+
+class ChunkedUploadError(Exception):
+    """Raised when a client breaks the upload protocol"""
+
+
+class ChunkedUpload:
+    """A file that is being received chunk by chunk
+
+    Methods
+    -------
+    write(chunk=bytes):
+        Appends chunk to the temporary file
+    commit():
+        Verifies that whole file is received and returns it
+    discard():
+        Closes and removes the temporary file
+    """
+
+    def __init__(self, upload_type: str, file_name: str, file_size: int):
+        self.id = uuid.uuid4()
+        self.upload_type = upload_type
+        self.file_size = file_size
+        self.received_size = 0
+        self.is_committed = False
+        self.sha256 = hashlib.sha256()
+
+        file_name = get_valid_filename(os.path.basename(file_name or "")) or "file"
+        self.file = TemporaryUploadedFile(file_name[-100:], None, file_size, None)
+
+    def write(self, chunk: bytes) -> None:
+        """Appends chunk to the temporary file"""
+
+        if self.is_committed:
+            raise ChunkedUploadError("Upload is already committed")
+
+        if self.received_size + len(chunk) > self.file_size:
+            raise ChunkedUploadError("Upload is larger than the declared file size")
+
+        self.file.write(chunk)
+        self.sha256.update(chunk)
+        self.received_size += len(chunk)
+
+    def commit(self) -> TemporaryUploadedFile:
+        """Verifies that whole file is received and returns it"""
+
+        if self.received_size != self.file_size:
+            raise ChunkedUploadError("Upload is incomplete")
+
+        self.file.flush()
+        self.file.seek(0)
+        self.file.sha256 = self.sha256.hexdigest()
+        self.is_committed = True
+        return self.file
+
+    def discard(self) -> None:
+        """Closes and removes the temporary file
+
+        Safe to call after the file is moved by the storage, closing the
+        temporary file also deletes it.
+        """
+        self.file.close()
+
+
+def parse_upload_frame(bytes_data: bytes):
+    """Splits a binary frame into upload id and file chunk
+
+    Parameters:
+        bytes_data (bytes): binary websocket frame
+
+    Returns:
+        (upload id, chunk) tuple
+    """
+    if len(bytes_data) <= UPLOAD_ID_LENGTH:
+        raise ChunkedUploadError("Invalid upload frame")
+
+    upload_id = uuid.UUID(bytes=bytes_data[:UPLOAD_ID_LENGTH])
+    return upload_id, bytes_data[UPLOAD_ID_LENGTH:]
@@ -0,0 +1,159 @@
+"""Chat related helper functions"""
+
+import logging
+from typing import Optional, Type
+
+import orjson
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.cache import cache
+from django.db import transaction
+from redis.exceptions import RedisError
+
+from chat.event_log import log_room_event
+from chat.models import ChatRoom
+from core.utils.general_data import READ_RECEIPT_INTERVAL, TYPING_THROTTLE_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+
+def send_room_state(room: Type[ChatRoom]) -> None:
+    """Sends room's block state to the room's consumers, so they refresh their cached room
+
+    Parameters:
+        room (object): chat room which is changed
+    """
+    try:
+        async_to_sync(get_channel_layer().group_send)(
+            room.group_name,
+            {
+                "type": "room_state_changed",
+                "room_id": room.id,
+                "is_blocked_by_member_1": room.is_blocked_by_member_1,
+                "is_blocked_by_member_2": room.is_blocked_by_member_2,
+            },
+        )
+    except (ConnectionRefusedError, TimeoutError, OSError) as e:  # when redis server isn't reachable
+        logger.error(f"Can't send chat room state of room {room.id}: {e!r}")
+
+
+def room_event(payload: dict, sender_id: Optional[int] = None) -> dict:
+    """Returns a 'forward_message' channel layer event of a message payload
+
+    Payload is json encoded here once, instead of by every recipient consumer.
+
+    Parameters:
+        payload (dict): message payload like {'response_type': 'new_message', ...}
+        sender_id (int): message sender id, recipients get 'send_by' key when it's given
+
+    Returns:
+        Channel layer event
+    """
+    return {
+        "type": "forward_message",
+        "payload": orjson.dumps(payload),
+        "sender_id": sender_id,
+    }
+
+
+def add_send_by(event: dict, user_id: int) -> bytes:
+    """Returns event's json payload with 'send_by' key for a recipient
+
+    Parameters:
+        event (dict): event made by 'room_event'
+        user_id (int): recipient user id
+
+    Returns:
+        Json encoded payload
+    """
+    payload = event["payload"]
+    if event.get("sender_id") is None:
+        return payload
+
+    # payload is a json object, so 'send_by' is added before it's closing brace
+    send_by = b"me" if event["sender_id"] == user_id else b"other"
+    return payload[:-1] + b',"send_by":"' + send_by + b'"}'
+
+
+def schedule_read_receipt(room_id: int, user_id: int) -> None:
+    """Schedules read receipt of the user, receipts within 'READ_RECEIPT_INTERVAL' are coalesced
+
+    The first mark of an interval schedules 'send_read_receipt' task at the end of the interval,
+    which sends the watermark of that time, so later marks of the interval are sent by it too.
+    """
+    from chat.tasks import send_read_receipt
+
+    if cache.add(f"chat_read_receipt:{room_id}:{user_id}", 1, timeout=READ_RECEIPT_INTERVAL):
+        send_read_receipt.apply_async((room_id, user_id), countdown=READ_RECEIPT_INTERVAL)
+
+
+def typing_throttle_key(room_id: int, user_id: int) -> str:
+    """Returns cache key of the user's typing throttle in the room"""
+    return f"chat_typing:{room_id}:{user_id}"
+
+
+def claim_typing_relay(room_id: int, user_id: int) -> bool:
+    """Returns whether typing event of the user can be relayed to the room, one event per
+    'TYPING_THROTTLE_INTERVAL' is relayed for all sockets of the user"""
+
+    return cache.add(typing_throttle_key(room_id, user_id), 1, timeout=TYPING_THROTTLE_INTERVAL)
+
+
+def schedule_media_tasks(messages: list) -> None:
+    """Makes image variants of attachments and transcodes voice of saved messages by celery after commit"""
+    from chat.tasks import generate_attachment_variants, transcode_voice_message
+
+    for message in messages:
+        if message.attachment_links:
+            transaction.on_commit(lambda message_id=message.id: generate_attachment_variants.delay(message_id))
+        if message.voice:
+            transaction.on_commit(lambda message_id=message.id: transcode_voice_message.delay(message_id))
+
+
+def send_voice_transcoded(message) -> None:
+    """Sends 'edited_message' event of a voice message whose file is transcoded
+
+    Parameters:
+        message (object): chat message with it's new voice and voice waveform
+    """
+    event = room_event({
+        "response_type": "edited_message",
+        "id": message.id,
+        "text_message": message.message_text,
+        "message_type": message.message_type,
+        "attachment_links": [],
+        "voice": message.voice,
+        "voice_waveform": message.voice_waveform,
+    })
+    try:
+        event = log_room_event(message.room_id, event)
+    except (RedisError, OSError) as e:  # sent without 'seq', 'resume' reports a gap
+        logger.error(f"Can't log event of room {message.room_id}: {e!r}")
+
+    try:
+        async_to_sync(get_channel_layer().group_send)(message.room.group_name, event)
+    except (ConnectionRefusedError, TimeoutError, OSError) as e:  # when redis server isn't reachable
+        logger.error(f"Can't send transcoded voice of message {message.id}: {e!r}")
+
+
+def send_read_receipt(room: Type[ChatRoom], user_id: int) -> None:
+    """Sends current read watermark of the user to the room
+
+    Parameters:
+        room (object): chat room
+        user_id (int): room member who has read the messages
+    """
+    reader = room.room_member_1 if user_id == room.room_member_1_id else room.room_member_2
+    try:
+        async_to_sync(get_channel_layer().group_send)(
+            room.group_name,
+            room_event({
+                "response_type": "read_receipt",
+                "room_id": room.id,
+                "user_id": user_id,
+                "last_read_message_id": room.get_last_read_message_id(reader),
+                "unread_count": room.get_unread_count(reader),
+            }),
+        )
+    except (ConnectionRefusedError, TimeoutError, OSError) as e:  # when redis server isn't reachable
+        logger.error(f"Can't send read receipt of room {room.id}: {e!r}")
@@ -0,0 +1,123 @@
+"""Per-(room, sender) voice message counters, so the voice message limit of a room is checked
+before the voice file is decoded.
+
+Redis keys:
+    chat:room:<room id>:voice:<user id>  number of voice messages the user has sent to the room
+
+A counter is loaded from the db on it's first use. A voice message reserves a slot before it's
+file is read and releases it when the message isn't sent, so concurrent sends can't pass the limit.
+'reconcile_voice_counters' celery beat task resets the counters from the db, which fixes counters
+of crashed sends.
+"""
+
+from asgiref.sync import sync_to_async
+from django.db.models import Count
+from django_redis import get_redis_connection
+
+from chat.models import ChatMessage
+from core.utils.executors import database_pool_to_async
+from core.utils.general_data import MAX_VOICE_MESSAGE_FOR_PER_CHATTING_ROOM, VOICE_COUNTER_TTL
+
+COUNTER_PATTERN = "chat:room:*:voice:*"
+
+# KEYS: counter; ARGV: limit, ttl, db count or '' when it isn't loaded
+# Returns 1 when a slot is reserved, 0 when the limit is reached, -1 when counter has to be loaded
+RESERVE_SCRIPT = """
+local count = redis.call('GET', KEYS[1])
+if not count then
+    if ARGV[3] == '' then
+        return -1
+    end
+    count = ARGV[3]
+end
+if tonumber(count) >= tonumber(ARGV[1]) then
+    redis.call('SET', KEYS[1], count, 'EX', ARGV[2])
+    return 0
+end
+redis.call('SET', KEYS[1], tonumber(count) + 1, 'EX', ARGV[2])
+return 1
+"""
+
+# KEYS: counter
+RELEASE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 and tonumber(redis.call('GET', KEYS[1])) > 0 then
+    redis.call('DECR', KEYS[1])
+end
+"""
+
+
+def counter_key(room_id: int, user_id: int) -> str:
+    """Returns redis key of the user's voice message counter in the room"""
+    return f"chat:room:{room_id}:voice:{user_id}"
+
+
+def count_voice_messages(room_id: int, user_id: int) -> int:
+    """Returns number of voice messages the user has sent to the room, deleted ones too"""
+    return ChatMessage.objects.filter(room_id=room_id, sender_id=user_id, message_type='voice').count()
+
+
+def reserve(room_id: int, user_id: int, db_count: int = None) -> int:
+    """Reserves a voice message slot, returns 1, 0 or -1 like 'RESERVE_SCRIPT'"""
+
+    return get_redis_connection("default").eval(
+        RESERVE_SCRIPT, 1, counter_key(room_id, user_id),
+        MAX_VOICE_MESSAGE_FOR_PER_CHATTING_ROOM, VOICE_COUNTER_TTL, "" if db_count is None else db_count,
+    )
+
+
+async def reserve_voice_message(room_id: int, user_id: int) -> bool:
+    """Reserves a voice message slot of the user in the room
+
+    Parameters:
+        room_id (int): chat room id
+        user_id (int): message sender id
+
+    Returns:
+        False when the user has already sent the maximum number of voice messages
+    """
+    reserved = await sync_to_async(reserve, thread_sensitive=False)(room_id, user_id)
+    if reserved == -1:
+        db_count = await database_pool_to_async(count_voice_messages)(room_id, user_id)
+        reserved = await sync_to_async(reserve, thread_sensitive=False)(room_id, user_id, db_count)
+    return reserved == 1
+
+
+async def release_voice_message(room_id: int, user_id: int) -> None:
+    """Gives back the slot of a voice message which isn't sent"""
+
+    await sync_to_async(get_redis_connection("default").eval, thread_sensitive=False)(
+        RELEASE_SCRIPT, 1, counter_key(room_id, user_id)
+    )
+
+
+def reconcile_counters(batch_size: int = 500) -> int:
+    """Resets cached counters to the voice message counts of the db
+
+    Messages which are still in the write-behind buffer or being sent aren't counted by the db,
+    so a user may send one more voice message right after a reconcile.
+
+    Returns:
+        Number of reconciled counters
+    """
+    redis = get_redis_connection("default")
+    keys = list(redis.scan_iter(match=COUNTER_PATTERN, count=batch_size))
+
+    for start in range(0, len(keys), batch_size):
+        pairs = {}
+        for key in keys[start:start + batch_size]:
+            _, _, room_id, _, user_id = key.decode().split(":")
+            pairs[(int(room_id), int(user_id))] = key
+
+        counts = ChatMessage.objects.filter(
+            message_type='voice',
+            room_id__in={room_id for room_id, _ in pairs},
+            sender_id__in={user_id for _, user_id in pairs},
+        ).values_list('room_id', 'sender_id').annotate(count=Count('id'))
+        counts = {(room_id, sender_id): count for room_id, sender_id, count in counts}
+
+        pipeline = redis.pipeline(transaction=False)
+        for pair, key in pairs.items():
+            pipeline.set(key, counts.get(pair, 0), ex=VOICE_COUNTER_TTL)
+        pipeline.execute()
+
+    return len(keys)
@@ -0,0 +1,277 @@
+"""Write-behind persistence of chat messages ('CHAT_WRITE_BEHIND' setting).
+
+Messages get their id from the db sequence up front (ids are allocated in blocks), so they
+are sent to the room right away and saved later by one 'bulk_create' and one commit per batch.
+A batch is flushed when 'CHAT_WRITE_BEHIND_BATCH_SIZE' messages are buffered or
+'CHAT_WRITE_BEHIND_FLUSH_INTERVAL' milliseconds after the first buffered message.
+
+Durability:
+    - Buffer is flushed when a chat socket is closed and when the process exits normally
+      (graceful shutdown closes the sockets, then 'atexit' flushes whatever is left).
+    - Editing, deleting or marking a buffered message as read flushes the buffer first.
+    - A failed flush saves it's messages one by one, so a message which can't be saved (e.g. an
+      integrity error) doesn't hold back the others. Such a message is retried by the next flushes
+      and dropped with an error log after 'CHAT_WRITE_BEHIND_MAX_ATTEMPTS' failures. Messages
+      failed by a db outage or a busy db pool are kept until they are saved.
+    - When the buffer is still full after a flush, sending fails with 'MessageBufferFull' instead
+      of growing the buffer.
+    - A killed process (SIGKILL, OOM, power loss) loses the messages of the last flush
+      interval, they have already been delivered to the room but are not in the history.
+    - History endpoints see a message after it's batch is flushed.
+"""
+
+import asyncio
+import atexit
+import logging
+import time
+from itertools import groupby
+
+from django.conf import settings
+from django.db import InterfaceError, OperationalError, connection, transaction
+
+from chat.models import ChatMessage
+from chat.utils import schedule_media_tasks
+from core.utils import metrics
+from core.utils.executors import ExecutorBusy, database_pool_to_async
+from core.utils.general_data import CHAT_WRITE_BEHIND_MAX_ATTEMPTS
+from core.utils.metrics import Timing
+
+logger = logging.getLogger(__name__)
+
+# errors of an unavailable db, messages failed by them are retried without limit
+OUTAGE_ERRORS = (OperationalError, InterfaceError, ConnectionError, ExecutorBusy)
+
+
+class MessageBufferFull(ExecutorBusy):
+    """Raised when buffer is still full after a flush, db can't keep up with the senders"""
+
+
+def allocate_message_ids(count: int) -> list:
+    """Returns next 'count' ids of the chat message id sequence"""
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+            [ChatMessage._meta.db_table, count],
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def save_messages(messages: list) -> None:
+    """Saves messages of several rooms in one transaction
+
+    Parameters:
+        messages (list): unsaved messages with ids in sending order
+    """
+    messages = sorted(messages, key=lambda message: message.room_id)  # stable, keeps sending order per room
+
+    with transaction.atomic():
+        # rooms are locked in id order, so concurrent flushes can't deadlock
+        for _, room_messages in groupby(messages, key=lambda message: message.room_id):
+            room_messages = list(room_messages)
+            room_messages[0].room.add_messages(room_messages)
+
+        schedule_media_tasks(messages)
+
+
+class MessageBuffer:
+    """Bounded in-process buffer of chat messages waiting to be saved
+
+    Methods
+    -------
+    add(message=ChatMessage):
+        Gives the message an id and buffers it
+    flush():
+        Saves buffered messages
+    save_one_by_one(messages=list):
+        Saves messages of a failed batch separately, returns messages to retry
+    ensure_persisted(message_id=int):
+        Flushes the buffer when the message is in it
+    ensure_room_persisted(room_id=int):
+        Flushes the buffer when it has messages of the room
+    flush_sync():
+        Saves buffered messages without event loop, used at exit
+    snapshot():
+        Returns buffer metrics
+    """
+
+    def __init__(self, batch_size: int, flush_interval: float, max_size: int):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval  # seconds
+        self.max_size = max_size
+
+        self.messages = []  # buffered messages in sending order
+        self.pending_ids = set()  # ids of buffered and being flushed messages
+        self.ids = []  # allocated message ids
+        self.flush_handle = None
+        self._lock = None
+
+        self.flushes = 0
+        self.flushed = 0  # saved messages
+        self.max_batch = 0
+        self.failed_flushes = 0
+        self.attempts = {}  # failed saves by message id
+        self.dropped = 0
+        self.flush_latency = Timing()
+
+        metrics.register("chat_write_behind", self.snapshot)
+        atexit.register(self.flush_sync)
+
+    @property
+    def lock(self) -> asyncio.Lock:
+        """Returns flush lock of the running event loop"""
+
+        loop = asyncio.get_running_loop()
+        if self._lock is None or self._lock[0] is not loop:
+            self._lock = (loop, asyncio.Lock())
+        return self._lock[1]
+
+    async def add(self, message: ChatMessage) -> ChatMessage:
+        """Gives the message an id and buffers it
+
+        Waits for a flush when buffer is full, so a slow db slows down senders instead of
+        growing the buffer. Raises 'MessageBufferFull' when the flush couldn't save them.
+        """
+        if len(self.messages) >= self.max_size:
+            await self.flush()
+            if len(self.messages) >= self.max_size:
+                raise MessageBufferFull(f"chat write-behind buffer has {len(self.messages)} unsaved messages")
+
+        while not self.ids:
+            self.ids.extend(await database_pool_to_async(allocate_message_ids)(self.batch_size))
+
+        message.id = self.ids.pop(0)
+        self.messages.append(message)
+        self.pending_ids.add(message.id)
+
+        if len(self.messages) >= self.batch_size:
+            asyncio.ensure_future(self.flush())
+        elif self.flush_handle is None:
+            self.schedule_flush()
+
+        return message
+
+    def schedule_flush(self) -> None:
+        """Flushes the buffer after flush interval"""
+
+        self.flush_handle = asyncio.get_running_loop().call_later(
+            self.flush_interval, lambda: asyncio.ensure_future(self.flush())
+        )
+
+    async def flush(self) -> None:
+        """Saves buffered messages"""
+
+        async with self.lock:
+            if self.flush_handle:
+                self.flush_handle.cancel()
+                self.flush_handle = None
+
+            messages, self.messages = self.messages, []
+            if not messages:
+                return
+
+            started_at = time.monotonic()
+            try:
+                # saving can't be rejected by a busy pool, buffer size is the bound
+                await database_pool_to_async(save_messages, must_run=True)(messages)
+            except Exception as e:
+                self.failed_flushes += 1
+                logger.error(f"Chat message flush of {len(messages)} messages failed: {e!r}")
+
+                dropped = self.dropped
+                retry = messages if isinstance(e, OUTAGE_ERRORS) else await self.save_one_by_one(messages)
+                self.pending_ids.difference_update({message.id for message in messages} - {message.id for message in retry})
+                self.flushed += len(messages) - len(retry) - (self.dropped - dropped)
+
+                if retry:
+                    self.messages = retry + self.messages  # retried by the next flush
+                    self.schedule_flush()
+                return
+
+            self.pending_ids.difference_update(message.id for message in messages)
+            self.flushes += 1
+            self.flushed += len(messages)
+            self.max_batch = max(self.max_batch, len(messages))
+            self.flush_latency.observe(time.monotonic() - started_at)
+
+    async def save_one_by_one(self, messages: list) -> list:
+        """Saves messages of a failed batch separately, returns messages to retry
+
+        A message which fails 'CHAT_WRITE_BEHIND_MAX_ATTEMPTS' times is dropped and logged with it's
+        content, so it can be restored by hand.
+        """
+        retry = []
+        for message in messages:
+            try:
+                await database_pool_to_async(save_messages, must_run=True)([message])
+            except OUTAGE_ERRORS:
+                retry.append(message)
+            except Exception as e:
+                self.attempts[message.id] = self.attempts.get(message.id, 0) + 1
+                if self.attempts[message.id] < CHAT_WRITE_BEHIND_MAX_ATTEMPTS:
+                    retry.append(message)
+                    continue
+
+                self.attempts.pop(message.id)
+                self.dropped += 1
+                row = {
+                    "id": message.id, "room_id": message.room_id, "sender_id": message.sender_id,
+                    "receiver_id": message.receiver_id, "message_type": message.message_type,
+                    "message_text": message.message_text, "attachment_links": message.attachment_links,
+                    "voice": str(message.voice) if message.voice else None, "created": str(message.created),
+                }
+                logger.error(f"Chat message is dropped after {CHAT_WRITE_BEHIND_MAX_ATTEMPTS} failed saves: {e!r} {row}")
+            else:
+                self.attempts.pop(message.id, None)
+
+        return retry
+
+    async def ensure_persisted(self, message_id: int) -> None:
+        """Flushes the buffer when the message is in it"""
+
+        try:
+            message_id = int(message_id)
+        except (TypeError, ValueError):
+            return
+
+        if message_id in self.pending_ids:
+            await self.flush()
+
+    async def ensure_room_persisted(self, room_id: int) -> None:
+        """Flushes the buffer when it has messages of the room"""
+
+        # a running flush may have messages of the room too
+        if self.lock.locked() or any(message.room_id == room_id for message in self.messages):
+            await self.flush()
+
+    def flush_sync(self) -> None:
+        """Saves buffered messages without event loop, used at exit"""
+
+        messages, self.messages = self.messages, []
+        if messages:
+            save_messages(messages)
+            self.pending_ids.clear()
+            self.flushed += len(messages)
+
+    def snapshot(self) -> dict:
+        """Returns buffer metrics"""
+
+        return {
+            "enabled": settings.CHAT_WRITE_BEHIND,
+            "buffer_size": len(self.messages),
+            "allocated_ids": len(self.ids),
+            "flushed": self.flushed,
+            "failed_flushes": self.failed_flushes,
+            "dropped": self.dropped,
+            "flush_latency": self.flush_latency.snapshot(),
+            "avg_batch": round(self.flushed / self.flushes, 1) if self.flushes else 0,
+            "max_batch": self.max_batch,
+        }
+
+
+# Buffer of this process
+message_buffer = MessageBuffer(
+    settings.CHAT_WRITE_BEHIND_BATCH_SIZE,
+    settings.CHAT_WRITE_BEHIND_FLUSH_INTERVAL / 1000,
+    settings.CHAT_WRITE_BEHIND_MAX_BUFFER,
+)
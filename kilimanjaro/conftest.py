@@ -444,10 +444,11 @@ def chat_room_obj(db, user_obj, user_obj2):
     )
 
 @pytest.fixture
-def chat_room_obj2(db, user_obj, user_obj2):
+def chat_room_obj2(db, user_obj, user_obj1):
 
+    # one room per two users, so this room's partner isn't 'user_obj2' of 'chat_room_obj'
     return ChatRoom.objects.create(
-        room_member_1=user_obj2,
+        room_member_1=user_obj1,
         room_member_2=user_obj,
         is_blocked_by_member_2 = True
     )
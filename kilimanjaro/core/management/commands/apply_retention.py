@@ -0,0 +1,27 @@
+"""
+    Expired tokens, chat message edit logs and deleted chat messages are deleted daily by
+    'apply_retention_policies' celery task, see 'core/retention.py'.
+    This command applies the retention policies now and prints what is reclaimed.
+"""
+
+from django.core.management.base import BaseCommand
+
+from core.retention import apply_policies
+from core.utils.general_data import RETENTION_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    """
+    To running this command start env and type
+            ```python manage.py apply_retention```
+    """
+
+    help = "Delete expired rows and their files"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=RETENTION_BATCH_SIZE)
+
+    def handle(self, *args, **kwargs):
+        report = apply_policies(batch_size=kwargs["batch_size"])
+        for name, reclaimed in report.items():
+            self.stdout.write(f"{name}: {reclaimed['rows']} rows, {reclaimed['bytes']} bytes reclaimed")  # for terminal log
@@ -0,0 +1,40 @@
+"""
+    Profile pictures, portfolio pictures and chat image attachments get their thumbnail and medium
+    variants by celery tasks after upload. This command schedules those tasks for the pictures
+    which were uploaded before, run it once after adding the variants fields.
+"""
+
+from django.core.management.base import BaseCommand
+
+from chat.models import ChatMessage
+from chat.tasks import generate_attachment_variants
+from core.tasks import generate_image_variants
+from portfolio.models import PortfolioImage
+from user.models import User
+
+
+class Command(BaseCommand):
+    """
+    To running this command start env and type
+            ```python manage.py generate_image_variants```
+    """
+
+    help = "Schedule image variants of the pictures which don't have them"
+
+    def handle(self, *args, **kwargs):
+        scheduled = 0
+
+        for model, field_name in ((User, "profile_picture"), (PortfolioImage, "picture")):
+            pictures = model.objects.exclude(**{f"{field_name}__isnull": True}).exclude(**{field_name: ""})
+            for pk in pictures.filter(**{f"{field_name}_variants": {}}).values_list("id", flat=True).iterator():
+                generate_image_variants.delay(model._meta.label, pk, field_name)
+                scheduled += 1
+
+        messages = ChatMessage.objects.filter(
+            attachment_links__isnull=False, attachment_variants__isnull=True, is_deleted=False
+        )
+        for message_id in messages.values_list("id", flat=True).iterator():
+            generate_attachment_variants.delay(message_id)
+            scheduled += 1
+
+        self.stdout.write(f"{scheduled} image variant tasks scheduled")  # for terminal log
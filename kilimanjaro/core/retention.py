@@ -0,0 +1,120 @@
+"""Retention policies, rows kept long enough are deleted by 'apply_retention_policies' celery task.
+
+Rows are deleted in batches of 'RETENTION_BATCH_SIZE' by ascending id. Each batch locks it's rows
+with SKIP LOCKED in a short transaction, so rows which are being used are skipped until the next
+run and other queries never wait behind a long delete. Files of the deleted rows are removed after
+their batch is committed.
+
+Report of a run looks like:
+
+    {"chat_message_edit_logs": {"rows": 1200, "bytes": 0}, "deleted_chat_messages": {...}, ...}
+"""
+
+import logging
+from datetime import timedelta
+
+from django.apps import apps
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from core.utils.general_data import (CHAT_EDIT_LOG_RETENTION_DAYS, DELETED_CHAT_MESSAGE_RETENTION_DAYS,
+                                     RETENTION_BATCH_SIZE, VERIFICATION_REQUEST_RETENTION_DAYS)
+
+logger = logging.getLogger(__name__)
+
+
+class RetentionPolicy:
+    """Rows of a model which are deleted when their 'date_field' is older than 'keep_days'
+
+    Methods
+    -------
+    expired_rows():
+        Returns queryset of the expired rows
+    apply(batch_size=int):
+        Deletes expired rows and their files, returns number of deleted rows and reclaimed bytes
+    """
+
+    def __init__(
+        self, name: str, model_label: str, keep_days: int, date_field: str = "created",
+        condition: Q = Q(), file_fields: tuple = (), purge_files: str = None,
+    ):
+        self.name = name
+        self.model_label = model_label
+        self.keep_days = keep_days
+        self.date_field = date_field
+        self.condition = condition
+        self.file_fields = file_fields  # fields with file urls, a list or an url
+        self.purge_files = purge_files  # dotted path of a function that removes files of urls and returns reclaimed bytes
+
+    def expired_rows(self):
+        """Returns queryset of the expired rows"""
+
+        threshold = timezone.now() - timedelta(days=self.keep_days)
+        model = apps.get_model(self.model_label)
+        return model.objects.filter(self.condition, **{f"{self.date_field}__lt": threshold})
+
+    def apply(self, batch_size: int = RETENTION_BATCH_SIZE) -> dict:
+        """Deletes expired rows and their files
+
+        Parameters:
+            batch_size (int): rows deleted by one transaction
+
+        Returns:
+            {"rows": number of deleted rows, "bytes": reclaimed bytes of files}
+        """
+        rows = self.expired_rows()
+        report = {"rows": 0, "bytes": 0}
+        last_id = 0
+
+        while True:
+            with transaction.atomic():
+                batch = list(
+                    rows.filter(id__gt=last_id).order_by("id").select_for_update(skip_locked=True)
+                    .values_list("id", *self.file_fields)[:batch_size]
+                )
+                if not batch:
+                    break
+                deleted, _ = rows.model.objects.filter(id__in=[row[0] for row in batch]).delete()
+
+            report["rows"] += deleted
+            last_id = batch[-1][0]
+
+            for values in batch:
+                urls = [url for value in values[1:] for url in (value if isinstance(value, list) else [value]) if url]
+                if urls:
+                    report["bytes"] += import_string(self.purge_files)(urls)
+
+        return report
+
+
+POLICIES = [
+    # tokens are valid for a day at most, requests are kept a while for support
+    RetentionPolicy("account_verification_requests", "user.AccountVerificationRequest", VERIFICATION_REQUEST_RETENTION_DAYS),
+    RetentionPolicy("reset_password_requests", "user.ResetPasswordRequest", VERIFICATION_REQUEST_RETENTION_DAYS),
+    RetentionPolicy("chat_message_edit_logs", "chat.ChatMessageEditLog", CHAT_EDIT_LOG_RETENTION_DAYS),
+    # deleted voice messages are kept, voice message quota counts them
+    RetentionPolicy(
+        "deleted_chat_messages", "chat.ChatMessage", DELETED_CHAT_MESSAGE_RETENTION_DAYS, date_field="modified",
+        condition=Q(is_deleted=True) & ~Q(message_type="voice"),
+        file_fields=("attachment_links", "voice"), purge_files="chat.attachment_store.purge_files",
+    ),
+]
+
+
+def apply_policies(policies: list = None, batch_size: int = RETENTION_BATCH_SIZE) -> dict:
+    """Applies the retention policies
+
+    Parameters:
+        policies (list): 'RetentionPolicy' list, all policies by default
+        batch_size (int): rows deleted by one transaction
+
+    Returns:
+        Report of the policies, {policy name: {"rows", "bytes"}}
+    """
+    report = {}
+    for policy in policies or POLICIES:
+        report[policy.name] = policy.apply(batch_size)
+        logger.info(f"Retention {policy.name}: {report[policy.name]['rows']} rows, {report[policy.name]['bytes']} bytes reclaimed")
+    return report
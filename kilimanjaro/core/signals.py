@@ -3,10 +3,13 @@ import secrets
 from django.conf import settings
 from django.core.cache import cache
 from django.core.cache.backends.base import DEFAULT_TIMEOUT
-from django.db.models.signals import pre_save
+from django.db import transaction
+from django.db.models.signals import post_save, pre_save
 from django.dispatch import receiver
 
 from core.models import ClientAPIKey
+from core.tasks import generate_image_variants
+from core.utils.general_func import cache_account_verified, is_account_verified
 
 CACHE_TTL = getattr(settings, "CACHE_TTL", DEFAULT_TIMEOUT)
 
@@ -28,4 +31,34 @@ def client_api_key(sender, instance, *args, **kwargs):
     client_api_list = ClientAPIKey.objects.filter(is_active=True).values_list(
         "api_key", flat=True
     )
-    cache.set("client_api_keys", client_api_list, timeout=CACHE_TTL)
\ No newline at end of file
+    cache.set("client_api_keys", client_api_list, timeout=CACHE_TTL)
+
+
+def schedule_image_variants(instance, field_name: str) -> None:
+    """Makes variants of the picture by celery after commit when the picture is changed"""
+
+    picture = getattr(instance, field_name)
+    if picture and getattr(instance, f"{field_name}_variants").get("source") != picture.name:
+        transaction.on_commit(lambda: generate_image_variants.delay(
+            instance._meta.label, instance.pk, field_name
+        ))
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def profile_picture_variants(sender, instance, *args, **kwargs):
+    """Schedules variants of the profile picture"""
+    schedule_image_variants(instance, "profile_picture")
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def account_verified_status(sender, instance, *args, **kwargs):
+    """Caches verification status after commit, tokens issued before a verification are checked by it"""
+
+    is_verified = is_account_verified(instance)
+    transaction.on_commit(lambda: cache_account_verified(instance.pk, is_verified))
+
+
+@receiver(post_save, sender="portfolio.PortfolioImage")
+def portfolio_picture_variants(sender, instance, *args, **kwargs):
+    """Schedules variants of the portfolio picture"""
+    schedule_image_variants(instance, "picture")
@@ -1,9 +1,16 @@
 """Contains celery task"""
+import logging
 from collections.abc import Callable
 
-from core.utils import general_func
+from django.apps import apps
+from PIL import UnidentifiedImageError
+
+from core import retention
+from core.utils import general_func, images
 from kilimanjaro.celery import app
 
+logger = logging.getLogger(__name__)
+
 
 @app.task(name="send_email")
 def send_email(
@@ -37,3 +44,48 @@ def send_sms(recipient_number: str, message: str) -> bool:
             None
     """
     general_func.send_sms_for_task(recipient_number, message)
+
+
+@app.task(name="generate_image_variants")
+def generate_image_variants(model_label: str, pk: int, field_name: str) -> None:
+    """
+    Making thumbnail and medium variants of an uploaded picture, saves them to '<field_name>_variants'
+
+        Parameters:
+            model_label (str) : Model of the picture like 'user.User'
+            pk (int) : Object id
+            field_name (str) : Image field name like 'profile_picture'
+
+        Returns:
+            None
+    """
+    model = apps.get_model(model_label)
+    instance = model.objects.filter(pk=pk).first()
+    picture = getattr(instance, field_name) if instance else None
+    variants_field = f"{field_name}_variants"
+    if not picture or getattr(instance, variants_field).get("source") == picture.name:
+        return
+
+    try:
+        with picture.open("rb"):
+            variants = images.make_variants(picture, images.variant_prefix(picture.name))
+    except (UnidentifiedImageError, OSError) as e:
+        logger.warning(f"Variants of {picture.name} can't be made: {e!r}")
+        variants = {}  # picture is served as it is
+
+    variants["source"] = picture.name
+
+    # picture may be changed meanwhile, then it's own task makes it's variants
+    is_updated = model.objects.filter(pk=pk, **{field_name: picture.name}).update(**{variants_field: variants})
+    images.remove_variants(getattr(instance, variants_field) if is_updated else variants)
+
+
+@app.task(name="apply_retention_policies")
+def apply_retention_policies() -> dict:
+    """
+    Deleting expired tokens, chat edit logs and deleted chat messages with their files, run by celery beat
+
+        Returns:
+            Number of deleted rows and reclaimed bytes per policy
+    """
+    return retention.apply_policies()
@@ -1,10 +1,24 @@
+import asyncio
+import threading
+from datetime import timedelta
+from io import BytesIO
 from unittest.mock import patch
 
 import pytest
+from django.core.cache import cache
 from django.test.utils import override_settings
+from django.utils import timezone
+from PIL import Image
+from rest_framework.test import APIClient
 
+from chat.models import ChatMessage
+from core.retention import apply_policies
 from core.tasks import send_email, send_sms
-from core.utils.general_func import send_mail_for_task, send_sms_for_task
+from core.utils import images
+from core.utils.executors import BoundedExecutor, ExecutorBusy, database_pool_to_async
+from core.utils.middlewares import ALLOWED_PATH_PATTERN
+from user.models import AccountVerificationRequest, ResetPasswordRequest, User
+from core.utils.general_func import get_tokens_for_user, send_mail_for_task, send_sms_for_task
 
 
 @pytest.mark.usefixtures("celery_session_app")
@@ -96,3 +110,153 @@ class TestGeneralFunction:
     def test_sms_send_worker_with_wrong_number(sell):
         res = send_sms_for_task("+880175049067", "This is only for testing purposes")
         assert res == False
+
+
+class TestBoundedExecutor:
+    @pytest.mark.asyncio
+    async def test_run_returns_result_and_records_metrics(self):
+        executor = BoundedExecutor("test_executor", max_workers=2, max_queue=2)
+
+        assert await executor.run(sum, [1, 2, 3]) == 6
+
+        snapshot = executor.snapshot()
+        assert snapshot["processing"]["count"] == 1
+        assert snapshot["queue_wait"]["count"] == 1
+        assert snapshot["queue_depth"] == 0
+
+    @pytest.mark.asyncio
+    async def test_run_rejects_when_queue_is_full(self):
+        executor = BoundedExecutor("test_full_executor", max_workers=1, max_queue=0)
+        release = threading.Event()
+
+        running = asyncio.ensure_future(executor.run(release.wait))
+        await asyncio.sleep(0)
+
+        with pytest.raises(ExecutorBusy):
+            await executor.run(sum, [1])
+
+        release.set()
+        await running
+        assert executor.snapshot()["rejected"] == 1
+
+    @pytest.mark.asyncio
+    async def test_run_queued_waits_when_queue_is_full(self):
+        executor = BoundedExecutor("test_queued_executor", max_workers=1, max_queue=0)
+        release = threading.Event()
+
+        running = asyncio.ensure_future(executor.run(release.wait))
+        await asyncio.sleep(0)
+        queued = asyncio.ensure_future(executor.run_queued(sum, [1, 2]))
+        await asyncio.sleep(0)
+
+        release.set()
+        await running
+        assert await queued == 3
+        assert executor.snapshot()["rejected"] == 0
+
+    @pytest.mark.django_db(transaction=True)
+    @pytest.mark.asyncio
+    async def test_database_pool_to_async_runs_queries_concurrently(self, user_obj):
+        executor = BoundedExecutor("test_db_executor", max_workers=2, max_queue=2)
+
+        with patch("core.utils.executors.db_executor", executor):
+            users = await asyncio.gather(*[
+                database_pool_to_async(User.objects.filter(id=user_obj.id).first)() for _ in range(4)
+            ])
+
+        assert users == [user_obj] * 4
+        assert executor.snapshot()["processing"]["count"] == 4
+
+
+class TestImageVariants:
+
+    def test_variants_keep_aspect_ratio_and_drop_exif(self, settings, tmp_path):
+        settings.MEDIA_ROOT = str(tmp_path)
+        exif = Image.Exif()
+        exif[0x010F] = "Camera maker"
+
+        file = BytesIO()
+        Image.new("RGB", (2000, 1000), (155, 0, 0)).save(file, "JPEG", exif=exif.tobytes())
+        file.seek(0)
+
+        variants = images.make_variants(file, "pictures/variants/photo")
+
+        assert (variants["thumb"]["width"], variants["thumb"]["height"]) == (320, 160)
+        assert (variants["medium"]["width"], variants["medium"]["height"]) == (1024, 512)
+        for extension in ("webp", "jpeg"):
+            variant = Image.open(tmp_path / variants["thumb"][extension][len(settings.MEDIA_URL):])
+            assert not variant.getexif()
+
+    def test_pick_variant_returns_smallest_large_enough_variant(self):
+        variants = {
+            "source": "photo.png",
+            "thumb": {"width": 320, "height": 160, "webp": "/media/t.webp", "jpeg": "/media/t.jpeg"},
+            "medium": {"width": 1024, "height": 512, "webp": "/media/m.webp", "jpeg": "/media/m.jpeg"},
+        }
+
+        assert images.pick_variant(variants, 160)["webp"] == "/media/t.webp"
+        assert images.pick_variant(variants, 640)["webp"] == "/media/m.webp"
+        assert images.pick_variant(variants, 4000)["webp"] == "/media/m.webp"
+        assert images.pick_variant({}, 160) is None
+
+
+@pytest.mark.django_db
+class TestRetention:
+
+    def test_expired_rows_and_files_are_deleted(
+        self, settings, tmp_path, user_obj, chat_room_obj, chat_message_obj,
+        account_verification_request_obj1, reset_password_request_obj1,
+    ):
+        settings.MEDIA_ROOT = str(tmp_path)
+        old = timezone.now() - timedelta(days=365)
+        (tmp_path / "room").mkdir()
+        (tmp_path / "room" / "old.png").write_bytes(b"12345")
+
+        fresh_request = AccountVerificationRequest.objects.create(user=user_obj, verify_by="email", token="e-000001")
+        voice_message = ChatMessage.objects.create(
+            sender=user_obj, room=chat_room_obj, message_type='voice', is_deleted=True
+        )
+        AccountVerificationRequest.objects.filter(id=account_verification_request_obj1.id).update(created=old)
+        ResetPasswordRequest.objects.filter(id=reset_password_request_obj1.id).update(created=old)
+        ChatMessage.objects.filter(id=chat_message_obj.id).update(
+            is_deleted=True, modified=old, attachment_links=[f"{settings.MEDIA_URL}room/old.png"]
+        )
+        ChatMessage.objects.filter(id=voice_message.id).update(modified=old)
+
+        report = apply_policies(batch_size=1)
+
+        assert report["account_verification_requests"] == {"rows": 1, "bytes": 0}
+        assert report["reset_password_requests"] == {"rows": 1, "bytes": 0}
+        assert report["deleted_chat_messages"] == {"rows": 1, "bytes": 5}
+        assert not (tmp_path / "room" / "old.png").exists()
+        assert AccountVerificationRequest.objects.filter(id=fresh_request.id).exists()
+        assert ChatMessage.objects.filter(id=voice_message.id).exists()  # voice message quota counts it
+
+
+class TestMiddlewares:
+
+    def test_allowed_paths(self):
+        assert ALLOWED_PATH_PATTERN.match("/core/metrics/")
+        assert ALLOWED_PATH_PATTERN.match("/admin/user/user/")
+        assert not ALLOWED_PATH_PATTERN.match("/core/metrics/extra/")
+        assert not ALLOWED_PATH_PATTERN.match("/notifications/")
+
+    def test_invalid_client_api_key_is_rejected_without_query(self, django_assert_num_queries, client_api_key_obj):
+        cache.set("client_api_keys", [client_api_key_obj.api_key])
+
+        with django_assert_num_queries(0):
+            response = APIClient().get("/notifications/", HTTP_CLIENTAPIKEY="invalid")
+            missing_key_response = APIClient().get("/notifications/")
+
+        assert response.status_code == 406
+        assert missing_key_response.status_code == 406
+
+    def test_unverified_user_is_rejected_without_query(self, django_assert_num_queries, api_client, client_api_key_obj, user_obj1):
+        cache.set("client_api_keys", [client_api_key_obj.api_key])
+        auth_headers = f"Bearer {get_tokens_for_user(user_obj1)['access']}"
+
+        with django_assert_num_queries(0):
+            response = api_client.patch("/notifications/mark_all_read/", HTTP_AUTHORIZATION=auth_headers)
+
+        assert response.status_code == 428
+        assert response.json()["is_account_verified"] is False
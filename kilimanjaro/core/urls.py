@@ -1,9 +1,10 @@
 from django.urls import path
-from core.views import client_api
+from core.views import client_api, metrics_view
 
 
 urlpatterns = [
-    path("client-api/", client_api, name="client_api")
+    path("client-api/", client_api, name="client_api"),
+    path("metrics/", metrics_view, name="metrics"),
 ]
 
 
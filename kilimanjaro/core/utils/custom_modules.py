@@ -1,5 +1,7 @@
 """This file contains custom modules"""
 
+import orjson
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
 from django.core.files.uploadedfile import InMemoryUploadedFile
 from django.core.serializers.json import DjangoJSONEncoder
 
@@ -18,4 +20,26 @@ class KJMJsonEncoder(DjangoJSONEncoder):
 
         if isinstance(o, InMemoryUploadedFile):
             return o.read()
-        return str(o)
\ No newline at end of file
+        return str(o)
+
+
+class OrjsonWebsocketConsumer(AsyncJsonWebsocketConsumer):
+    """Json websocket consumer that uses orjson instead of the standard json module
+
+    Methods
+    --------
+    decode_json(text_data=""):
+        Returns decoded json
+    encode_json(content=dict):
+        Returns json string
+    """
+
+    @classmethod
+    async def decode_json(cls, text_data: str):
+        """Returns decoded json"""
+        return orjson.loads(text_data)
+
+    @classmethod
+    async def encode_json(cls, content) -> str:
+        """Returns json string"""
+        return orjson.dumps(content).decode()
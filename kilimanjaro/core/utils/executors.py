@@ -0,0 +1,138 @@
+"""Bounded executors that keep blocking work off the event loop of async consumers"""
+
+import asyncio
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections.abc import Callable
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from core.utils import metrics
+from core.utils.metrics import Timing
+
+
+class ExecutorBusy(Exception):
+    """Raised when executor queue is full"""
+
+
+class BoundedExecutor:
+    """Thread pool with a limited queue and queue-wait/processing time metrics
+
+    Methods
+    -------
+    run(func=Callable, *args, **kwargs):
+        Runs func in the pool and returns it's result
+    run_queued(func=Callable, *args, **kwargs):
+        Runs func in the pool even when the queue is full
+    snapshot():
+        Returns executor metrics
+    """
+
+    def __init__(self, name: str, max_workers: int, max_queue: int):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self.pending = 0  # submitted but not finished calls
+        self.rejected = 0
+        self.queue_wait = Timing()
+        self.processing = Timing()
+
+        metrics.register(name, self.snapshot)
+
+    async def run(self, func: Callable, *args, **kwargs):
+        """Runs func in the pool and returns it's result
+
+        Raises 'ExecutorBusy' instead of queueing more than 'max_queue' calls
+        """
+        return await self._run(True, func, *args, **kwargs)
+
+    async def run_queued(self, func: Callable, *args, **kwargs):
+        """Runs func in the pool and returns it's result, it's queued even when the queue is full
+
+        For calls which can't be retried by the client, like cleanup of a closed socket.
+        """
+        return await self._run(False, func, *args, **kwargs)
+
+    async def _run(self, is_bounded: bool, func: Callable, *args, **kwargs):
+        """Runs func in the pool, raises 'ExecutorBusy' when queue is full and call is bounded"""
+
+        with self._lock:
+            if is_bounded and self.pending >= self.max_workers + self.max_queue:
+                self.rejected += 1
+                raise ExecutorBusy(f"{self.name} queue is full")
+            self.pending += 1
+
+        submitted_at = time.monotonic()
+
+        def timed_call():
+            started_at = time.monotonic()
+            self.queue_wait.observe(started_at - submitted_at)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.processing.observe(time.monotonic() - started_at)
+
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._pool, timed_call)
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+    def snapshot(self) -> dict:
+        """Returns executor metrics"""
+
+        return {
+            "max_workers": self.max_workers,
+            "max_queue": self.max_queue,
+            "queue_depth": max(self.pending - self.max_workers, 0),
+            "running": min(self.pending, self.max_workers),
+            "rejected": self.rejected,
+            "queue_wait": self.queue_wait.snapshot(),
+            "processing": self.processing.snapshot(),
+        }
+
+
+# Image resize, audio parsing and file saving of chat media
+media_executor = BoundedExecutor(
+    "media_executor", settings.MEDIA_EXECUTOR_MAX_WORKERS, settings.MEDIA_EXECUTOR_MAX_QUEUE
+)
+
+# ORM calls of websocket consumers, every worker thread holds it's own db connection
+db_executor = BoundedExecutor(
+    "db_executor", settings.DB_EXECUTOR_MAX_WORKERS, settings.DB_EXECUTOR_MAX_QUEUE
+)
+
+
+def run_with_db_connection(func: Callable, *args, **kwargs):
+    """Runs func between connection cleanups, like 'channels.db.database_sync_to_async' does"""
+
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+def database_pool_to_async(func: Callable, must_run: bool = False) -> Callable:
+    """Decorator that runs a blocking ORM function concurrently in 'db_executor'
+
+    Replaces 'database_sync_to_async', which runs every db call of the process in a single
+    thread, so one slow query doesn't hold back the queries of other sockets.
+
+    Parameters:
+        func (Callable): ORM function
+        must_run (bool): queues the call instead of raising 'ExecutorBusy' when the pool is busy
+    """
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        run = db_executor.run_queued if must_run else db_executor.run
+        return await run(run_with_db_connection, func, *args, **kwargs)
+
+    return wrapper
@@ -20,7 +20,8 @@ sensitive_fields = {
 # List of url path for which is not required client api key
 ALLOWED_PATHS_WITHOUT_CLIENT_API_KEY = [
     "/core/client-api-key/",
-    "/core/client-api/"
+    "/core/client-api/",
+    "/core/metrics/",
 ]
 
 # List of url path for which and their extention is not required client api key
@@ -28,6 +29,10 @@ ALLOWED_PATHS_WITH_EXTENSION_WITHOUT_CLIENT_API_KEY = [
     "/admin",
 ]
 
+# JWT claim with user's verification status, checked by 'ForceAccountVerification' middleware
+ACCOUNT_VERIFIED_CLAIM = "is_account_verified"
+ACCOUNT_VERIFIED_CACHE_KEY = "account_verified:{user_id}" # user's current verification status, for tokens with a False claim
+
 # 'ContactUs' model 'attachment' max size
 MAX_CONTACT_US_ATTACHMENT_SIZE = 5 * 1024 * 1024  # 5MB
 
@@ -36,17 +41,84 @@ MAX_PORTFOLIO_IMAGE_NUMBER = 10
 
 # CHAT MAX FILE SIZE 
 MAX_FILE_SIZE_FOR_CHATTING = 5 * 1024 * 1024 # 5MB
+RESIZED_IMAGE_SIZE = 1600 # longest side of a resized oversized image
+
+# IMAGE VARIANTS (pixels of the longest side, aspect ratio is kept)
+IMAGE_VARIANT_SIZES = {"thumb": 320, "medium": 1024}
+IMAGE_VARIANT_QUALITY = 80
+PROFILE_PICTURE_DISPLAY_SIZE = 160 # serializers return the smallest variant that is at least this large
+PORTFOLIO_IMAGE_DISPLAY_SIZE = 640
+CHAT_ATTACHMENT_DISPLAY_SIZE = 640
 
 # CHAT MAX VOICE DURATION
 MAX_VOICE_DURATION_MIN = 2
 MAX_VOICE_DURATION_FOR_CHATTING = MAX_VOICE_DURATION_MIN * 60 # 2 MIN
 
+# VOICE TRANSCODING
+VOICE_OPUS_BITRATE = "24k" # speech stays clear at this bitrate
+VOICE_WAVEFORM_POINTS = 64 # bars of the waveform of a voice message, every bar is 0-100
+VOICE_TRANSCODE_TIMEOUT = 60 # seconds
+
 # VOICE MESSAGE LIMIT
 MAX_VOICE_MESSAGE_FOR_PER_CHATTING_ROOM = 10
+VOICE_COUNTER_TTL = 60 * 60 * 24 * 7 # seconds, counter of an idle (room, sender) is reloaded from db after this time
+
+# CHAT CHUNKED UPLOAD (binary websocket frames)
+MAX_CHUNKED_UPLOAD_SIZE = 20 * 1024 * 1024 # 20MB, oversized images are resized after upload
+CHUNKED_UPLOAD_CHUNK_SIZE = 64 * 1024 # 64KB, max file bytes carried by one binary frame
+MAX_PENDING_UPLOADS_PER_CONNECTION = 10
+SERVER_BUSY_CLOSE_CODE = 1013 # "Try Again Later", socket is closed with it when db pool is busy
+MAX_JOINED_ROOMS_PER_CONNECTION = 20 # least recently used room is left when a connection joins more
+
+# CHAT READ RECEIPTS
+READ_RECEIPT_INTERVAL = 1 # seconds, partner gets at most one read receipt of a reader per room in this interval
+
+# ONLINE PRESENCE (seconds)
+PRESENCE_HEARTBEAT_INTERVAL = 30 # each process refreshes it's sockets in this interval
+PRESENCE_TTL = 90 # socket is offline when it isn't refreshed in this time
+PRESENCE_OFFLINE_DELAY = 5 # chat partners are notified when user doesn't come back in this time
+
+# CHAT TYPING INDICATOR (seconds)
+TYPING_THROTTLE_INTERVAL = 2 # at most one typing event of a user per room in this interval
+TYPING_EXPIRES_IN = 5 # client hides the indicator when no typing event comes in this time
+
+# CHAT EVENT LOG (replayed by 'resume' after reconnect)
+ROOM_EVENT_LOG_MAXLEN = 1000 # approximate number of the latest events kept per room
+ROOM_EVENT_LOG_TTL = 60 * 60 * 24 # seconds, log of an idle room is removed after this time
+RESUME_MAX_EVENTS = 200 # events replayed by one 'resume' command
+
+# CHAT WRITE BEHIND
+CHAT_WRITE_BEHIND_MAX_ATTEMPTS = 3 # failed saves of a message before it's dropped, db outages aren't counted
+
+# CHAT ATTACHMENT STORE
+CHAT_BLOB_DIR = "chat_blobs/" # directory of content addressed attachment files inside media root
+CHAT_BLOB_GC_GRACE = 60 * 60 # seconds, newer unused files may still be sent by a message
+
+# CHAT MESSAGE PARTITIONS (monthly, by 'created')
+CHAT_PARTITION_MONTHS_AHEAD = 3 # months of empty partitions kept ready for new messages
+CHAT_ARCHIVE_CACHE_TTL = 60 * 60 # seconds, whether the archive table exists is cached this long
+
+# RETENTION (days), older rows are deleted by 'apply_retention_policies' celery task
+VERIFICATION_REQUEST_RETENTION_DAYS = 7 # account verification and reset password requests
+CHAT_EDIT_LOG_RETENTION_DAYS = 180
+DELETED_CHAT_MESSAGE_RETENTION_DAYS = 30
+RETENTION_BATCH_SIZE = 1000 # rows deleted by one short transaction
+
+# CHAT SEARCH
+CHAT_SEARCH_CONFIG = "simple" # postgres text search config, 'simple' doesn't stem so it works for every language
+
+# NOTIFICATION DISPATCH
+NOTIFICATION_CELERY_THRESHOLD = 200 # notifications of a transaction, more are published by celery
+NOTIFICATION_PUBLISH_CHUNK = 500 # group sends running concurrently
+NOTIFICATION_SNAPSHOT_SIZE = 20 # newest unread notifications sent by the notification socket on connect
+NOTIFICATION_UNREAD_TTL = 60 * 60 * 24 # seconds, unread counters are reloaded from the db after this time
+NOTIFICATION_UNREAD_LOAD_TTL = 60 # seconds, a load of an unread counter which didn't finish is forgotten after this time
+NOTIFICATION_DIGEST_BATCH_SIZE = 500 # users emailed by one digest batch
 
 # 'Notification' 'body' field value
 ORDER_CREATE_MSG = "An Order has created by {first_name} {last_name}"
 ORDER_UPDATE_MSG = "Order has updated by {first_name} {last_name}"
+COALESCED_NOTIFICATION_MSG = "{count} more updates"
 
 LIST_OF_COUNTRIES_WITH_CURRENCY = [
     ["Afghanistan", "Afghan Afghani", "AFN"],
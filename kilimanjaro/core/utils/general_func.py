@@ -4,7 +4,6 @@ import logging
 import os
 import random
 import smtplib
-import sys
 import socket
 from collections.abc import Callable
 from datetime import datetime
@@ -12,10 +11,9 @@ from io import BytesIO
 from typing import Optional, Type
 
 import requests 
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
 from django.apps import apps
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.core.files import File
 from django.core.mail import BadHeaderError, EmailMultiAlternatives
@@ -27,12 +25,14 @@ from django.test.client import RequestFactory
 from django.utils.html import format_html
 from hashids import Hashids
 from PIL import Image
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
 from rest_framework_simplejwt.tokens import RefreshToken
 from django.core.files.storage import FileSystemStorage
 from django.core.files.uploadedfile import InMemoryUploadedFile
 
 from core.tasks import send_email, send_sms
-from core.utils.general_data import ORDER_CREATE_MSG, ORDER_UPDATE_MSG
+from core.utils.general_data import ACCOUNT_VERIFIED_CACHE_KEY, ACCOUNT_VERIFIED_CLAIM, RESIZED_IMAGE_SIZE
+from core.utils.images import encode, open_image
 
 import base64
 from django.core.files.base import ContentFile
@@ -44,7 +44,6 @@ User = (
 )
 
 # logger
-notification_logger = logging.getLogger('notification')
 email_send_logger = logging.getLogger('email_send')
 sms_send_logger = logging.getLogger('sms_send')
 
@@ -70,10 +69,34 @@ def generate_random_number():
     return number
 
 
+def is_account_verified(user: Type[User]) -> bool:
+    """Returns whether user has verified email/phone, staff users don't need verification"""
+
+    return bool(user.is_superuser or user.is_staff or user.is_email_verified or user.is_phone_number_verified)
+
+
+def cache_account_verified(user_id: int, is_verified: bool) -> None:
+    """Caches user's verification status, it's kept as long as a refresh token lives
+
+    A refreshed access token copies the claim of the refresh token, so tokens issued before the
+    verification (or staff promotion) keep a False claim until the user logs in again.
+    """
+    cache.set(
+        ACCOUNT_VERIFIED_CACHE_KEY.format(user_id=user_id), is_verified,
+        timeout=jwt_settings.REFRESH_TOKEN_LIFETIME.total_seconds(),
+    )
+
+
+def get_cached_account_verified(user_id: int) -> Optional[bool]:
+    """Returns user's cached verification status, None when it isn't cached"""
+    return cache.get(ACCOUNT_VERIFIED_CACHE_KEY.format(user_id=user_id))
+
+
 def get_tokens_for_user(user: Type[User]) -> dict[str, str]:
     """Takes a user object and returns that user's JWT Tokens(refresh & access) as dict"""
 
     jwt_token = RefreshToken.for_user(user)
+    jwt_token[ACCOUNT_VERIFIED_CLAIM] = is_account_verified(user)  # access token copies the claim
     return {"refresh": str(jwt_token), "access": str(jwt_token.access_token)}
 
 
@@ -213,65 +236,6 @@ def send_verification_credential(
     return response_message
 
 
-def send_notification(
-    user_id,
-    first_name: Optional[str] = None,
-    last_name: Optional[str] = None,
-    notification_for: Optional[str] = None,
-) -> None:
-    """Sends notification to channel layer
-    :param first_name: Optional[str]
-    :param last_name: Optional[str]
-    :param notification_for: Optional[str]
-    """
-
-    if notification_for == "order_create":
-        message = ORDER_CREATE_MSG.format(
-            first_name="first_name", last_name="last_name"
-        )
-    else:
-        message = ORDER_UPDATE_MSG.format(
-            first_name="first_name", last_name="last_name"
-        )
-
-    extra = {}  # Adding custom key & value for logging formatter
-    response_dict = {}
-    exception_happen = False
-
-    # Sending notification to channel layer
-    try:
-        async_to_sync(get_channel_layer().group_send)(
-            f"notification_room_{user_id}",
-            {
-                "type": "message.notification",
-                "message": message,
-            },
-        )
-        response_dict.update({"Success": "Notification send successfully"})
-    except ConnectionRefusedError:  # when redis server doesn't exists
-        exception_happen = True
-        response_dict.update(
-            {"ConnectionRefusedError": "Can't connect to the Redis server"}
-        )
-    except TimeoutError:  # Taking long time to send
-        exception_happen = True
-        response_dict.update(
-            {"TimeoutError": "Can't send the notification, because of time out"}
-        )
-    except OSError:  # Redis set-up error
-        exception_happen = True
-        response_dict.update({"OSError": "OS error happen"})
-    except NameError:  # object related error
-        exception_happen = True
-        response_dict.update({"NameError": "Something is incorrect"})
-
-    # saves log to file
-    if exception_happen:
-        notification_logger.info("Exception happend", extra={"response_dict": response_dict})
-    else:
-        notification_logger.info("Info", extra={"response_dict": response_dict})
-    
-
 def convert_form_data_to_dict_data(meta, stream, upload_handlers, encoding):
     """
     Converting form-data into dictionary
@@ -516,13 +480,12 @@ def upload_file(file, path: str ):
 
 
 def resize_image(file):
-    """Reduce image size"""
-
-    img = Image.open(file) # open image
-    outputIoStream = BytesIO()
-    img = img.resize((500, 500), Image.ANTIALIAS) # resize image
-    img.save(outputIoStream, format='JPEG') # save resizes image
-    outputIoStream.seek(0)
-    uploadedImage = InMemoryUploadedFile(outputIoStream,'ImageField', file.name, 'image/jpeg', sys.getsizeof(outputIoStream), None)
+    """Reduce image size, aspect ratio is kept and EXIF metadata is dropped"""
+
+    img = open_image(file, RESIZED_IMAGE_SIZE) # open image, JPEG is scaled down while decoding
+    img.thumbnail((RESIZED_IMAGE_SIZE, RESIZED_IMAGE_SIZE), Image.LANCZOS) # resize image
+    outputIoStream = BytesIO(encode(img, 'JPEG')) # save resizes image
+    name = f"{os.path.splitext(file.name)[0]}.jpeg"
+    uploadedImage = InMemoryUploadedFile(outputIoStream,'ImageField', name, 'image/jpeg', outputIoStream.getbuffer().nbytes, None)
     return uploadedImage
 
@@ -0,0 +1,119 @@
+"""Smaller variants of uploaded pictures, made by celery tasks after upload.
+
+Variants keep the aspect ratio of the picture and don't have it's EXIF metadata (camera,
+GPS location). Each one is saved as WebP and JPEG, a variants dict looks like:
+
+    {
+        "source": "<name of the picture file>",
+        "thumb": {"width": 320, "height": 240, "webp": "/media/...webp", "jpeg": "/media/...jpeg"},
+        "medium": {...},
+    }
+
+Serializers use 'pick_variant' to return the smallest variant that is large enough.
+"""
+
+import os
+from io import BytesIO
+from typing import Optional
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+from core.utils.general_data import IMAGE_VARIANT_QUALITY, IMAGE_VARIANT_SIZES
+
+VARIANT_FORMATS = (("webp", "WEBP"), ("jpeg", "JPEG"))
+
+
+def open_image(file, max_size: int) -> Image.Image:
+    """Opens an image scaled down close to 'max_size' and rotated by it's EXIF orientation"""
+
+    image = Image.open(file)
+    image.draft("RGB", (max_size, max_size))  # JPEG decoder skips the pixels that aren't needed
+    image = ImageOps.exif_transpose(image)  # orientation is applied before EXIF is dropped
+
+    if image.mode in ("RGBA", "LA", "P"):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))  # JPEG has no transparency
+        background.paste(image, mask=image.split()[-1])
+        return background
+    return image.convert("RGB")
+
+
+def encode(image: Image.Image, image_format: str) -> bytes:
+    """Returns image encoded without metadata"""
+
+    buffer = BytesIO()
+    image.save(buffer, image_format, quality=IMAGE_VARIANT_QUALITY, exif=b"")
+    return buffer.getvalue()
+
+
+def make_variants(file, name_prefix: str) -> dict:
+    """Saves the variants of an image
+
+    Parameters:
+        file (File): image file
+        name_prefix (str): file name prefix of the variants inside media root
+
+    Returns:
+        Variants dict without 'source' key
+    """
+    image = open_image(file, max(IMAGE_VARIANT_SIZES.values()))
+    image.info = {}
+
+    variants = {}
+    for label, size in sorted(IMAGE_VARIANT_SIZES.items(), key=lambda item: item[1], reverse=True):
+        image.thumbnail((size, size), Image.LANCZOS)  # every variant is made from the previous larger one
+        variants[label] = {"width": image.width, "height": image.height}
+        for extension, image_format in VARIANT_FORMATS:
+            name = default_storage.save(f"{name_prefix}-{label}.{extension}", ContentFile(encode(image, image_format)))
+            variants[label][extension] = settings.MEDIA_URL + name
+
+    return variants
+
+
+def variant_prefix(name: str) -> str:
+    """Returns file name prefix of the variants of a picture file"""
+
+    directory, file_name = os.path.split(name)
+    return os.path.join(directory, "variants", os.path.splitext(file_name)[0])
+
+
+def remove_variants(variants: dict) -> None:
+    """Removes variant files"""
+
+    for variant in (variants or {}).values():
+        if isinstance(variant, dict):
+            for extension, _ in VARIANT_FORMATS:
+                url = variant.get(extension)
+                if url and url.startswith(settings.MEDIA_URL):
+                    default_storage.delete(url[len(settings.MEDIA_URL):])
+
+
+def with_host(variant: Optional[dict], host: str) -> Optional[dict]:
+    """Returns variant with absolute urls"""
+
+    if not variant:
+        return None
+    return {**variant, **{extension: f"{host}{variant[extension]}" for extension, _ in VARIANT_FORMATS}}
+
+
+def pick_variant(variants: dict, size: int) -> Optional[dict]:
+    """Returns the smallest variant whose longest side is at least 'size', the largest one when none is
+
+    Parameters:
+        variants (dict): variants dict of a picture
+        size (int): displayed size in pixels
+
+    Returns:
+        {"width", "height", "webp", "jpeg"} or None when picture has no variants yet
+    """
+    candidates = sorted(
+        (variant for variant in (variants or {}).values() if isinstance(variant, dict)),
+        key=lambda variant: max(variant["width"], variant["height"]),
+    )
+    for variant in candidates:
+        if max(variant["width"], variant["height"]) >= size:
+            return variant
+    return candidates[-1] if candidates else None
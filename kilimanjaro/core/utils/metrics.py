@@ -0,0 +1,55 @@
+"""In-process metrics (executors, buffers etc.), exposed by 'core.views.metrics'"""
+
+import threading
+from collections.abc import Callable
+
+# metric group name -> function that returns the group's current values
+_collectors = {}
+
+
+class Timing:
+    """Thread-safe count/avg/max of a measured duration
+
+    Methods
+    -------
+    observe(seconds=float):
+        Records a duration
+    snapshot():
+        Returns current values in milliseconds
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float) -> None:
+        """Records a duration"""
+
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    def snapshot(self) -> dict:
+        """Returns current values in milliseconds"""
+
+        with self._lock:
+            return {
+                "count": self.count,
+                "avg_ms": round(self.total / self.count * 1000, 3) if self.count else 0,
+                "max_ms": round(self.max * 1000, 3),
+            }
+
+
+def register(name: str, collector: Callable) -> None:
+    """Registers a metric group, 'collector' returns a json serializable dict"""
+
+    _collectors[name] = collector
+
+
+def collect() -> dict:
+    """Returns values of all registered metric groups"""
+
+    return {name: collector() for name, collector in _collectors.items()}
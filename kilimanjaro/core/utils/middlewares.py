@@ -1,54 +1,101 @@
-"""This file contains some custom middlewares"""
-from os import closerange
+"""This file contains some custom middlewares
+
+Both checks run before the view, a rejected request never reaches it. Client api keys are read
+from cache. A JWT user's verification status is read from cache, it's updated whenever the user
+is saved. When it isn't cached a True 'ACCOUNT_VERIFIED_CLAIM' of the access token is trusted,
+a False claim may be older than the verification (refreshed tokens copy it), so the db is read
+and cached then.
+"""
+import re
+from functools import cached_property
 
 from django.conf import settings
+from django.contrib.auth import get_user_model
 from django.core.cache import cache
 from django.core.cache.backends.base import DEFAULT_TIMEOUT
 from django.http import JsonResponse
 from django.shortcuts import reverse
-from django.test import client
 from django.utils.deprecation import MiddlewareMixin
 from rest_framework import status
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from rest_framework_simplejwt.tokens import AccessToken
 
 from core.models import ClientAPIKey
 from core.utils.general_data import (
+    ACCOUNT_VERIFIED_CLAIM,
     ALLOWED_PATHS_WITH_EXTENSION_WITHOUT_CLIENT_API_KEY,
     ALLOWED_PATHS_WITHOUT_CLIENT_API_KEY)
+from core.utils.general_func import cache_account_verified, get_cached_account_verified, is_account_verified
 
 CACHE_TTL = getattr(settings, "CACHE_TTL", DEFAULT_TIMEOUT)
 
+# Url paths which don't require client api key, the exact paths and the paths with an allowed prefix
+ALLOWED_PATH_PATTERN = re.compile(
+    "|".join(
+        [re.escape(path) + r"\Z" for path in ALLOWED_PATHS_WITHOUT_CLIENT_API_KEY]
+        + [re.escape(path) for path in ALLOWED_PATHS_WITH_EXTENSION_WITHOUT_CLIENT_API_KEY]
+    )
+)
+
+
+def get_access_token(request):
+    """Returns validated JWT access token of the 'Authorization' header, None when there is no valid one
+
+    Signature and expiry are checked without db, an invalid token is left for the view's authentication.
+    """
+    parts = request.META.get("HTTP_AUTHORIZATION", "").split()
+    if len(parts) != 2 or parts[0] not in jwt_settings.AUTH_HEADER_TYPES:
+        return None
+
+    try:
+        return AccessToken(parts[1])
+    except TokenError:
+        return None
+
 
 class ForceAccountVerification(MiddlewareMixin):
     """Checks non-staff 'user' 'email'/'phone' verification status, depending on
     verification status they get response or error response
-    """
 
-    def process_response(self, request, response):
-        user = request.user
+    Methods
+    -------
+    verification_paths():
+        Returns url paths accessible for unverified 'user'
+    process_request(request):
+        Returns error response for unverified 'user', None to continue to the view
+    """
 
-        if not user.is_authenticated:
-            return response
+    @cached_property
+    def verification_paths(self) -> frozenset:
+        """Returns url paths accessible for unverified(email/phone) 'user'"""
 
-        if (
-            user.is_superuser
-            or user.is_staff
-            or user.is_email_verified
-            or user.is_phone_number_verified
-        ):
-            return response 
+        return frozenset([reverse("user:verify_account"), reverse("user:send_verification_key")])
 
+    def process_request(self, request):
         current_path = request.META["PATH_INFO"]  # current request path
-        account_verify_url = reverse("user:verify_account")
-        send_verification_key_url = reverse("user:send_verification_key")
-
-        # accessible url path for unverified(email/phone) 'user'
-        valid_urls = [
-            account_verify_url,
-            send_verification_key_url,
-        ]
-
-        if current_path in valid_urls:
-            return response
+        if current_path in self.verification_paths:
+            return None
+
+        token = get_access_token(request)
+        if token is not None:
+            # claim may be older than the user's current status, cached status is kept current on save
+            user_id = token[jwt_settings.USER_ID_CLAIM]
+            is_verified = get_cached_account_verified(user_id)
+            if is_verified is None and token.get(ACCOUNT_VERIFIED_CLAIM):
+                is_verified = True
+            elif is_verified is None:  # False or missing claim
+                user = get_user_model().objects.filter(id=user_id).first()
+                is_verified = user is None or is_account_verified(user)  # unknown user is rejected by the view
+                if user is not None:
+                    cache_account_verified(user_id, is_verified)
+        else:
+            # session authenticated user, e.g. admin; anonymous user costs no query
+            user = request.user
+            is_verified = not user.is_authenticated or is_account_verified(user)
+
+        if is_verified:
+            return None
 
         # Response data for unverified 'user'
         data = {
@@ -60,43 +107,38 @@ class ForceAccountVerification(MiddlewareMixin):
 
 
 class ClientAPIVerification(MiddlewareMixin):
-    """Client API key verification"""
+    """Client API key verification
 
-    def process_response(self, request, response):
+    Methods
+    -------
+    process_request(request):
+        Returns error response for an invalid client api key, None to continue to the view
+    """
+
+    def process_request(self, request):
+        current_path = request.META["PATH_INFO"]  # current request path
+        if ALLOWED_PATH_PATTERN.match(current_path):
+            return None
 
         client_api_key = request.META.get('HTTP_CLIENTAPIKEY') # getting client api keys from headers
-        current_path = request.META["PATH_INFO"] # current request path
-
-        # gets api keys from cache
-        client_api_list = cache.get("client_api_keys")
-
-        # when api keys is not exists into cache
-        if client_api_list == None or len(client_api_list) == 0:
-            client_api_list = ClientAPIKey.objects.filter(is_active=True).values_list(
-                "api_key", flat=True
-            )
-
-            # set api keys to cache
-            cache.set("client_api_keys", client_api_list, timeout=CACHE_TTL)
-
-        # List of url path for which is not required client api key
-        allowed_path = (
-            current_path in ALLOWED_PATHS_WITHOUT_CLIENT_API_KEY
-            or len(
-                [
-                    path
-                    for path in ALLOWED_PATHS_WITH_EXTENSION_WITHOUT_CLIENT_API_KEY
-                    if current_path.startswith(path)
-                ]
-            )
-            > 0
-        )
+        if client_api_key:
+            # gets api keys from cache
+            client_api_list = cache.get("client_api_keys")
 
-        # when provided an invalid key, won't get response
-        if client_api_key not in client_api_list and not allowed_path:
-            return JsonResponse(
-                data={"message": "Invalid Client API"},
-                status=status.HTTP_406_NOT_ACCEPTABLE,
-            )
+            # when api keys is not exists into cache
+            if client_api_list == None or len(client_api_list) == 0:
+                client_api_list = list(
+                    ClientAPIKey.objects.filter(is_active=True).values_list("api_key", flat=True)
+                )
+
+                # set api keys to cache
+                cache.set("client_api_keys", client_api_list, timeout=CACHE_TTL)
+
+            if client_api_key in client_api_list:
+                return None
 
-        return response
+        # when provided an invalid key, won't get response
+        return JsonResponse(
+            data={"message": "Invalid Client API"},
+            status=status.HTTP_406_NOT_ACCEPTABLE,
+        )
@@ -0,0 +1,140 @@
+"""Custom pagination classes"""
+
+from django.db.models import Q, Subquery
+from rest_framework import pagination
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+
+
+class KeysetPagination(pagination.BasePagination):
+    """Keyset (cursor) pagination ordered by ('ordering_field', 'id'), newest first
+
+    Instead of page number client sends the id of a row that it already has:
+        ?before=<id>  rows older than that row
+        ?after=<id>   rows newer than that row
+    so every page is an index range scan, no COUNT(*) and no OFFSET.
+
+    With 'use_archive' pages continue into 'view.get_archive_queryset()' after the oldest row
+    of the queryset, archived rows have to be older than every row of the queryset.
+
+    With 'compare_in_db' the rows are compared with the ordering value of the cursor row computed
+    by db, for values which change on a round trip through python (e.g. float4 of 'ts_rank').
+
+    Methods
+    -------
+    paginate_queryset(queryset=QuerySet, request=Request, view=None):
+        Returns rows of the requested page
+    get_anchor_value(queryset=QuerySet, value=object, row_id=int):
+        Returns ordering value of the cursor row that rows are compared with
+    get_paginated_response(data=list):
+        Returns paginated response
+    """
+
+    page_size = 10
+    max_page_size = 100
+    page_size_query_param = "page_size"
+    ordering_field = "created"
+    use_archive = False
+    compare_in_db = False
+
+    def get_page_size(self, request) -> int:
+        """Returns requested page size limited by 'max_page_size'"""
+
+        try:
+            page_size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except ValueError:
+            page_size = self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def get_querysets(self, queryset, view) -> list:
+        """Returns the queryset and the archive queryset of the view when there is one, newest rows first"""
+
+        archive = getattr(view, "get_archive_queryset", None) if self.use_archive else None
+        archive = archive() if archive else None
+        return [queryset] if archive is None else [queryset, archive]
+
+    def get_anchor(self, querysets: list, row_id: str) -> tuple:
+        """Returns (ordering value, id) of the cursor row and index of the queryset which has it"""
+
+        if row_id.isdigit():
+            for index, queryset in enumerate(querysets):
+                anchor = queryset.filter(id=row_id).values_list(self.ordering_field, "id").first()
+                if anchor:
+                    return anchor, index
+
+        raise ValidationError({"message": "Invalid cursor id"})
+
+    def get_anchor_value(self, queryset, value, row_id: int):
+        """Returns ordering value of the cursor row that rows are compared with"""
+
+        if self.compare_in_db:
+            # scalar subquery, db computes it once with the same type as the compared rows
+            return Subquery(queryset.filter(id=row_id).values(self.ordering_field)[:1])
+        return value
+
+    def paginate_queryset(self, queryset, request, view=None) -> list:
+        """Returns rows of the requested page"""
+
+        field = self.ordering_field
+        page_size = self.get_page_size(request)
+        before = request.query_params.get("before")
+        after = request.query_params.get("after")
+        querysets = self.get_querysets(queryset, view)
+
+        self.is_after = bool(after and not before)
+        self.is_before = bool(before)
+
+        if self.is_before:
+            (value, row_id), index = self.get_anchor(querysets, before)
+            value = self.get_anchor_value(querysets[index], value, row_id)
+
+            # '__lte' bound lets db use (and prune) the ordering index range directly
+            querysets = [
+                queryset.filter(**{f"{field}__lte": value}).filter(
+                    Q(**{f"{field}__lt": value}) | Q(**{field: value, "id__lt": row_id})
+                ).order_by(f"-{field}", "-id")
+                for queryset in querysets[index:]
+            ]
+        elif self.is_after:
+            (value, row_id), index = self.get_anchor(querysets, after)
+            value = self.get_anchor_value(querysets[index], value, row_id)
+
+            querysets = [
+                queryset.filter(**{f"{field}__gte": value}).filter(
+                    Q(**{f"{field}__gt": value}) | Q(**{field: value, "id__gt": row_id})
+                ).order_by(field, "id")
+                for queryset in reversed(querysets[:index + 1])
+            ]
+        else:
+            querysets = [queryset.order_by(f"-{field}", "-id") for queryset in querysets]
+
+        # next queryset is read only when the page isn't full yet, one extra row tells there is more
+        rows = []
+        for queryset in querysets:
+            rows += queryset[: page_size + 1 - len(rows)]
+            if len(rows) > page_size:
+                break
+        self.has_more = len(rows) > page_size
+        self.rows = rows[:page_size]
+
+        # pages are always newest first
+        if self.is_after:
+            self.rows.reverse()
+
+        return self.rows
+
+    def get_paginated_response(self, data: list) -> Response:
+        """Returns paginated response"""
+
+        has_older = self.has_more if not self.is_after else True
+        has_newer = self.has_more if self.is_after else self.is_before
+
+        return Response({
+            "pagination": {
+                "has_older": has_older,
+                "has_newer": has_newer,
+                "before": self.rows[-1].id if self.rows and has_older else None,  # cursor of older page
+                "after": self.rows[0].id if self.rows and has_newer else None,  # cursor of newer page
+            },
+            "results": data,
+        })
@@ -1,10 +1,19 @@
+from django.http import JsonResponse
 from django.shortcuts import redirect
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 
 from core.models import ClientAPIKey
+from core.utils import metrics
 
 @login_required
 def client_api(request):
     if request.user.is_superuser:
         ClientAPIKey.objects.create(is_active=True)
     return redirect("/admin/core/clientapikey")
+
+
+@staff_member_required
+def metrics_view(request):
+    """Returns in-process metrics of this worker, like executor queue depth and wait time"""
+    return JsonResponse(metrics.collect())
@@ -130,6 +130,29 @@ CACHES = {
 
 CACHE_TTL = 60 * 43800
 
+# Executor for blocking chat media work (image resize, audio parsing, file saving)
+MEDIA_EXECUTOR_MAX_WORKERS = config("MEDIA_EXECUTOR_MAX_WORKERS", default=4, cast=int)
+MEDIA_EXECUTOR_MAX_QUEUE = config("MEDIA_EXECUTOR_MAX_QUEUE", default=32, cast=int)  # waiting calls before rejecting
+FFMPEG_BINARY = config("FFMPEG_BINARY", default="ffmpeg")  # voice messages are transcoded by it
+
+# Executor for db queries of websocket consumers, each worker uses one db connection
+DB_EXECUTOR_MAX_WORKERS = config("DB_EXECUTOR_MAX_WORKERS", default=8, cast=int)
+DB_EXECUTOR_MAX_QUEUE = config("DB_EXECUTOR_MAX_QUEUE", default=512, cast=int)  # waiting calls before rejecting
+
+# Write-behind chat message saving, see 'chat/write_behind.py' for durability
+CHAT_WRITE_BEHIND = config("CHAT_WRITE_BEHIND", default=False, cast=bool)
+CHAT_WRITE_BEHIND_BATCH_SIZE = config("CHAT_WRITE_BEHIND_BATCH_SIZE", default=100, cast=int)
+CHAT_WRITE_BEHIND_FLUSH_INTERVAL = config("CHAT_WRITE_BEHIND_FLUSH_INTERVAL", default=50, cast=int)  # milliseconds
+CHAT_WRITE_BEHIND_MAX_BUFFER = config("CHAT_WRITE_BEHIND_MAX_BUFFER", default=5000, cast=int)
+
+# Chat message archive, see 'chat/partitions.py'
+CHAT_ARCHIVE_AFTER_MONTHS = config("CHAT_ARCHIVE_AFTER_MONTHS", default=12, cast=int)  # older months are archived
+CHAT_ARCHIVE_TABLESPACE = config("CHAT_ARCHIVE_TABLESPACE", default="")  # tablespace on compressed storage, empty keeps the table where it is
+
+# Notification bursts, see 'notification/dispatch.py'
+NOTIFICATION_COALESCE_WINDOW = config("NOTIFICATION_COALESCE_WINDOW", default=60, cast=int)  # seconds, 0 sends every notification
+NOTIFICATION_DIGEST_INTERVAL = config("NOTIFICATION_DIGEST_INTERVAL", default=60 * 60 * 6, cast=int)  # seconds
+
 # Database
 # https://docs.djangoproject.com/en/3.2/ref/settings/#databases
 
@@ -237,6 +260,27 @@ CELERY_TASK_SERIALIZER = "json"
 CELERY_RESULT_SERIALIZER = "json"
 CELERY_TIMEZONE = "UTC"
 
+# periodic tasks, run by 'celery -A kilimanjaro beat'
+CHAT_VOICE_COUNTER_RECONCILE_INTERVAL = config("CHAT_VOICE_COUNTER_RECONCILE_INTERVAL", default=60 * 60, cast=int)  # seconds
+CELERY_BEAT_SCHEDULE = {
+    "reconcile_voice_counters": {
+        "task": "reconcile_voice_counters",
+        "schedule": CHAT_VOICE_COUNTER_RECONCILE_INTERVAL,
+    },
+    "create_chat_message_partitions": {
+        "task": "create_chat_message_partitions",
+        "schedule": 60 * 60 * 24,  # daily, partitions are made months ahead
+    },
+    "apply_retention_policies": {
+        "task": "apply_retention_policies",
+        "schedule": 60 * 60 * 24,  # daily, see 'core/retention.py'
+    },
+    "send_notification_digests": {
+        "task": "send_notification_digests",
+        "schedule": NOTIFICATION_DIGEST_INTERVAL,
+    },
+}
+
 EMAIL_VALIDITY_TIME = 24 * 60  # 24hrs
 SMS_VALIDITY_TIME = 60  # 1hr
 TOKEN_REQUEST_TIMEOUT = 1  # 1min
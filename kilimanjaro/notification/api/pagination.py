@@ -0,0 +1,7 @@
+from core.utils.pagination import KeysetPagination
+
+
+class NotificationCursorPagination(KeysetPagination):
+    """Notification pages by '?before=<notification id>' / '?after=<notification id>', newest first"""
+    page_size = 20
+    ordering_field = 'created'
@@ -2,18 +2,41 @@ from rest_framework import viewsets
 from rest_framework.decorators import action
 from rest_framework.response import Response
 
+from notification import dispatch
+from notification.api.pagination import NotificationCursorPagination
 from notification.api.permissions import NotificationPermission
 from notification.api.serializers import NotificationSerializer
 from notification.models import Notification
 
 
 class NotificationViewset(viewsets.ModelViewSet):
+    """Notification's viewset
+
+    Methods
+    -------
+        get_queryset:
+            Returns the request user's notifications, only unread ones by '?is_read=false'
+        mark_as_read:
+            Marks a notification as read
+        mark_all_read:
+            Marks the request user's notifications as read, up to '?until=<notification id>'
+    """
+
     serializer_class = NotificationSerializer
     permission_classes = [NotificationPermission]
+    pagination_class = NotificationCursorPagination
     http_method_names = ["get", "patch"]
 
     def get_queryset(self):
-        return Notification.objects.filter(user=self.request.user)
+        """Returns the request user's notifications, pagination orders them newest first"""
+
+        notifications = Notification.objects.filter(user=self.request.user)
+
+        is_read = self.request.GET.get("is_read")
+        if is_read in ("true", "false"):
+            notifications = notifications.filter(is_read=is_read == "true")
+
+        return notifications
 
     @action(
         detail=True,
@@ -28,7 +51,32 @@ class NotificationViewset(viewsets.ModelViewSet):
         is_read = request.data.get("is_read", None)
 
         if is_read:
-            instance.is_read = True
-            instance.save()
+            # only an unread notification changes the unread counter
+            is_updated = Notification.objects.filter(id=instance.id, is_read=False).update(is_read=True)
+            dispatch.mark_read(instance.user_id, is_updated)
 
         return Response({"message": "Success"}, status=200)
+
+    @action(detail=False, methods=["PATCH"], url_path="mark_all_read")
+    def mark_all_read(self, request):
+        """Marks the request user's unread notifications as read with one UPDATE
+
+        Parameters:
+            until (int): marks notifications up to this notification id (optional), newer ones
+                         which client hasn't seen yet stay unread
+
+        Returns:
+            Number of marked notifications
+        """
+        notifications = Notification.objects.filter(user=request.user, is_read=False)
+
+        until = request.data.get("until", request.GET.get("until"))
+        if until is not None:
+            if not str(until).isdigit():
+                return Response({"message": "Invalid notification id"}, status=400)
+            notifications = notifications.filter(id__lte=until)
+
+        marked = notifications.update(is_read=True)
+        dispatch.mark_read(request.user.id, marked)
+
+        return Response({"message": "Success", "marked": marked}, status=200)
@@ -1,14 +1,20 @@
-from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from chat import presence
+from core.utils.custom_modules import OrjsonWebsocketConsumer
+from core.utils.executors import ExecutorBusy, database_pool_to_async
+from core.utils.general_data import NOTIFICATION_SNAPSHOT_SIZE, SERVER_BUSY_CLOSE_CODE
+from notification import unread
+from notification.api.serializers import NotificationSerializer
+from notification.models import Notification
 
 
-class NotificationConsumer(AsyncJsonWebsocketConsumer):
+class NotificationConsumer(OrjsonWebsocketConsumer):
     """Consumer for notification sends
 
     Methods
     -------
     connect():
         Creates socket connection and makes a room for the user
-        then adds that room to the channel layer
+        then adds that room to the channel layer and sends the unread snapshot
     receive_json(content=""):
         Receives messages from client side
     disconnect(close_code=int):
@@ -24,6 +30,10 @@ class NotificationConsumer(AsyncJsonWebsocketConsumer):
         await self.accept()  # Creates connection
 
         self.user = self.scope["user"]
+        if self.scope.get("is_server_busy"):  # user couldn't be authenticated
+            await self.close(code=SERVER_BUSY_CLOSE_CODE)
+            return
+
         if self.user.is_authenticated:
             self.room_name = f"notification_room_{self.user.id}"  # Room
 
@@ -31,6 +41,14 @@ class NotificationConsumer(AsyncJsonWebsocketConsumer):
                 self.room_name, self.channel_name
             )  # Adding room to layer
 
+            await presence.tracker.connect(self.user.id, self.channel_name)  # user is online
+
+            # sent after joining the room, so a notification of meanwhile is sent twice rather than missed
+            try:
+                await self.send_json(await get_unread_snapshot(self.user.id))
+            except ExecutorBusy:
+                await self.close(code=SERVER_BUSY_CLOSE_CODE)  # 'disconnect' leaves the room
+
     async def receive_json(self, content: str) -> None:
         """Receives messages from client side"""
         pass
@@ -38,9 +56,37 @@ class NotificationConsumer(AsyncJsonWebsocketConsumer):
     async def disconnect(self, close_code: int) -> None:
         """To destroy socket connection"""
 
-        await self.channel_layer.group_discard(self.room_name, self.channel_name)
+        if self.user.is_authenticated:
+            await self.channel_layer.group_discard(self.room_name, self.channel_name)
+            await presence.tracker.disconnect(self.user.id, self.channel_name)
 
     async def message_notification(self, event: dict[str, str]) -> None:
         """Sends messages to a respective layer"""
 
         await self.send_json(event)
+
+
+@database_pool_to_async
+def get_unread_snapshot(user_id: int) -> dict:
+    """Returns the unread count and the newest unread notifications of the user
+
+    Count is read from the user's redis counter, only a counter which isn't loaded is counted by the db.
+
+    Parameters:
+        user_id (int): user id
+
+    Returns:
+        {"type": "notification.snapshot", "unread_count", "notifications"}
+    """
+    notifications = Notification.objects.filter(user_id=user_id, is_read=False).order_by('-created')
+    unread_count = unread.get_count(user_id)
+    if unread_count is None:
+        token = unread.start_load(user_id)
+        unread_count = notifications.count()
+        unread.load_count(user_id, unread_count, token)
+
+    return {
+        "type": "notification.snapshot",
+        "unread_count": unread_count,
+        "notifications": NotificationSerializer(notifications[:NOTIFICATION_SNAPSHOT_SIZE], many=True).data,
+    }
@@ -0,0 +1,80 @@
+"""Notification digest emails, sent by 'send_notification_digests' celery beat task.
+
+Every 'NOTIFICATION_DIGEST_INTERVAL' a user with unread notifications which aren't emailed yet
+gets one email with the number of them per 'notification_for', instead of an email per
+notification. Notifications of the last 'NOTIFICATION_COALESCE_WINDOW' seconds are left for
+the next digest, the user may still read them on the socket.
+"""
+
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Count, Max
+from django.utils import timezone
+
+from core.tasks import send_email
+from core.utils.general_data import NOTIFICATION_DIGEST_BATCH_SIZE
+from notification.models import Notification
+
+logger = logging.getLogger(__name__)
+
+DIGEST_TEMPLATE = "email_templates/notification-digest.html"
+
+
+def send_digests(batch_size: int = NOTIFICATION_DIGEST_BATCH_SIZE) -> int:
+    """Emails a digest of the unread notifications to each of their users
+
+    Users are read in batches by ascending id, a batch is marked as emailed with one UPDATE.
+
+    Parameters:
+        batch_size (int): users emailed by one batch
+
+    Returns:
+        Number of sent digests
+    """
+    created_before = timezone.now() - timedelta(seconds=settings.NOTIFICATION_COALESCE_WINDOW)
+    notifications = Notification.objects.filter(is_read=False, is_emailed=False, created__lt=created_before)
+    labels = dict(Notification._notification_for_choices)
+
+    sent = 0
+    last_user_id = 0
+    while True:
+        user_ids = list(
+            notifications.filter(user_id__gt=last_user_id).order_by("user_id")
+            .values_list("user_id", flat=True).distinct()[:batch_size]
+        )
+        if not user_ids:
+            break
+
+        digests = {}
+        max_id = 0
+        counts = notifications.filter(user_id__in=user_ids).values(
+            "user_id", "user__email", "user__first_name", "notification_for"
+        ).annotate(count=Count("id"), max_id=Max("id")).order_by("user_id", "notification_for")
+
+        for row in counts:
+            digest = digests.setdefault(row["user_id"], {
+                "email": row["user__email"], "first_name": row["user__first_name"], "counts": [], "total": 0,
+            })
+            digest["counts"].append({"label": labels.get(row["notification_for"], row["notification_for"]), "count": row["count"]})
+            digest["total"] += row["count"]
+            max_id = max(max_id, row["max_id"])
+
+        for digest in digests.values():
+            email = digest.pop("email")
+            if email:
+                send_email.delay(
+                    subject=f"Kilimanjaro: {digest['total']} unread notifications",
+                    to_email=email,
+                    template=DIGEST_TEMPLATE,
+                    context=digest,
+                )
+                sent += 1
+
+        # notifications created after the counts are left for the next digest
+        notifications.filter(user_id__in=user_ids, id__lte=max_id).update(is_emailed=True)
+        last_user_id = user_ids[-1]
+
+    logger.info(f"{sent} notification digests sent")
+    return sent
@@ -0,0 +1,263 @@
+"""Batched notification publishing to the users' notification sockets.
+
+Notifications created in a transaction are collected and published once after it commits, so
+nothing is sent for a rolled back transaction and the request doesn't wait for a redis round
+trip per notification. The group sends of a batch run concurrently in one event loop pass,
+batches larger than 'NOTIFICATION_CELERY_THRESHOLD' are published by celery instead.
+
+Unread counters of the users are changed with the same commit, see 'notification.unread'.
+
+Bursts are coalesced by (user, notification_for, subject). The first notification of a burst
+is sent at once, the next ones in 'NOTIFICATION_COALESCE_WINDOW' seconds are only counted:
+
+    notification:burst:<user id>:<notification_for>:<subject>  notifications of the burst
+
+and 'flush_notification_burst' celery task sends one "N more updates" event of them when the
+window ends. When the task can't be queued the burst is ended at once and it's notifications are
+sent, a burst whose counter expired before it's task ran is flushed by nobody. Unread notifications are emailed by a periodic digest, see 'notification.digest'.
+
+Outside of a transaction notifications are published at once.
+"""
+
+import asyncio
+import logging
+import threading
+from collections import Counter
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import connection, transaction
+from django_redis import get_redis_connection
+from kombu.exceptions import KombuError
+from redis.exceptions import RedisError
+
+from core.utils.general_data import (COALESCED_NOTIFICATION_MSG, NOTIFICATION_CELERY_THRESHOLD,
+                                     NOTIFICATION_PUBLISH_CHUNK, ORDER_CREATE_MSG, ORDER_UPDATE_MSG)
+from notification import unread
+
+notification_logger = logging.getLogger("notification")
+
+_local = threading.local()
+
+# KEYS: burst counter; ARGV: ttl
+# Returns number of notifications in the burst, the first one is sent
+COALESCE_SCRIPT = """
+local count = redis.call('INCR', KEYS[1])
+if count == 1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return count
+"""
+
+# KEYS: burst counter
+# Ends the burst, returns number of it's notifications, nil when the counter expired
+FLUSH_SCRIPT = """
+local count = redis.call('GET', KEYS[1])
+redis.call('DEL', KEYS[1])
+return tonumber(count)
+"""
+
+
+def burst_key(notification) -> str:
+    """Returns redis key of the burst counter of a notification"""
+    return f"notification:burst:{notification.user_id}:{notification.notification_for}:{notification.subject or ''}"
+
+
+def notification_event(notification) -> list:
+    """Returns [group name, channel layer event, burst key] of a notification"""
+
+    message_format = ORDER_CREATE_MSG if notification.notification_for == "order_create" else ORDER_UPDATE_MSG
+    message = message_format.format(first_name="first_name", last_name="last_name")  # notification doesn't know who made the order
+    event = {"type": "message.notification", "message": message, "notification_for": notification.notification_for}
+
+    return [f"notification_room_{notification.user_id}", event, burst_key(notification)]
+
+
+async def group_send_all(events: list) -> int:
+    """Sends the events concurrently, returns number of failed sends
+
+    Parameters:
+        events (list): [group name, event] pairs
+    """
+    channel_layer = get_channel_layer()
+    failed = 0
+
+    for start in range(0, len(events), NOTIFICATION_PUBLISH_CHUNK):
+        results = await asyncio.gather(
+            *(channel_layer.group_send(group, event) for group, event in events[start:start + NOTIFICATION_PUBLISH_CHUNK]),
+            return_exceptions=True,
+        )
+        errors = [result for result in results if isinstance(result, Exception)]
+        failed += len(errors)
+        for error in errors[:1]:  # one of a chunk is enough, they are likely the same redis error
+            notification_logger.info("Exception happend", extra={"response_dict": {type(error).__name__: repr(error)}})
+
+    return failed
+
+
+def send_events(events: list) -> None:
+    """Sends the events in one event loop pass and logs the result"""
+
+    failed = async_to_sync(group_send_all)(events)
+    notification_logger.info(
+        "Info", extra={"response_dict": {"Success": f"{len(events) - failed} of {len(events)} notifications send"}}
+    )
+
+
+def coalesce(events: list) -> list:
+    """Returns [group name, event] pairs to send now, next events of a burst are only counted
+
+    Parameters:
+        events (list): [group name, event, burst key] of the notifications
+    """
+    window = settings.NOTIFICATION_COALESCE_WINDOW
+    if not window or not events:
+        return [[group, event] for group, event, _ in events]
+
+    try:
+        pipeline = get_redis_connection("default").pipeline(transaction=False)
+        for _, _, key in events:
+            pipeline.eval(COALESCE_SCRIPT, 1, key, window * 10)  # counter expires when it's flush task is lost
+        counts = pipeline.execute()
+    except RedisError as e:  # every notification is sent
+        notification_logger.info("Exception happend", extra={"response_dict": {"RedisError": repr(e)}})
+        return [[group, event] for group, event, _ in events]
+
+    from notification.tasks import flush_notification_burst  # tasks module imports this one
+
+    sends = []
+    unflushed = set()  # bursts whose flush task couldn't be queued, their notifications are sent
+    for (group, event, key), count in zip(events, counts):
+        if key in unflushed:
+            sends.append([group, event])
+        elif count == 1:  # first one of a burst
+            sends.append([group, event])
+            try:
+                flush_notification_burst.apply_async((key, group, event["notification_for"]), countdown=window)
+            except (KombuError, ConnectionError) as e:  # nothing would flush the counter
+                notification_logger.info("Exception happend", extra={"response_dict": {type(e).__name__: repr(e)}})
+                unflushed.add(key)
+
+    if unflushed:
+        try:
+            get_redis_connection("default").delete(*unflushed)
+        except RedisError as e:  # counters expire in 'window * 10' seconds
+            notification_logger.info("Exception happend", extra={"response_dict": {"RedisError": repr(e)}})
+    return sends
+
+
+def flush_burst(key: str, group: str, notification_for: str) -> None:
+    """Ends a burst and sends one event of it's notifications which weren't sent
+
+    Parameters:
+        key (str): burst key
+        group (str): notification group name of the user
+        notification_for (str): 'notification_for' of the burst
+    """
+    count = get_redis_connection("default").eval(FLUSH_SCRIPT, 1, key)
+    if count is None:  # expired before the task ran, it's count is unknown
+        notification_logger.info("Info", extra={"response_dict": {"Expired": f"{key} burst isn't flushed"}})
+        return
+
+    count -= 1  # first one is sent
+    if count > 0:
+        send_events([[group, {
+            "type": "message.notification",
+            "message": COALESCED_NOTIFICATION_MSG.format(count=count),
+            "notification_for": notification_for,
+            "count": count,
+        }]])
+
+
+def publish(events: list, unread_changes: Counter = None) -> None:
+    """Changes the unread counters and sends the events, large batches are handed to celery
+
+    Parameters:
+        events (list): [group name, event, burst key] of the notifications
+        unread_changes (Counter): {user id: change of the unread count}
+    """
+    try:
+        unread.change_counters(unread_changes)
+    except RedisError as e:  # counters expire and are reloaded from the db
+        notification_logger.info("Exception happend", extra={"response_dict": {"RedisError": repr(e)}})
+
+    events = coalesce(events)
+    if not events:
+        return
+
+    if len(events) > NOTIFICATION_CELERY_THRESHOLD:
+        from notification.tasks import publish_notifications  # tasks module imports this one
+
+        publish_notifications.delay(events)
+    else:
+        send_events(events)
+
+
+class PendingEvents:
+    """Events of the current transaction, published together after it commits
+
+    Methods
+    -------
+    flush():
+        Publishes the events, registered by 'transaction.on_commit'
+    is_registered():
+        Returns whether 'flush' is still waiting for the commit
+    """
+
+    def __init__(self):
+        self.events = []
+        self.unread_changes = Counter()
+
+    def flush(self) -> None:
+        """Publishes the events, registered by 'transaction.on_commit'"""
+
+        if getattr(_local, "pending", None) is self:
+            _local.pending = None
+        publish(self.events, self.unread_changes)
+
+    def is_registered(self) -> bool:
+        """Returns whether 'flush' is still waiting for the commit, rolled back transactions drop it"""
+        return any(callback == self.flush for _, callback in connection.run_on_commit)
+
+
+def dispatch(events: list, unread_changes: Counter = None) -> None:
+    """Publishes the events after the current transaction commits, at once when there is no transaction
+
+    Parameters:
+        events (list): [group name, event, burst key] of the notifications
+        unread_changes (Counter): {user id: change of the unread count}
+    """
+    if not connection.in_atomic_block:
+        publish(events, unread_changes)
+        return
+
+    pending = getattr(_local, "pending", None)
+    if pending is None or not pending.is_registered():
+        pending = _local.pending = PendingEvents()
+        transaction.on_commit(pending.flush)
+    pending.events.extend(events)
+    pending.unread_changes.update(unread_changes or {})
+
+
+def notify(notifications: list) -> None:
+    """Publishes saved notifications to their users' sockets, after the transaction commits
+
+    Parameters:
+        notifications (list): 'Notification' objects
+    """
+    dispatch(
+        [notification_event(notification) for notification in notifications],
+        Counter(notification.user_id for notification in notifications if not notification.is_read),
+    )
+
+
+def mark_read(user_id: int, count: int) -> None:
+    """Decrements the user's unread counter after the transaction commits
+
+    Parameters:
+        user_id (int): user id
+        count (int): number of notifications marked as read
+    """
+    if count:
+        dispatch([], Counter({user_id: -count}))
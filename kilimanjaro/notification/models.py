@@ -3,6 +3,40 @@ import uuid
 from django.db import models
 from model_utils.models import TimeStampedModel
 
+from notification import dispatch
+
+
+class NotificationManager(models.Manager):
+    """Notification manager
+
+    Methods
+    -------
+    bulk_notify(users=list, notification_for=str, body=str, subject=str):
+        Creates a notification for each user and publishes them together
+    """
+
+    def bulk_notify(
+        self, users: list, notification_for: str, body: str = None, subject: str = None, batch_size: int = 1000
+    ) -> list:
+        """Creates a notification for each user with one INSERT per batch and publishes them together
+        after the transaction commits, 'post_save' isn't sent for them
+
+        Parameters:
+            users (list): 'User' objects
+            notification_for (str): one of the 'notification_for' choices
+            body (str): notification body
+            subject (str): what the notification is about like an order uuid
+
+        Returns:
+            Created notifications
+        """
+        notifications = self.bulk_create(
+            [self.model(user=user, notification_for=notification_for, body=body, subject=subject) for user in users],
+            batch_size=batch_size,
+        )
+        dispatch.notify(notifications)
+        return notifications
+
 
 class Notification(TimeStampedModel):
 
@@ -17,7 +51,19 @@ class Notification(TimeStampedModel):
         max_length=100, choices=_notification_for_choices, null=True
     )
     body = models.CharField(max_length=225, null=True)
+    subject = models.CharField(max_length=100, null=True, blank=True)  # what it's about like an order uuid, bursts of a subject are coalesced
     is_read = models.BooleanField(default=False)
+    is_emailed = models.BooleanField(default=False)  # sent by a notification digest email
+
+    objects = NotificationManager()
+
+    class Meta:
+        indexes = [
+            # unread notifications of a user, newest first
+            models.Index(fields=['user', 'is_read', '-created'], name='notification_unread_idx'),
+            # all notifications of a user, newest first
+            models.Index(fields=['user', '-created'], name='notification_feed_idx'),
+        ]
 
     def __str__(self):
         return str(self.id)
@@ -1,7 +1,7 @@
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 
-from core.utils import send_notification
+from notification import dispatch
 from notification.models import Notification
 
 
@@ -9,10 +9,5 @@ from notification.models import Notification
 def push_notifications(sender, instance, created, **kwargs):
     if created:
 
-        # Sends notification to web socket layer
-        send_notification(
-            user_id=instance.user.id,
-            first_name=instance.user.first_name,
-            last_name=instance.user.last_name,
-            notification_for=instance.notification_for,
-        )  # Custom function to send notification
+        # Sends notification to web socket layer after the transaction commits, batched with the others
+        dispatch.notify([instance])
@@ -0,0 +1,45 @@
+"""Contains notification celery tasks"""
+
+from kilimanjaro.celery import app
+from notification import digest, dispatch
+
+
+@app.task(name="publish_notifications")
+def publish_notifications(events: list) -> None:
+    """
+    Publishing a large batch of notifications, handed over by 'notification.dispatch.publish'
+
+        Parameters:
+            events (list) : [group name, channel layer event] pairs
+
+        Returns:
+            None
+    """
+    dispatch.send_events(events)
+
+
+@app.task(name="flush_notification_burst")
+def flush_notification_burst(key: str, group: str, notification_for: str) -> None:
+    """
+    Ending a notification burst and sending one "N more updates" event of it, scheduled by 'notification.dispatch.coalesce'
+
+        Parameters:
+            key (str) : Burst counter key
+            group (str) : Notification group name of the user
+            notification_for (str) : 'notification_for' of the burst
+
+        Returns:
+            None
+    """
+    dispatch.flush_burst(key, group, notification_for)
+
+
+@app.task(name="send_notification_digests")
+def send_notification_digests() -> int:
+    """
+    Emailing each user one digest of the unread notifications, run by celery beat
+
+        Returns:
+            Number of sent digests
+    """
+    return digest.send_digests()
@@ -1,7 +1,18 @@
+import uuid
+from unittest.mock import patch
+
 import pytest
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.db import transaction
+from django_redis import get_redis_connection
+from kombu.exceptions import OperationalError
 from mixer.backend.django import mixer
 
 from core.utils.general_func import request_factory
+from kilimanjaro.asgi import application
+from notification import dispatch, unread
+from notification.digest import send_digests
 from notification.api.serializers import NotificationSerializer
 from notification.models import Notification
 
@@ -28,3 +39,158 @@ class TestNotification:
 
     def test_notification_string_representation(self, notification_obj):
         assert notification_obj.__str__() == str(notification_obj.id)
+
+    def test_notification_list_pages(self, api_client, auth_headers, user_obj):
+        notifications = Notification.objects.bulk_notify([user_obj] * 25, "order_create")
+
+        response = api_client.get(self.endpoint, HTTP_AUTHORIZATION=auth_headers)
+        assert [notification["id"] for notification in response.data["results"]] == [
+            notification.id for notification in notifications[:4:-1]
+        ]
+        assert response.data["pagination"]["has_older"] == True
+
+        response = api_client.get(
+            f"{self.endpoint}?before={response.data['pagination']['before']}", HTTP_AUTHORIZATION=auth_headers
+        )
+        assert len(response.data["results"]) == 5
+        assert response.data["pagination"]["has_older"] == False
+
+    def test_notification_mark_all_read_until(self, api_client, auth_headers, user_obj):
+        notifications = Notification.objects.bulk_notify([user_obj] * 3, "order_create")
+
+        response = api_client.patch(
+            f"{self.endpoint}mark_all_read/", {"until": notifications[1].id}, HTTP_AUTHORIZATION=auth_headers
+        )
+        assert response.data["marked"] == 2
+
+        response = api_client.get(f"{self.endpoint}?is_read=false", HTTP_AUTHORIZATION=auth_headers)
+        assert [notification["id"] for notification in response.data["results"]] == [notifications[2].id]
+
+        response = api_client.patch(f"{self.endpoint}mark_all_read/", HTTP_AUTHORIZATION=auth_headers)
+        assert response.data["marked"] == 1
+
+    def test_notification_digest_emails_each_user_once(self, settings, user_obj, user_obj2):
+        settings.NOTIFICATION_COALESCE_WINDOW = 0
+        Notification.objects.bulk_notify([user_obj] * 3 + [user_obj2], "order_update")
+        Notification.objects.create(user=user_obj, notification_for="order_create", is_read=True)
+
+        with patch("notification.digest.send_email.delay") as send_email:
+            assert send_digests(batch_size=1) == 2
+            assert send_digests() == 0  # already emailed
+
+        contexts = {call.kwargs["to_email"]: call.kwargs["context"] for call in send_email.call_args_list}
+        assert contexts[user_obj.email]["total"] == 3
+        assert contexts[user_obj.email]["counts"] == [{"label": "Order Update", "count": 3}]
+
+
+@pytest.mark.django_db(transaction=True)
+class TestNotificationDispatch:
+
+    def test_notifications_are_published_together_after_commit(self, user_obj, user_obj2):
+        with patch("notification.dispatch.send_events") as send_events:
+            with transaction.atomic():
+                Notification.objects.bulk_notify([user_obj, user_obj2], "order_create")
+                Notification.objects.create(user=user_obj, notification_for="order_update")
+                assert not send_events.called
+
+        send_events.assert_called_once()
+        events = send_events.call_args[0][0]
+        assert [group for group, _ in events] == [
+            f"notification_room_{user_obj.id}", f"notification_room_{user_obj2.id}", f"notification_room_{user_obj.id}"
+        ]
+        assert Notification.objects.count() == 3
+
+    def test_rolled_back_notifications_are_not_published(self, user_obj):
+        with patch("notification.dispatch.send_events") as send_events:
+            with pytest.raises(ValueError):
+                with transaction.atomic():
+                    Notification.objects.create(user=user_obj, notification_for="order_create")
+                    raise ValueError
+
+            Notification.objects.create(user=user_obj, notification_for="order_update")  # no transaction, sent at once
+
+        send_events.assert_called_once()
+        assert len(send_events.call_args[0][0]) == 1
+
+    def test_notification_bursts_are_coalesced(self, settings, user_obj):
+        settings.NOTIFICATION_COALESCE_WINDOW = 60
+        subject = uuid.uuid4().hex
+
+        with patch("notification.dispatch.send_events") as send_events, \
+                patch("notification.tasks.flush_notification_burst.apply_async") as flush_notification_burst:
+            for _ in range(5):
+                Notification.objects.create(user=user_obj, notification_for="order_update", subject=subject)
+
+            assert send_events.call_count == 1  # first one of the burst
+            flush_notification_burst.assert_called_once()
+
+            dispatch.flush_burst(*flush_notification_burst.call_args[0][0])
+
+        assert send_events.call_count == 2
+        assert send_events.call_args[0][0][0][1]["count"] == 4
+
+    def test_notification_burst_is_sent_when_flush_task_is_not_queued(self, settings, user_obj):
+        settings.NOTIFICATION_COALESCE_WINDOW = 60
+        subject = uuid.uuid4().hex
+
+        with patch("notification.dispatch.send_events") as send_events, \
+                patch("notification.tasks.flush_notification_burst.apply_async", side_effect=OperationalError):
+            for _ in range(3):
+                Notification.objects.create(user=user_obj, notification_for="order_update", subject=subject)
+
+        assert send_events.call_count == 3  # no burst without a flush task
+
+    def test_expired_notification_burst_is_not_flushed(self, user_obj):
+        with patch("notification.dispatch.send_events") as send_events:
+            dispatch.flush_burst(f"notification:burst:{uuid.uuid4().hex}", f"notification_room_{user_obj.id}", "order_update")
+
+        assert not send_events.called
+
+    def test_unread_counter_follows_create_and_mark_as_read(self, api_client, auth_headers, user_obj):
+        get_redis_connection("default").delete(unread.counter_key(user_obj.id))
+        assert unread.load_count(user_obj.id, 0, unread.start_load(user_obj.id))
+
+        notifications = Notification.objects.bulk_notify([user_obj, user_obj], "order_create")
+        assert unread.get_count(user_obj.id) == 2
+
+        for _ in range(2):  # already read notification doesn't change the counter
+            api_client.patch(
+                f"/notifications/{notifications[0].id}/mark_as_read/",
+                {"is_read": True},
+                HTTP_AUTHORIZATION=auth_headers,
+            )
+        assert unread.get_count(user_obj.id) == 1
+
+
+@pytest.mark.django_db(transaction=True)
+def test_unread_counter_is_not_loaded_when_changed_meanwhile(user_obj):
+    get_redis_connection("default").delete(unread.counter_key(user_obj.id))
+
+    token = unread.start_load(user_obj.id)
+    count = Notification.objects.filter(user=user_obj, is_read=False).count()
+    Notification.objects.create(user=user_obj, notification_for="order_create")  # after the db count
+
+    assert not unread.load_count(user_obj.id, count, token)
+    assert unread.get_count(user_obj.id) is None  # next read counts again
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_unread_snapshot_is_sent_on_connect(ws_user1, auth_token_for_user1):
+    get_redis_connection("default").delete(unread.counter_key(ws_user1.id))
+    await database_sync_to_async(Notification.objects.bulk_notify)([ws_user1, ws_user1], "order_create")
+    await database_sync_to_async(Notification.objects.create)(user=ws_user1, notification_for="order_update", is_read=True)
+
+    communicator = WebsocketCommunicator(
+        application, "/notification/", [(b'authorization', auth_token_for_user1.encode('ascii'))]
+    )
+    connected, _ = await communicator.connect()
+    assert connected
+
+    snapshot = await communicator.receive_json_from()
+    assert snapshot["type"] == "notification.snapshot"
+    assert snapshot["unread_count"] == 2  # counted by db, then read from redis
+    assert len(snapshot["notifications"]) == 2
+    assert unread.get_count(ws_user1.id) == 2
+
+    await communicator.disconnect()
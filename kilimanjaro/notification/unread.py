@@ -0,0 +1,109 @@
+"""Per-user unread notification counters, sent by the notification socket on connect.
+
+Redis keys:
+    notification:unread:<user id>          number of the user's unread notifications
+    notification:unread:loading:<user id>  token of the load in progress
+
+A counter is loaded from the db on it's first read. Created notifications increment it and
+'mark_as_read' decrements it after their transaction commits. A change of a counter which isn't
+loaded deletes the loading token instead, the db count of a load in progress may miss it, so
+that load isn't saved and the next read counts again. Counters expire after
+'NOTIFICATION_UNREAD_TTL', so a counter which drifted (e.g. deleted users' notifications) is
+reloaded.
+"""
+
+import uuid
+from collections import Counter
+
+from django_redis import get_redis_connection
+
+from core.utils.general_data import NOTIFICATION_UNREAD_LOAD_TTL, NOTIFICATION_UNREAD_TTL
+
+# KEYS: counter, loading token; ARGV: change, ttl
+# Counter never goes below 0, a load in progress is cancelled when there is no counter
+CHANGE_SCRIPT = """
+local count = redis.call('GET', KEYS[1])
+if count then
+    count = math.max(tonumber(count) + tonumber(ARGV[1]), 0)
+    redis.call('SET', KEYS[1], count, 'EX', ARGV[2])
+else
+    redis.call('DEL', KEYS[2])
+end
+"""
+
+# KEYS: counter, loading token; ARGV: token, count, ttl
+# Returns 1 when the counter is loaded, a counter set meanwhile is kept
+LOAD_SCRIPT = """
+if redis.call('GET', KEYS[2]) ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[2])
+if redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3], 'NX') then
+    return 1
+end
+return 0
+"""
+
+
+def counter_key(user_id: int) -> str:
+    """Returns redis key of the user's unread notification counter"""
+    return f"notification:unread:{user_id}"
+
+
+def loading_key(user_id: int) -> str:
+    """Returns redis key of the token of the user's counter load in progress"""
+    return f"notification:unread:loading:{user_id}"
+
+
+def change_counters(changes: Counter) -> None:
+    """Adds the changes to the loaded counters, cancels the loads in progress of the others
+
+    Parameters:
+        changes (Counter): {user id: change}
+    """
+    changes = {user_id: change for user_id, change in (changes or {}).items() if change}
+    if not changes:
+        return
+
+    pipeline = get_redis_connection("default").pipeline(transaction=False)
+    for user_id, change in changes.items():
+        pipeline.eval(CHANGE_SCRIPT, 2, counter_key(user_id), loading_key(user_id), change, NOTIFICATION_UNREAD_TTL)
+    pipeline.execute()
+
+
+def get_count(user_id: int):
+    """Returns the user's unread counter, None when it isn't loaded"""
+
+    count = get_redis_connection("default").get(counter_key(user_id))
+    return None if count is None else int(count)
+
+
+def start_load(user_id: int) -> str:
+    """Starts loading the user's unread counter, it's called before the db count is read
+
+    Returns:
+        Token of the load for 'load_count'
+    """
+    token = uuid.uuid4().hex
+    get_redis_connection("default").set(loading_key(user_id), token, ex=NOTIFICATION_UNREAD_LOAD_TTL)
+    return token
+
+
+def load_count(user_id: int, count: int, token: str) -> bool:
+    """Loads the user's unread counter with the db count
+
+    The count isn't saved when a change came after 'start_load' (the db count may not have it)
+    or another load started meanwhile, the next read counts again.
+
+    Parameters:
+        user_id (int): user id
+        count (int): db count of the unread notifications
+        token (str): token of 'start_load'
+
+    Returns:
+        Whether the counter is loaded
+    """
+    loaded = get_redis_connection("default").eval(
+        LOAD_SCRIPT, 2, counter_key(user_id), loading_key(user_id), token, count, NOTIFICATION_UNREAD_TTL
+    )
+    return bool(loaded)
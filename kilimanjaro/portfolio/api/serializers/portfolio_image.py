@@ -1,12 +1,22 @@
 from rest_framework import serializers
 
+from core.utils.general_data import PORTFOLIO_IMAGE_DISPLAY_SIZE
+from core.utils.images import pick_variant, with_host
 from portfolio.models import PortfolioImage
 
 
 class PortfolioImageSerializer(serializers.ModelSerializer):
+    picture_variant = serializers.SerializerMethodField()
+
     class Meta:
         model = PortfolioImage
-        fields = ["id", "picture"]
+        fields = ["id", "picture", "picture_variant"]
+
+    def get_picture_variant(self, obj):
+        # smallest image variant for the portfolio page, None until it's made
+        request = self.context.get("request")
+        host = request.build_absolute_uri("/").rstrip("/") if request else ""
+        return with_host(pick_variant(obj.picture_variants, PORTFOLIO_IMAGE_DISPLAY_SIZE), host)
 
     def validate(self, attrs):
 
@@ -29,6 +29,7 @@ class PortfolioImage(TimeStampedModel):
     picture = models.ImageField(
         upload_to=_upload_to_portfolio_picture, max_length=1000, null=True
     )  # _upload_to_portfolio_picture() has called here
+    picture_variants = models.JSONField(default=dict, blank=True, editable=False)  # set by 'generate_image_variants' task
     portfolio = models.ForeignKey(
         Portfolio, on_delete=models.CASCADE, verbose_name="portfolio"
     )
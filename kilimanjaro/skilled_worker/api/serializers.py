@@ -1,5 +1,7 @@
 from rest_framework import serializers
 
+from core.utils.general_data import PROFILE_PICTURE_DISPLAY_SIZE
+from core.utils.images import pick_variant, with_host
 from user.models import User
 
 
@@ -8,6 +10,7 @@ class UserSkilledWorkerProfileSerializer(serializers.ModelSerializer):
     occupation_name = serializers.SerializerMethodField()
     user_email = serializers.SerializerMethodField()
     user_phone_number = serializers.SerializerMethodField()
+    profile_picture_variant = serializers.SerializerMethodField()
 
     class Meta:
         model = User
@@ -22,6 +25,7 @@ class UserSkilledWorkerProfileSerializer(serializers.ModelSerializer):
             "country_name",
             "city",
             "profile_picture",
+            "profile_picture_variant",
             "age_consent",
         )
 
@@ -44,3 +48,9 @@ class UserSkilledWorkerProfileSerializer(serializers.ModelSerializer):
         if obj.occupation_name:
             return obj.occupation_name
         return None
+
+    def get_profile_picture_variant(self, obj):
+        # smallest image variant for the listing card, None until it's made
+        request = self.context.get("request")
+        host = request.build_absolute_uri("/").rstrip("/") if request else ""
+        return with_host(pick_variant(obj.profile_picture_variants, PROFILE_PICTURE_DISPLAY_SIZE), host)
@@ -45,7 +45,7 @@ class SkillWorkerViewset(viewsets.ModelViewSet):
         instance_portfolio_image_qs = instance_portfolio_obj.portfolioimage_set.all()
         portfolio_serializer = PortfolioSerializer(instance_portfolio_obj)
         portfolio_img_serializer = PortfolioImageSerializer(
-            instance_portfolio_image_qs, many=True
+            instance_portfolio_image_qs, many=True, context={"request": request}
         )
 
         data = {
@@ -1,9 +1,19 @@
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 
+from core.utils.general_data import ACCOUNT_VERIFIED_CLAIM
+from core.utils.general_func import is_account_verified
+
 
 class MyTokenObtainPairSerializer(TokenObtainPairSerializer):
     """Customises JWT response"""
 
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        # 'ForceAccountVerification' middleware reads it instead of the db
+        token[ACCOUNT_VERIFIED_CLAIM] = is_account_verified(user)
+        return token
+
     def validate(self, attrs):
         data = super().validate(attrs)  # Data dict
         jwt_token = self.get_token(self.user)
@@ -3,7 +3,7 @@ from rest_framework import permissions, viewsets
 from rest_framework.decorators import action
 from rest_framework.response import Response
 
-from core.utils import send_verification_credential
+from core.utils import get_tokens_for_user, send_verification_credential
 from user.models import AccountVerificationRequest
 
 
@@ -93,6 +93,9 @@ class AccountVerificationRequestViewset(viewsets.ViewSet):
             request_obj.is_used = True
             request_obj.save()
             data = {"message": "Success! Your account is verified"}
+            if request.user == user:
+                # new tokens have the verified claim, 'ForceAccountVerification' checks the old ones by cache
+                data.update(get_tokens_for_user(user))
             return Response(data, status=200)
 
         data = {"message": "Token already used or invalid"}
@@ -103,6 +103,7 @@ class User(AbstractUser, TimeStampedModel):
     profile_picture = models.ImageField(
         upload_to=_upload_to_profile_picture, max_length=1000, null=True
     )  # _upload_to_profile_picture() has called here
+    profile_picture_variants = models.JSONField(default=dict, blank=True, editable=False)  # set by 'generate_image_variants' task
     age_consent = models.PositiveIntegerField(null=True)
     terms_and_condition = models.BooleanField(null=True)
     is_phone_number_verified = models.BooleanField(default=False)
@@ -1,7 +1,9 @@
 import pytest
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.db.models import Q
 
+from core.utils.general_data import ACCOUNT_VERIFIED_CACHE_KEY
 from user.api.serializers import ResetPasswordRequestSerializer
 from user.models import ResetPasswordRequest
 
@@ -163,6 +165,12 @@ class TestAuthModels:
         )
         assert response.status_code == 200
 
+        # old token has the unverified claim, the new one is accepted
+        response = api_client.get(
+            "/notifications/", HTTP_AUTHORIZATION=f"Bearer {response.data['access']}"
+        )
+        assert response.status_code == 200
+
     def test_forget_password_email_send(self, api_client, user_obj1):
         data = {"email": user_obj1.email}
         response = api_client.post(self.reset_password_request_endpoint, data=data)
@@ -206,3 +214,32 @@ class TestAuthModels:
         }
         response = api_client.post(self.reset_password_endpoint, data=data)
         assert response.status_code == 422
+
+
+@pytest.mark.django_db(transaction=True)
+def test_refreshed_token_is_accepted_after_verification(api_client, auth_token1, account_verification_request_obj1):
+    cache.delete(ACCOUNT_VERIFIED_CACHE_KEY.format(user_id=account_verification_request_obj1.user_id))
+    response = api_client.get("/notifications/", HTTP_AUTHORIZATION=f"Bearer {auth_token1['access']}")
+    assert response.status_code == 428
+
+    # verified without the user's token, e.g. from the email link on another device
+    response = api_client.post("/user/verify-account/", data={"verification_key": "098765"})
+    assert response.status_code == 200
+
+    # refreshed access token copies the unverified claim of the refresh token
+    response = api_client.post("/api/token/refresh_token/", data={"refresh": auth_token1["refresh"]})
+    response = api_client.get("/notifications/", HTTP_AUTHORIZATION=f"Bearer {response.data['access']}")
+    assert response.status_code == 200
+
+
+@pytest.mark.django_db(transaction=True)
+def test_verified_token_is_rejected_after_losing_verification(api_client, auth_token, user_obj):
+    response = api_client.get("/notifications/", HTTP_AUTHORIZATION=f"Bearer {auth_token['access']}")
+    assert response.status_code == 200
+
+    user_obj.is_email_verified = user_obj.is_phone_number_verified = user_obj.is_staff = user_obj.is_superuser = False
+    user_obj.save()
+
+    # token still has the verified claim
+    response = api_client.get("/notifications/", HTTP_AUTHORIZATION=f"Bearer {auth_token['access']}")
+    assert response.status_code == 428